@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+# End-to-end load benchmark for the Grok Flask API (grok.py, grok_asgi.py)
+#
+# Starts the app under gunicorn against local stand-ins: one stub HTTP server plays the
+# OpenAI-compatible xAI chat/images API, Nominatim, Open-Meteo, YouTube oEmbed and the YouTube
+# Data API (each with its own latency distribution), and Redis is either an in-process fakeredis
+# or a real server. Client threads then drive /chat, /chat/stream and /generate-image with a
+# weighted message mix and the run reports throughput, p50/p95/p99 latency per request kind,
+# and CPU and RSS for each gunicorn worker (read from /proc, so Linux only).
+#
+#   python3 bench_server.py                                     # 2 sync workers, 8 clients, 30s
+#   python3 bench_server.py --async -w 2 -c 32 -d 60            # grok_asgi.py under uvicorn workers
+#   python3 bench_server.py --mix chat=70,weather=20,image=10 --xai-latency lognormal:0.8:0.4
+#   python3 bench_server.py --save base.json                    # keep the results...
+#   python3 bench_server.py --compare base.json                 # ...and judge a change against them
+import os
+import ast
+import sys
+import json
+import math
+import time
+import glob
+import random
+import shutil
+import signal
+import socket
+import struct
+import argparse
+import tempfile
+import threading
+import zlib
+import subprocess
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+import redis
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+CORPUS = {
+    'chat': [
+        "can you explain how a transistor works", "recommend a good sci-fi book", "what's 17 * 23",
+        "translate 'good morning' into german", "why is the sky blue", "write a haiku about eggdrop bots",
+        "explain quantum entanglement like I'm five", "best pizza topping?", "is python faster than perl",
+        "how do I set up an irc bouncer", "what does TCL stand for", "summarize the plot of dune",
+        "tell me a joke", "who is the president of france",
+    ],
+    'weather': [
+        "weather in falkirk", "what's the weather for london tomorrow", "forecast for glasgow",
+        "7-day weather for stirling", "temperature in paris today", "weather in perth tomorrow",
+    ],
+    'time': ["what time is it in tokyo", "time in new york", "what's the date today"],
+    'news': ["news for uk", "what's the news in america", "headlines please"],
+    'video': [
+        "give me a youtube link to never gonna give you up", "music video for bohemian rhapsody",
+        "song video of thunderstruck", "link to video of cats",
+    ],
+    'stream': ["write a short story about a lighthouse keeper", "explain how tcp handshakes work"],
+    'image': ["a cat wearing a hat", "a dragon over edinburgh castle", "sunset over loch lomond"],
+}
+DEFAULT_MIX = 'chat=55,weather=10,time=5,news=5,video=10,stream=5,image=10'
+def make_png(width: int, height: int, seed: int = 1) -> bytes:
+    """Noisy RGB PNG, so the app's downloads and renditions cost about what a real provider image does."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+    noise = random.Random(seed).randbytes(width * 3 * height)
+    rows = b''.join(b'\0' + bytes(b & 0x3f for b in noise[y * width * 3:(y + 1) * width * 3]) for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows, 6)) + chunk(b'IEND', b''))
+# Served as the "generated" image, at a typical provider size
+PNG = make_png(1024, 768)
+
+# ------------------------------------------------------------------------------
+# Latency distributions
+# ------------------------------------------------------------------------------
+def parse_latency(spec: str):
+    """'0', 'fixed:S', 'uniform:LO:HI', 'normal:MEAN:SD' or 'lognormal:MEDIAN:SIGMA' -> sampler (seconds)."""
+    kind, *args = spec.split(':')
+    try:
+        args = [float(a) for a in args]
+        if kind in ('0', 'none'):
+            return lambda: 0.0
+        if kind == 'fixed' and len(args) == 1:
+            return lambda: args[0]
+        if kind == 'uniform' and len(args) == 2:
+            return lambda: random.uniform(*args)
+        if kind == 'normal' and len(args) == 2:
+            return lambda: max(0.0, random.gauss(*args))
+        if kind == 'lognormal' and len(args) == 2:
+            return lambda: random.lognormvariate(math.log(args[0]), args[1]) if args[0] > 0 else 0.0
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"bad latency spec: {spec}")
+
+def parse_mix(spec: str) -> dict:
+    mix = {}
+    for part in spec.split(','):
+        kind, _, weight = part.partition('=')
+        if kind.strip() not in CORPUS:
+            raise argparse.ArgumentTypeError(f"unknown request kind {kind!r} (one of {', '.join(CORPUS)})")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+# ------------------------------------------------------------------------------
+# Stub upstreams
+# ------------------------------------------------------------------------------
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, as the real APIs allow
+    def log_message(self, *args):
+        pass
+    def _sleep(self, kind: str) -> None:
+        time.sleep(self.server.latency[kind]())
+    def _send(self, body: bytes, content_type: str = 'application/json', status: int = 200) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def _json(self, obj, status: int = 200) -> None:
+        self._send(json.dumps(obj).encode(), status=status)
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path.startswith('/img/'):
+            self._sleep('image')
+            return self._send(PNG, 'image/png')
+        if url.path == '/nominatim/search':
+            self._sleep('provider')
+            name = query.get('q', 'somewhere')
+            seed = sum(map(ord, name))
+            return self._json([{'lat': str(50 + seed % 8 + 0.123), 'lon': str(-4 + seed % 5 + 0.456),
+                                'display_name': f"{name.title()}, Stubland", 'place_id': seed}])
+        if url.path == '/openmeteo/v1/forecast':
+            self._sleep('provider')
+            days = [time.strftime('%Y-%m-%d', time.gmtime(time.time() + i * 86400)) for i in range(8)]
+            return self._json({
+                'current': {'temperature_2m': 12.5, 'weather_code': 3, 'relative_humidity_2m': 80,
+                            'wind_speed_10m': 14.0, 'pressure_msl': 1012.0},
+                'daily': {'time': days, 'temperature_2m_max': [14.0] * 8, 'temperature_2m_min': [7.0] * 8, 'weather_code': [3] * 8},
+            })
+        if url.path == '/oembed':
+            self._sleep('provider')
+            return self._json({'title': 'Stub video', 'html': '<iframe></iframe>'})
+        if url.path.startswith('/youtube/youtube/v3/search'):
+            self._sleep('provider')
+            vid = f"{abs(hash(query.get('q', ''))) % 10**11:011d}"
+            if query.get('type') == 'channel':
+                return self._json({'items': [{'id': {'channelId': 'UCstub'}, 'snippet': {'title': 'Stub channel'}}]})
+            return self._json({'items': [{'id': {'videoId': vid}, 'snippet': {'title': f"Stub: {query.get('q', '')[:40]}", 'channelTitle': 'Stub'}}]})
+        self._json({'error': 'not found'}, 404)
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            body = {}
+        if self.path.endswith('/images/generations'):
+            self._sleep('image')
+            host, port = self.server.server_address[:2]
+            return self._json({'created': int(time.time()), 'data': [{'url': f"http://{host}:{port}/img/{random.randrange(10**9)}.png"}]})
+        if not self.path.endswith('/chat/completions'):
+            return self._json({'error': 'not found'}, 404)
+        prompt = (body.get('messages') or [{}])[-1].get('content') or ''
+        text = ("Stub reply. " + ' '.join(prompt.split()[:12]) + ". " +
+                "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * random.randint(1, 4)).strip()
+        usage = {'prompt_tokens': sum(len((m.get('content') or '').split()) for m in body.get('messages') or []),
+                 'completion_tokens': len(text.split())}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        if not body.get('stream'):
+            self._sleep('xai')
+            return self._json({'id': 'stub', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model', 'stub'),
+                               'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                               'usage': usage})
+        # Streamed: the sampled latency is spread over the chunks, first token after a fifth of it
+        total = self.server.latency['xai']()
+        words = text.split(' ')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        time.sleep(total * 0.2)
+        for word in words:
+            chunk = {'id': 'stub', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': body.get('model', 'stub'),
+                     'choices': [{'index': 0, 'delta': {'content': word + ' '}, 'finish_reason': None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            time.sleep(total * 0.8 / len(words))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+def start_stub(latency: dict) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, name='stub-upstream', daemon=True).start()
+    return server
+
+# ------------------------------------------------------------------------------
+# Redis
+# ------------------------------------------------------------------------------
+def app_lua_scripts() -> list[str]:
+    """The *_LUA scripts grok.py registers, read from its source without importing it."""
+    tree = ast.parse(open(os.path.join(APP_DIR, 'grok.py')).read())
+    namespace = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id.endswith('_LUA') for t in node.targets):
+            exec(compile(ast.Module([node], type_ignores=[]), 'grok.py', 'exec'), namespace)
+    return [v for k, v in namespace.items() if k.endswith('_LUA')]
+
+def start_redis(mode: str, host: str, port: int):
+    """'fake': fakeredis on host:port inside this process; 'external': a server already listening there."""
+    if mode == 'fake':
+        from fakeredis import TcpFakeServer
+        server = TcpFakeServer((host, port))
+        threading.Thread(target=server.serve_forever, name='fake-redis', daemon=True).start()
+    else:
+        server = None
+    client = redis.Redis(host=host, port=port, decode_responses=True)
+    client.ping()
+    # fakeredis's TCP server never answers an EVALSHA for an unknown script, so load them up front
+    for script in app_lua_scripts():
+        client.script_load(script)
+    return server, client
+
+# ------------------------------------------------------------------------------
+# App under test
+# ------------------------------------------------------------------------------
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def write_config(workdir: str, args, stub_url: str) -> dict:
+    with open(args.config or os.path.join(APP_DIR, 'config.json')) as f:
+        config = json.load(f)
+    config.update({
+        'xai_api_key': 'bench', 'api_base_url': f"{stub_url}/v1", 'youtube_api_key': 'bench',
+        'redis_host': args.redis_host, 'redis_port': args.redis_port,
+        'log_file': os.path.join(workdir, 'grok.log'), 'log_level': args.log_level,
+        'trace_file': os.path.join(workdir, 'traces.ndjson'),
+        'run_startup_test': False, 'enable_image_generation': True, 'image_provider': '', 'image_save_dir': os.path.join(workdir, 'generate'),
+        'weather_provider': 'openmeteo', 'reply_cache_enabled': args.reply_cache, 'xai_keepwarm_interval': 0,
+        'geocode_db_path': os.path.join(workdir, 'geocode.sqlite3'), 'geocode_min_interval': 0,
+        'met_sitelist_path': os.path.join(workdir, 'met_sitelist.json'),
+        'youtube_discovery_path': os.path.join(workdir, 'youtube.v3.json'),
+        'provider_urls': {
+            'nominatim': f"{stub_url}/nominatim", 'openmeteo': f"{stub_url}/openmeteo",
+            'youtube_oembed': f"{stub_url}/oembed", 'youtube_api': f"{stub_url}/youtube",
+        },
+    })
+    if args.rate_limit is not None: # replay_log.py --bench passes None to keep the base config's cooldowns
+        config.update({'rate_limit_seconds': args.rate_limit, 'image_cooldown': 0})
+    os.makedirs(config['image_save_dir'], exist_ok=True)
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+    return config
+
+def start_app(workdir: str, args, port: int) -> subprocess.Popen:
+    """gunicorn serving a copy of the app from workdir (grok.py reads config.json next to itself)."""
+    for path in glob.glob(os.path.join(APP_DIR, '*.py')):
+        shutil.copy(path, workdir)
+    cmd = [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '-b', f"127.0.0.1:{port}",
+           '--timeout', '120', '--log-file', os.path.join(workdir, 'gunicorn.log')]
+    cmd += ['-k', 'uvicorn.workers.UvicornWorker', 'grok_asgi:app'] if args.use_async else ['grok:app']
+    proc = subprocess.Popen(cmd, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT, start_new_session=True)
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {proc.returncode}; see {workdir}/gunicorn.log")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=2).status_code == 200 and \
+                    len(worker_pids(proc.pid)) >= args.workers:
+                return proc
+        except requests.RequestException:
+            pass
+        time.sleep(0.25)
+    stop_app(proc)
+    raise RuntimeError(f"app not healthy after {args.startup_timeout}s; see {workdir}/gunicorn.log")
+
+def stop_app(proc: subprocess.Popen) -> None:
+    if proc.poll() is None:
+        os.killpg(proc.pid, signal.SIGTERM)
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+
+# ------------------------------------------------------------------------------
+# Worker CPU / RSS from /proc
+# ------------------------------------------------------------------------------
+def worker_pids(master: int) -> list[int]:
+    pids = []
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master:
+            pids.append(int(stat.split('/')[2]))
+    return sorted(pids)
+
+def proc_sample(pid: int) -> tuple[float, int] | None:
+    """(CPU seconds used so far, RSS bytes) for pid, or None once it has gone."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+    except (OSError, IndexError):
+        return None
+    return (int(fields[11]) + int(fields[12])) / CLK_TCK, rss_pages * PAGE_SIZE
+
+class ProcMonitor(threading.Thread):
+    """Samples the master and each worker every `interval` seconds: CPU used since start(), current and peak RSS."""
+    def __init__(self, master: int, interval: float = 0.5):
+        super().__init__(name='proc-monitor', daemon=True)
+        self.master, self.interval = master, interval
+        self.pids = [master] + worker_pids(master)
+        self.first = {pid: proc_sample(pid) for pid in self.pids}
+        self.last = dict(self.first)
+        self.peak = {pid: s[1] for pid, s in self.first.items() if s}
+        self.stopped = threading.Event()
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+    def sample(self):
+        for pid in self.pids:
+            s = proc_sample(pid)
+            if s:
+                self.last[pid] = s
+                self.peak[pid] = max(self.peak.get(pid, 0), s[1])
+    def report(self, elapsed: float) -> list[dict]:
+        self.stopped.set()
+        self.sample()
+        rows = []
+        for pid in self.pids:
+            first, last = self.first.get(pid), self.last.get(pid)
+            if not first or not last:
+                continue
+            cpu = last[0] - first[0]
+            rows.append({'pid': pid, 'role': 'master' if pid == self.master else 'worker', 'cpu_s': round(cpu, 2),
+                         'cpu_pct': round(100 * cpu / elapsed, 1) if elapsed else 0.0,
+                         'rss_mb': round(last[1] / 2**20, 1), 'peak_rss_mb': round(self.peak[pid] / 2**20, 1)})
+        return rows
+
+# ------------------------------------------------------------------------------
+# Load
+# ------------------------------------------------------------------------------
+def send(session: requests.Session, base: str, kind: str, nick: str, channel: str, timeout: float) -> int:
+    message = random.choice(CORPUS[kind])
+    if kind == 'image':
+        return session.post(f"{base}/generate-image", json={'prompt': message, 'nick': nick}, timeout=timeout).status_code
+    if kind == 'stream':
+        with session.post(f"{base}/chat/stream", json={'message': message, 'nick': nick, 'channel': channel},
+                          timeout=timeout, stream=True) as resp:
+            for _ in resp.iter_lines():
+                pass
+            return resp.status_code
+    return session.post(f"{base}/chat", json={'message': message, 'nick': nick, 'channel': channel}, timeout=timeout).status_code
+
+def run_load(base: str, args) -> tuple[list, float]:
+    """Client threads send mix-weighted requests until the duration or request count is used up; returns samples, seconds."""
+    kinds, weights = zip(*args.mix.items())
+    sessions = [(f"bench{i}", f"#bench{i % 4}") for i in range(args.sessions)]
+    samples = []
+    lock = threading.Lock()
+    sent = iter(range(args.requests)) if args.requests else None
+    begin = time.perf_counter()
+    record_after = begin + args.warmup
+    deadline = None if args.requests else record_after + args.duration
+    def client():
+        http = requests.Session()
+        while True:
+            if sent is not None:
+                with lock:
+                    if next(sent, None) is None:
+                        return
+            elif time.perf_counter() >= deadline:
+                return
+            kind = random.choices(kinds, weights)[0]
+            nick, channel = random.choice(sessions)
+            start = time.perf_counter()
+            try:
+                status = send(http, base, kind, nick, channel, args.timeout)
+            except requests.RequestException as e:
+                status = type(e).__name__
+            end = time.perf_counter()
+            if start >= record_after:
+                with lock:
+                    samples.append((kind, status, end - start, end))
+    threads = [threading.Thread(target=client, name=f"client-{i}") for i in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, time.perf_counter() - max(record_after, begin)
+
+def percentile(ordered: list, p: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+def summarize(samples: list) -> dict:
+    latencies = sorted(s[2] for s in samples)
+    statuses = {}
+    for s in samples:
+        statuses[str(s[1])] = statuses.get(str(s[1]), 0) + 1
+    return {'requests': len(samples), 'errors': sum(1 for s in samples if not (isinstance(s[1], int) and s[1] < 400)),
+            'statuses': statuses, 'mean_ms': round(1000 * sum(latencies) / len(latencies), 1) if latencies else 0.0,
+            **{f"p{p}_ms": round(1000 * percentile(latencies, p), 1) for p in (50, 95, 99)},
+            'max_ms': round(1000 * latencies[-1], 1) if latencies else 0.0}
+
+def print_report(results: dict, baseline: dict | None = None) -> None:
+    run = results['run']
+    print(f"\n{run['app']} x{run['workers']} workers, {run['concurrency']} clients, {run['elapsed_s']}s, redis={run['redis']}")
+    print(f"Throughput: {results['throughput_rps']} req/s over {results['overall']['requests']} requests "
+          f"({results['overall']['errors']} errors)")
+    header = f"{'kind':<10} {'count':>7} {'err':>5} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (ms)"
+    print(header)
+    print('-' * len(header))
+    for kind, s in [*results['by_kind'].items(), ('ALL', results['overall'])]:
+        print(f"{kind:<10} {s['requests']:>7} {s['errors']:>5} {s['mean_ms']:>8} {s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8} {s['max_ms']:>8}")
+    print(f"Statuses: {', '.join(f'{k}={v}' for k, v in sorted(results['overall']['statuses'].items()))}")
+    print(f"\n{'pid':>8} {'role':<7} {'cpu s':>8} {'cpu %':>7} {'rss MB':>8} {'peak MB':>8}")
+    for p in results['processes']:
+        print(f"{p['pid']:>8} {p['role']:<7} {p['cpu_s']:>8} {p['cpu_pct']:>7} {p['rss_mb']:>8} {p['peak_rss_mb']:>8}")
+    if baseline:
+        print(f"\nvs {baseline['run'].get('label') or 'baseline'}:")
+        pairs = [('throughput_rps', results['throughput_rps'], baseline['throughput_rps'])]
+        pairs += [(k, results['overall'][k], baseline['overall'][k]) for k in ('p50_ms', 'p95_ms', 'p99_ms')]
+        worker_cpu = lambda r: sum(p['cpu_s'] for p in r['processes'] if p['role'] == 'worker') / max(r['overall']['requests'], 1)
+        pairs.append(('worker_cpu_ms_per_req', round(1000 * worker_cpu(results), 2), round(1000 * worker_cpu(baseline), 2)))
+        for name, now, before in pairs:
+            change = f"{100 * (now - before) / before:+.1f}%" if before else 'n/a'
+            print(f"  {name:<24} {before:>10} -> {now:<10} {change}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark for the Grok API against local stub upstreams")
+    parser.add_argument('-w', '--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--async', dest='use_async', action='store_true', help="serve grok_asgi.py with uvicorn workers")
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help="concurrent client threads")
+    parser.add_argument('-d', '--duration', type=float, default=30.0, help="seconds of measured load")
+    parser.add_argument('-n', '--requests', type=int, default=0, help="stop after this many requests instead of --duration")
+    parser.add_argument('--warmup', type=float, default=3.0, help="seconds of load before measuring starts")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f"kind=weight,... (default {DEFAULT_MIX})")
+    parser.add_argument('--sessions', type=int, default=50, help="distinct nick:channel sessions to spread requests over")
+    parser.add_argument('--xai-latency', type=parse_latency, default=parse_latency('lognormal:0.6:0.35'), help="chat completion latency")
+    parser.add_argument('--image-latency', type=parse_latency, default=parse_latency('lognormal:2.0:0.3'), help="image generation/download latency")
+    parser.add_argument('--provider-latency', type=parse_latency, default=parse_latency('lognormal:0.12:0.4'), help="geocode/weather/YouTube latency")
+    parser.add_argument('--redis', choices=('fake', 'external'), default='fake', help="fakeredis in this process, or a server already running")
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--rate-limit', type=float, default=0, help="rate_limit_seconds for the app under test; image_cooldown is always 0 here (default: 0)")
+    parser.add_argument('--reply-cache', action=argparse.BooleanOptionalAction, default=True, help="shared reply cache on/off")
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('--config', help="base config.json (default: the one next to this script)")
+    parser.add_argument('--timeout', type=float, default=60.0, help="client request timeout")
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--keep', action='store_true', help="keep the work directory (logs, traces, config)")
+    parser.add_argument('--label', default='', help="name stored with --save results")
+    parser.add_argument('--save', help="write the results as JSON")
+    parser.add_argument('--compare', help="results JSON from an earlier --save to compare against")
+    args = parser.parse_args()
+    if not os.path.isdir('/proc/self'):
+        parser.error("worker CPU/RSS sampling needs /proc (Linux)")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    stub = start_stub({'xai': args.xai_latency, 'image': args.image_latency, 'provider': args.provider_latency})
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    redis_server, _ = start_redis(args.redis, args.redis_host, args.redis_port)
+    workdir = tempfile.mkdtemp(prefix='grok_bench_')
+    write_config(workdir, args, stub_url)
+    port = free_port()
+    print(f"Stub upstreams at {stub_url}, redis {args.redis} at {args.redis_host}:{args.redis_port}, work dir {workdir}")
+    proc = start_app(workdir, args, port)
+    try:
+        monitor = ProcMonitor(proc.pid)
+        monitor.start()
+        samples, elapsed = run_load(f"http://127.0.0.1:{port}", args)
+        processes = monitor.report(elapsed)
+    finally:
+        stop_app(proc)
+        stub.shutdown()
+        if redis_server is not None:
+            redis_server.shutdown()
+    by_kind = {kind: summarize([s for s in samples if s[0] == kind]) for kind in args.mix}
+    results = {
+        'run': {'label': args.label, 'app': 'grok_asgi:app' if args.use_async else 'grok:app', 'workers': args.workers,
+                'concurrency': args.concurrency, 'elapsed_s': round(elapsed, 2), 'redis': args.redis,
+                'mix': args.mix, 'reply_cache': args.reply_cache, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        'overall': summarize(samples),
+        'by_kind': by_kind,
+        'processes': processes,
+    }
+    print_report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults saved to {args.save}")
+    if args.keep:
+        print(f"Work dir kept: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
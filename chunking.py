@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# IRC line chunking for the Grok Flask API (grok.py, grok_asgi.py)
+#
+# chunked_reply() splits a whole reply into IRC-safe lines: newlines are kept, paragraphs over
+# max_line_len are wrapped on spaces (textwrap, which also expands their tabs). IncrementalChunker
+# gives the same lines from a streamed reply as the deltas arrive, emitting each line once nothing
+# later in the stream can change it. test_chunking.py checks the two against each other.
+import re
+import textwrap
+
+def chunked_reply(text: str, max_line_len: int = 380) -> list[str]:
+    """Chunk text into IRC-safe lines: preserve newlines, wrap long lines on spaces, ensure first chunk is single unbroken line."""
+    if not text:
+        return [text]
+    # Split on natural newlines first
+    paragraphs = text.split('\n')
+    chunks = []
+    for para in paragraphs:
+        para = para.rstrip()  # Trim trailing spaces
+        if not para:
+            continue
+        # If para is already short, keep as-is (allows newlines)
+        if len(para) <= max_line_len:
+            chunks.append(para)
+        else:
+            # Wrap long para on spaces to avoid mid-word splits
+            wrapped = textwrap.wrap(para, width=max_line_len, break_long_words=False, replace_whitespace=False)
+            chunks.extend(wrapped)
+    # Ensure first chunk is a "single line" (no internal wraps if possible, but under limit)
+    if len(chunks) > 0 and len(chunks[0]) > max_line_len:
+        # Rare case; force wrap first para if oversized
+        first_para = chunks[0]
+        chunks[0] = textwrap.wrap(first_para, width=max_line_len, break_long_words=False, replace_whitespace=False)[0]
+    return chunks
+
+class IncrementalChunker:
+    """Incremental chunked_reply() for streamed replies.
+
+    feed() model deltas and get back the IRC-safe lines that can no longer change; flush() returns the rest.
+    Lines come out as chunked_reply() would split the whole text, so the first is still a single unbroken line.
+    """
+    def __init__(self, max_line_len: int = 380):
+        self.max_line_len = max_line_len
+        self.buffer = ''
+        self.started = False
+        self.column = None # once the paragraph is known to be wrapped: its columns already sent
+
+    def _expand(self, text: str) -> str:
+        """Tabs expanded as textwrap expands them in the whole paragraph (from its start, not the buffer's)."""
+        if self.column is None or '\t' not in text:
+            return text
+        pad = self.column % 8
+        return (' ' * pad + text).expandtabs()[pad:]
+
+    def _wrap(self, para: str) -> list[str]:
+        para = para.rstrip()
+        if not para:
+            return []
+        if len(para) <= self.max_line_len:
+            return [para]
+        return textwrap.wrap(para, width=self.max_line_len, break_long_words=False, replace_whitespace=False)
+
+    def feed(self, text: str) -> list[str]:
+        self.buffer += text
+        if not self.started: # same as the .strip() on full replies
+            self.buffer = self.buffer.lstrip()
+            self.started = bool(self.buffer)
+        # Literal '\\n' from the model means newline; hold back a trailing backslash until the next delta
+        held = len(self.buffer) - len(self.buffer.rstrip('\\'))
+        body, tail = (self.buffer[:-held], self.buffer[-held:]) if held else (self.buffer, '')
+        self.buffer = body.replace(r'\\n', '\n') + tail
+        lines = []
+        while '\n' in self.buffer:
+            para, self.buffer = self.buffer.split('\n', 1)
+            lines.extend(self._wrap(self._expand(para)))
+            self.column = None
+        # A long paragraph: every wrapped line but the last is final once the last line's first word is
+        # complete (until then a later hyphen could still pull part of it up a line). Held backslashes
+        # don't count towards its length: they may yet turn out to be its end.
+        body = self.buffer[:len(self.buffer) - held]
+        if self.column is not None or len(body.rstrip()) > self.max_line_len:
+            self.column = self.column or 0 # chunked_reply will textwrap (and so expand) this paragraph
+            self.buffer = self._expand(self.buffer)
+            body = self.buffer[:len(self.buffer) - held]
+            wrapped = self._wrap(body)
+            if len(wrapped) > 1:
+                cut = body.rfind(wrapped[-1])
+                if cut > 0 and re.search(r"\s", body[cut:]):
+                    lines.extend(wrapped[:-1])
+                    self.column += cut
+                    self.buffer = self.buffer[cut:]
+        return lines
+
+    def flush(self) -> list[str]:
+        lines = self._wrap(self._expand(self.buffer))
+        self.buffer = ''
+        self.column = None
+        return lines
@@ -5,7 +5,7 @@
 
 $dir = __DIR__;
 $files = array_filter(scandir($dir), function($f) use ($dir) {
-    return $f !== '.' && $f !== '..' && is_file($dir . '/' . $f);
+    return $f[0] !== '.' && is_file($dir . '/' . $f); // skips downloads still in progress (.*.part)
 });
 sort($files); // Alphabetical order
 
@@ -24,12 +24,29 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST' && isset($_POST['clear_dir']) && $_POS
             }
         }
     }
+    // Renditions made by grok.py (image_pipeline.py)
+    foreach (['web', 'thumbs'] as $sub) {
+        foreach (glob($dir . '/' . $sub . '/*') ?: [] as $path) {
+            unlink($path);
+        }
+    }
     // Redirect to refresh the page
     header('Location: /generate/');
     exit;
 }
 
 $imageTypes = ['jpg', 'jpeg', 'png', 'gif', 'webp', 'svg'];
+
+// Web copy or thumbnail of an image, if grok.py has made one ('web' or 'thumbs'); null otherwise
+function rendition($dir, $file, $sub) {
+    $stem = pathinfo($file, PATHINFO_FILENAME);
+    foreach (['webp', 'jpg'] as $ext) {
+        if (is_file("$dir/$sub/$stem.$ext")) {
+            return "$sub/" . urlencode("$stem.$ext");
+        }
+    }
+    return null;
+}
 ?>
 <!DOCTYPE html>
 <html lang="en">
@@ -87,20 +104,22 @@ $imageTypes = ['jpg', 'jpeg', 'png', 'gif', 'webp', 'svg'];
                         $ext = strtolower(pathinfo($file, PATHINFO_EXTENSION));
                         $isImage = in_array($ext, $imageTypes);
                         $fileUrl = '/generate/' . urlencode($file);
+                        $thumb = $isImage ? rendition($dir, $file, 'thumbs') : null;
+                        $web = $isImage ? rendition($dir, $file, 'web') : null;
                         $fileSize = filesize($dir . '/' . $file);
                         $sizeStr = $fileSize < 1024 ? $fileSize . ' B' : ($fileSize < 1048576 ? round($fileSize / 1024, 1) . ' KB' : round($fileSize / 1048576, 1) . ' MB');
                     ?>
                         <tr>
                             <td>
                                 <?php if ($isImage): ?>
-                                    <img src="<?php echo $fileUrl; ?>" alt="<?php echo htmlspecialchars($file); ?>" class="thumb" loading="lazy">
+                                    <img src="<?php echo $thumb ? '/generate/' . $thumb : $fileUrl; ?>" alt="<?php echo htmlspecialchars($file); ?>" class="thumb" loading="lazy">
                                 <?php else: ?>
                                     <div class="no-thumb">📄</div>
                                 <?php endif; ?>
                             </td>
                             <td><?php echo htmlspecialchars($file); ?></td>
                             <td><?php echo $sizeStr; ?></td>
-                            <td><a href="<?php echo $fileUrl; ?>" target="_blank">View</a></td>
+                            <td><a href="<?php echo $web ? '/generate/' . $web : $fileUrl; ?>" target="_blank">View</a><?php if ($web): ?> · <a href="<?php echo $fileUrl; ?>" target="_blank">Original</a><?php endif; ?></td>
                         </tr>
                     <?php endforeach; ?>
                 </tbody>
@@ -12,52 +12,121 @@ import subprocess
 import json
 import logging
 import time
+BOOT_STARTED = time.perf_counter() # startup profile (boot_step), taken before the heavy imports
 import hashlib
 import random
 import string
 import uuid
 import re
+import math
+import bisect
+import itertools
+import sqlite3
+import threading
 import traceback
+import atexit
+import queue
+import contextvars
+import io
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import requests # For downloading images
 from datetime import datetime, timedelta, timezone
-from flask import Flask, request, jsonify, send_from_directory
-from openai import OpenAI, APIError, APIConnectionError, Timeout, BadRequestError
+from flask import Flask, Blueprint, current_app, request, jsonify, send_from_directory, Response, stream_with_context, g, redirect
+from openai import OpenAI, APIError, APIConnectionError, BadRequestError
 import openai
+import httpx # openai's transport: its errors can escape while a stream is being read
 import flask
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from xai_client import get_client, probe # Pooled, fork-safe xAI clients
+from intent_router import route_message, chat_branch, has_time_intent, extract_location # Single-pass intent routing
+from prompt_budget import estimator, fit_prompt # Token-budgeted history
+from chunking import chunked_reply, IncrementalChunker # IRC-safe reply lines, whole or streamed
+import metrics # /metrics, aggregated across workers through Redis
+import tracing # Per-request spans, NDJSON sink
+import image_pipeline # Web copies and thumbnails of generated images (Pillow, in a process pool)
+from contextlib import contextmanager
 import redis
-import textwrap  # For wrapping text in chunked_reply
 try:
     from zoneinfo import ZoneInfo # Python 3.9+
 except Exception: # pragma: no cover
     ZoneInfo = None
-# For weather geocoding
-from geopy.geocoders import Nominatim
-import bleach # For sanitization
-# For Stability AI (optional image provider)
-from stability_sdk import client as stability_client
-# For YouTube API
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+# Provider SDKs (geopy, googleapiclient/httplib2, bleach, huggingface_hub) are imported on first use,
+# so a worker boots without them; Stability goes through the OpenAI-compatible client
 # For email sending
 from email.message import EmailMessage
 import smtplib
 # ------------------------------------------------------------------------------
 # Logging
 # ------------------------------------------------------------------------------
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('/tmp/xaiChatApi.log') # Will be overridden by config.json
-    ]
-)
+# Request threads only put records on a queue; one listener thread per process formats them and
+# does the stdout/file I/O. DEBUG records pass only for sessions picked by sample_debug().
+# Startup profile: seconds per import-time phase, logged once per process and shown in /debug
+boot_times = {}
+_boot_mark = {'at': BOOT_STARTED}
+def boot_step(phase: str) -> None:
+    """Close the startup phase that began at the previous boot_step()."""
+    now = time.perf_counter()
+    boot_times[phase] = round(now - _boot_mark['at'], 4)
+    _boot_mark['at'] = now
+boot_step('imports')
+log_queue = queue.SimpleQueue()
+log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+log_debug = contextvars.ContextVar('log_debug') # DEBUG records wanted for the current /chat request
+log_debug_default = True # outside a sampled request: whether log_level itself is DEBUG
+class DebugSampleFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or log_debug.get(log_debug_default)
+def _log_handlers(log_file: str, max_bytes: int = 0, backup_count: int = 0) -> tuple:
+    handlers = (logging.StreamHandler(sys.stdout), RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count))
+    for h in handlers:
+        h.setFormatter(log_formatter)
+    return handlers
+log_queue_handler = QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter('%(message)s')) # merge args/traceback only; the listener adds the prefix
+log_queue_handler.addFilter(DebugSampleFilter())
+log_listener = QueueListener(log_queue, *_log_handlers('/tmp/xaiChatApi.log')) # Will be overridden by config.json
+logging.basicConfig(level=logging.DEBUG, handlers=[log_queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
+def _restart_log_listener() -> None:
+    """The listener thread doesn't survive fork; give each gunicorn worker a fresh queue and its own."""
+    global log_queue
+    log_queue = log_queue_handler.queue = log_listener.queue = queue.SimpleQueue()
+    log_listener._thread = None
+    log_listener.start()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_log_listener)
 logger = logging.getLogger(__name__)
 logger.info("Starting XaiChatApi.py initialization")
 # ------------------------------------------------------------------------------
 # Config
 # ------------------------------------------------------------------------------
+def configure_logging(config: dict) -> None:
+    """Point the listener at config's log file (rotated by size) and set the level and DEBUG sampling."""
+    global log_debug_default
+    level = logging.getLevelName(str(config['log_level']).upper())
+    level = level if isinstance(level, int) else logging.INFO
+    log_listener.stop()
+    for h in log_listener.handlers:
+        h.close()
+    log_listener.handlers = _log_handlers(config['log_file'], int(config['log_max_bytes']), int(config['log_backup_count']))
+    log_listener.start()
+    # Sampled sessions need DEBUG records to reach the filter, so open the root level when sampling
+    logging.getLogger().setLevel(logging.DEBUG if config['log_debug_sample_rate'] > 0 else level)
+    log_debug_default = level <= logging.DEBUG
+def sample_debug(session_key: str) -> bool:
+    """Decide (stably per session) whether this request logs at DEBUG; returns the decision."""
+    sampled = log_debug_default
+    rate = config['log_debug_sample_rate']
+    if not sampled and rate > 0:
+        sampled = int(hashlib.md5(session_key.encode()).hexdigest()[:8], 16) / 0xffffffff < rate
+    log_debug.set(sampled)
+    return sampled
+def debug_payloads() -> bool:
+    """True when a DEBUG record from this request would be written (guard for costly log arguments)."""
+    return logger.isEnabledFor(logging.DEBUG) and log_debug.get(log_debug_default)
 def load_config():
     config_path = os.path.join(os.path.dirname(__file__), 'config.json')
     logger.debug(f"Attempting to load config from {config_path}")
@@ -78,6 +147,21 @@ def load_config():
         history_fields = ['max_history_turns', 'rate_limit_seconds']
         required_fields.extend(history_fields)
         # weather providers and keys
+        # Redis (shared history, rate limits, caches, metrics); the in-memory fallbacks cover an outage
+        config.setdefault('redis_host', 'localhost')
+        config.setdefault('redis_port', 6379)
+        config.setdefault('redis_db', 0)
+        # Logging: level, share of /chat sessions logged at DEBUG regardless, size-based rotation
+        config.setdefault('log_level', 'INFO')
+        config.setdefault('log_debug_sample_rate', 0.0)
+        config.setdefault('log_max_bytes', 10 * 1024 * 1024)
+        config.setdefault('log_backup_count', 5)
+        # /metrics: seconds between each worker adding its counts to the shared Redis hash
+        config.setdefault('metrics_flush_interval', 5.0)
+        # Tracing: NDJSON span file ('' to disable), share of /chat requests traced, rotation size
+        config.setdefault('trace_file', '/tmp/grok_traces.ndjson')
+        config.setdefault('trace_sample_rate', 1.0)
+        config.setdefault('trace_max_bytes', 50 * 1024 * 1024)
         config.setdefault('weather_provider', 'none') # 'met', 'openweather', 'openmeteo', or 'none'
         config.setdefault('met_api_key', '')
         config.setdefault('openweather_api_key', '')
@@ -87,8 +171,32 @@ def load_config():
         config.setdefault('hf_api_key', '')
         # Enable/disable image generation
         config.setdefault('enable_image_generation', True) # Default to enabled
+        # Image jobs: generation threads per web worker (0 leaves the queue to `python3 grok.py --image-worker`,
+        # which runs image_worker_threads), seconds a job's status is kept, seconds before a job whose process
+        # died is retried, and the longest /generate-image may be asked to wait for the image (its "wait" field)
+        config.setdefault('image_job_workers', 2)
+        config.setdefault('image_worker_threads', 4)
+        config.setdefault('image_job_ttl', 86400)
+        config.setdefault('image_job_timeout', 300)
+        config.setdefault('image_job_max_wait', 60)
+        # Seconds a normalized image prompt keeps pointing at the image it produced; repeats reuse it (0 always generates)
+        config.setdefault('image_dedupe_window', 7 * 86400)
+        # Largest image accepted from a provider, in bytes (downloads stream to disk and stop past this)
+        config.setdefault('image_max_bytes', 20 * 1024 * 1024)
+        # Image renditions (image_pipeline.py, run in a process pool): format ('webp' or 'jpeg') and quality, longest side
+        # of the copy linked on IRC and of the gallery thumbnail; image_process_workers 0 links the originals instead
+        config.setdefault('image_rendition_format', 'webp')
+        config.setdefault('image_rendition_quality', 80)
+        config.setdefault('image_web_max_px', 1024)
+        config.setdefault('image_thumb_max_px', 256)
+        config.setdefault('image_process_workers', 2)
         # YouTube API key
         config.setdefault('youtube_api_key', os.getenv('YOUTUBE_API_KEY', ''))
+        # oEmbed link validity cache, seconds per verdict
+        config.setdefault('youtube_valid_ttl', 86400)
+        config.setdefault('youtube_invalid_ttl', 600)
+        # Saved copy of the YouTube discovery document, used if the installed client library doesn't bundle one
+        config.setdefault('youtube_discovery_path', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'youtube.v3.json'))
         # SMTP for email sending
         config.setdefault('smtp_server', '')
         config.setdefault('smtp_port', 587)
@@ -97,6 +205,50 @@ def load_config():
         config.setdefault('smtp_from', '')
         config.setdefault('email_whitelist', [])
         config.setdefault('email_cooldown', 86400)  # 1 day
+        # xAI connection pool (see xai_client.py)
+        config.setdefault('xai_pool_max_connections', 20)
+        config.setdefault('xai_pool_max_keepalive', 10)
+        config.setdefault('xai_keepalive_expiry', 120.0)
+        config.setdefault('xai_keepwarm_interval', 50.0) # 0 disables the idle keep-warm ping
+        # Async server (grok_asgi.py): threads for provider SDKs that have no async API
+        config.setdefault('asgi_provider_threads', 32)
+        # Shared reply cache for repeated, non-personal questions (TTL in seconds per intent)
+        config.setdefault('reply_cache_enabled', True)
+        config['reply_cache_ttls'] = {'default': 3600, 'search': 600, 'news': 900, 'video': 86400, **config.get('reply_cache_ttls', {})}
+        # Weather cache: seconds a provider payload stays fresh (roughly each provider's update cadence),
+        # and how long past that it may still be served when the provider is erroring
+        config['weather_cache_ttls'] = {'met': 3600, 'openweather': 600, 'openmeteo': 900, **config.get('weather_cache_ttls', {})}
+        config.setdefault('weather_stale_grace', 1800)
+        # Geocode cache (Nominatim allows ~1 request/s; misses are throttled across workers via Redis)
+        config.setdefault('geocode_db_path', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geocode_cache.sqlite3'))
+        config.setdefault('geocode_ttl', 30 * 86400)
+        config.setdefault('geocode_negative_ttl', 86400) # "not found" answers
+        config.setdefault('geocode_min_interval', 1.1)
+        config.setdefault('geocode_max_wait', 5.0) # give up on a lookup rather than queue longer than this
+        # Met Office sitelist: local copy refreshed in the background, nearest-site fallback radius
+        config.setdefault('met_sitelist_path', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'met_sitelist.json'))
+        config.setdefault('met_sitelist_refresh', 86400)
+        config.setdefault('met_nearest_max_km', 50)
+        # Upstream base URLs, overridable to point the app at local stand-ins (bench_server.py)
+        config['provider_urls'] = {
+            'met': 'http://datapoint.metoffice.gov.uk',
+            'openweather': 'https://api.openweathermap.org',
+            'openmeteo': 'https://api.open-meteo.com',
+            'nominatim': 'https://nominatim.openstreetmap.org',
+            'youtube_oembed': 'https://www.youtube.com/oembed',
+            'youtube_api': 'https://youtube.googleapis.com',
+            'stability': 'https://api.stability.ai/v1',
+            **config.get('provider_urls', {}),
+        }
+        # Estimated input tokens allowed per /chat request, by intent; the oldest history is cut first
+        # Rolling history summary: once a session's raw history passes the threshold (estimated tokens), all but the
+        # newest history_summary_keep messages are folded into a stored summary, after the reply has been sent
+        config.setdefault('history_summary_enabled', False)
+        config.setdefault('history_summary_threshold', 1500)
+        config.setdefault('history_summary_keep', 6)
+        config.setdefault('history_summary_max_tokens', 250)
+        config.setdefault('history_summary_model', 'grok-3-mini')
+        config['prompt_token_budgets'] = {'default': 4000, 'search': 6000, 'news': 6000, 'video': 3000, **config.get('prompt_token_budgets', {})}
         missing = [f for f in required_fields if f not in config]
         if missing:
             logger.error(f"Missing config fields: {missing}")
@@ -111,12 +263,9 @@ def load_config():
         if not os.access(config['image_save_dir'], os.W_OK):
             logger.error(f"Image save dir {config['image_save_dir']} not writable")
             sys.exit(1)
-        # switch log file to config's path
-        for h in logger.handlers[:]:
-            if isinstance(h, logging.FileHandler):
-                logger.removeHandler(h)
-        logger.addHandler(logging.FileHandler(config['log_file']))
-        logger.info(f"Config loaded: {json.dumps({k: '****' if 'key' in k or 'pass' in k else v for k, v in config.items()}, indent=2)}")
+        configure_logging(config)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Config loaded: {json.dumps({k: '****' if 'key' in k or 'pass' in k else v for k, v in config.items()}, indent=2)}")
         # Warnings for providers without keys (skip openmeteo as no key needed)
         provider = config['weather_provider']
         if provider in ['met', 'openweather'] and not config.get(f"{provider}_api_key"):
@@ -143,191 +292,323 @@ def load_config():
         logger.debug(f"Stack trace: {traceback.format_exc()}"); sys.exit(1)
 logger.info("Loading configuration")
 config = load_config()
+boot_step('config')
 last_api_success = None
 # In-memory stores for history and rate limits (Redis for prod/multi-worker)
-redis_pool = redis.ConnectionPool(host='localhost', port=6379, db=0, decode_responses=True)
+# Built at import, before any fork: the pool connects lazily and, by redis-py's pid check, drops
+# connections inherited from the preloading master; register_script only hashes the Lua locally
+redis_pool = redis.ConnectionPool(host=config['redis_host'], port=config['redis_port'], db=config['redis_db'], decode_responses=True)
 redis_client = redis.Redis(connection_pool=redis_pool)
+metrics.configure(redis_client, config['metrics_flush_interval'])
+tracing.configure(config['trace_file'], config['trace_sample_rate'], config['trace_max_bytes'])
+@contextmanager
+def track(dependency: str):
+    """One upstream call: latency/error metrics plus a span in the request's trace."""
+    with tracing.span(dependency, kind='client'), metrics.track(dependency):
+        yield
 history_store = {} # fallback
 rate_limits = {} # fallback
 image_limits = {} # fallback
 email_limits = {} # fallback for email
-# Geocoder for weather
-geolocator = Nominatim(user_agent="grok_flask_api") # Free, rate-limited
-# Redis Functions
-def get_history(session_key: str) -> deque:
+# Geocoder for weather, built on the first lookup
+_geocoder = {'client': None}
+def get_geolocator():
+    if _geocoder['client'] is None:
+        from geopy.geocoders import Nominatim
+        scheme, _, domain = config['provider_urls']['nominatim'].partition('://')
+        _geocoder['client'] = Nominatim(user_agent="grok_flask_api", domain=domain, scheme=scheme) # Free, rate-limited
+    return _geocoder['client']
+def sanitize_text(text: str) -> str:
+    """Strip any HTML from user input."""
+    import bleach
+    return bleach.clean(text, tags=[], strip=True)
+def get_xai_client() -> OpenAI:
+    """Pooled xAI client for this worker (built after fork, reused across requests)."""
+    return get_client(config['xai_api_key'], config['api_base_url'], config)
+# ------------------------------------------------------------------------------
+# Turn scripts: one Redis round trip to start a /chat turn, one to commit it
+# ------------------------------------------------------------------------------
+# history:<session> is a capped list of JSON-encoded messages; older deployments kept the whole
+# deque as one JSON string, which this snippet converts in place (keeping its TTL) on first touch
+MIGRATE_HISTORY_LUA = """
+local function migrate_history(key, maxlen)
+    if redis.call('TYPE', key)['ok'] ~= 'string' then
+        return 0
+    end
+    local ok, turns = pcall(cjson.decode, redis.call('GET', key))
+    local ttl = redis.call('TTL', key)
+    redis.call('DEL', key)
+    if ok and type(turns) == 'table' then
+        for _, turn in ipairs(turns) do
+            redis.call('RPUSH', key, cjson.encode(turn))
+        end
+        redis.call('LTRIM', key, -maxlen, -1)
+        if ttl > 0 then
+            redis.call('EXPIRE', key, ttl)
+        end
+    end
+    return 1
+end
+"""
+# KEYS: ratelimit:<session>, history:<session>, emaillimit:<nick>, imagelimit:<nick>, summary:<session>
+# ARGV: now, rate_limit_seconds, history maxlen
+BEGIN_TURN_LUA = MIGRATE_HISTORY_LUA + """
+local last = redis.call('GET', KEYS[1])
+if last and tonumber(ARGV[1]) - tonumber(last) < tonumber(ARGV[2]) then
+    return {0}
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', math.max(1, math.ceil(tonumber(ARGV[2]))))
+migrate_history(KEYS[2], tonumber(ARGV[3]))
+return {1, redis.call('LRANGE', KEYS[2], -tonumber(ARGV[3]), -1), redis.call('GET', KEYS[3]), redis.call('GET', KEYS[4]),
+        redis.call('GET', KEYS[5])}
+"""
+# KEYS: history:<session>[, <limit prefix>:<key>]
+# ARGV: history maxlen, history ttl, limit timestamp, limit ttl, new message json...
+COMMIT_TURN_LUA = MIGRATE_HISTORY_LUA + """
+local maxlen = tonumber(ARGV[1])
+migrate_history(KEYS[1], maxlen)
+for i = 5, #ARGV do
+    redis.call('RPUSH', KEYS[1], ARGV[i])
+end
+redis.call('LTRIM', KEYS[1], -maxlen, -1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+if KEYS[2] then
+    redis.call('SET', KEYS[2], ARGV[3], 'EX', math.max(1, math.ceil(tonumber(ARGV[4]))))
+end
+return 1
+"""
+# KEYS: history:<session>; ARGV: history maxlen
+MIGRATE_HISTORY_KEY_LUA = MIGRATE_HISTORY_LUA + """
+return migrate_history(KEYS[1], tonumber(ARGV[1]))
+"""
+HISTORY_TTL = 86400
+begin_turn_script = redis_client.register_script(BEGIN_TURN_LUA)
+commit_turn_script = redis_client.register_script(COMMIT_TURN_LUA)
+migrate_history_script = redis_client.register_script(MIGRATE_HISTORY_KEY_LUA)
+limit_stores = {'ratelimit': rate_limits, 'emaillimit': email_limits, 'imagelimit': image_limits} # fallbacks by key prefix
+def history_maxlen() -> int:
+    return config['max_history_turns'] * 2
+def turn_keys(session_key: str, nick: str) -> list[str]:
+    return [f"ratelimit:{session_key}", f"history:{session_key}", f"emaillimit:{nick}", f"imagelimit:{nick}", f"summary:{session_key}"]
+def begin_turn_args(now: float) -> list:
+    return [now, config['rate_limit_seconds'], history_maxlen()]
+def parse_begin_turn(result: list) -> dict:
+    """BEGIN_TURN_LUA reply -> {'allowed', 'history', 'email_last', 'image_last', 'summary'}"""
+    maxlen = history_maxlen()
+    if not result[0]:
+        return {'allowed': False, 'history': deque(maxlen=maxlen), 'email_last': None, 'image_last': None, 'summary': None}
+    history_items, email_last, image_last, summary = (list(result[1:]) + [None] * 4)[:4]
+    return {
+        'allowed': True,
+        'history': deque((json.loads(item) for item in history_items or []), maxlen=maxlen),
+        'email_last': float(email_last) if email_last else None,
+        'image_last': float(image_last) if image_last else None,
+        'summary': summary or None,
+    }
+def begin_turn_fallback(session_key: str, nick: str, now: float) -> dict:
+    last = rate_limits.get(session_key)
+    if last is not None and now - last < config['rate_limit_seconds']:
+        return {'allowed': False, 'history': deque(maxlen=history_maxlen()), 'email_last': None, 'image_last': None, 'summary': None}
+    rate_limits[session_key] = now
+    return {
+        'allowed': True,
+        'history': history_store.get(session_key, deque(maxlen=history_maxlen())),
+        'email_last': email_limits.get(nick),
+        'image_last': image_limits.get(nick),
+        'summary': None, # summaries live in Redis only
+    }
+def begin_turn(session_key: str, nick: str, now: float) -> dict:
+    """Atomically check-and-set the rate limit and load history plus email/image cooldowns."""
     try:
-        history_data = redis_client.get(f"history:{session_key}")
-        history = deque(json.loads(history_data), maxlen=config['max_history_turns'] * 2) if history_data else deque(maxlen=config['max_history_turns'] * 2)
-        logger.debug(f"Retrieved history for {session_key}: {list(history)} (Redis key: history:{session_key})")
-        return history
+        with track('redis'):
+            turn = parse_begin_turn(begin_turn_script(keys=turn_keys(session_key, nick), args=begin_turn_args(now)))
+        logger.debug(f"Began turn for {session_key}: allowed={turn['allowed']}, history length {len(turn['history'])}")
+        return turn
     except redis.RedisError as e:
-        logger.warning(f"Redis unavailable for get_history {session_key}: {str(e)}, using in-memory")
-        history = history_store.get(session_key, deque(maxlen=config['max_history_turns'] * 2))
-        logger.debug(f"In-memory history for {session_key}: {list(history)}")
-        return history
-def save_history(session_key: str, history: deque) -> None:
+        logger.warning(f"Redis unavailable for begin_turn {session_key}: {str(e)}, using in-memory")
+        return begin_turn_fallback(session_key, nick, now)
+def commit_turn_args(session_key: str, history: deque, limit: tuple | None) -> tuple[list, list]:
+    """Keys/args for COMMIT_TURN_LUA: only the exchange just appended to history is sent."""
+    keys, args = [f"history:{session_key}"], [history_maxlen(), HISTORY_TTL, '', '']
+    if limit:
+        prefix, key, cooldown, timestamp = limit
+        keys.append(f"{prefix}:{key}")
+        args[2:4] = [timestamp, cooldown]
+    args += [json.dumps(turn) for turn in list(history)[-2:]]
+    return keys, args
+def commit_turn(session_key: str, history: deque, message: str, reply: str, limit: tuple | None = None) -> None:
+    """Append the exchange and push it, plus an optional (prefix, key, cooldown, timestamp) limit, atomically."""
+    history.append({"role": "user", "content": message})
+    history.append({"role": "assistant", "content": reply})
     try:
-        with redis_client.pipeline() as pipe:
-            pipe.multi()
-            pipe.set(f"history:{session_key}", json.dumps(list(history)))
-            pipe.expire(f"history:{session_key}", 86400)
-            pipe.execute()
-        logger.debug(f"Saved history for {session_key}, length: {len(history)}")
+        with track('redis'):
+            commit_turn_script(*commit_turn_args(session_key, history, limit))
+        logger.debug(f"Committed turn for {session_key}, length: {len(history)}")
+        schedule_history_summary(session_key, history)
     except redis.RedisError as e:
-        logger.warning(f"Redis unavailable for save_history {session_key}: {str(e)}, using in-memory")
+        logger.warning(f"Redis unavailable for commit_turn {session_key}: {str(e)}, using in-memory")
         history_store[session_key] = history
-def update_rate_limit(session_key: str, timestamp: float) -> None:
+        if limit:
+            limit_stores[limit[0]][limit[1]] = limit[3]
+def migrate_history_blobs() -> int:
+    """One-off conversion of every JSON-string history key to the list layout; returns keys converted."""
+    converted = 0
+    for key in redis_client.scan_iter(match='history:*', count=500):
+        converted += migrate_history_script(keys=[key], args=[history_maxlen()])
+    logger.info(f"Migrated {converted} history keys to capped lists")
+    return converted
+# ------------------------------------------------------------------------------
+# History summaries: old turns folded into one stored summary, off the request path
+# ------------------------------------------------------------------------------
+# KEYS: history:<session>, summary:<session>
+# ARGV: summary, messages summarized, first summarized message json, ttl
+# Only trims if the list still starts where the summarizer read it (a concurrent compaction or
+# "clear my context" wins); the summary and the trim land together or not at all
+COMPACT_HISTORY_LUA = """
+if redis.call('LINDEX', KEYS[1], 0) ~= ARGV[3] then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], tonumber(ARGV[2]), -1)
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[4])
+return 1
+"""
+SUMMARY_PROMPT = (
+    "Summarize this IRC conversation between a user and Grok so it can replace the transcript as context. "
+    "Fold in the previous summary if there is one. Keep names, facts, preferences, decisions and open questions; "
+    "drop pleasantries, links and long quoted text. Plain sentences, at most {words} words."
+)
+compact_history_script = redis_client.register_script(COMPACT_HISTORY_LUA)
+_summary_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='history-summary')
+def schedule_history_summary(session_key: str, history: deque) -> None:
+    """Queue a compaction once the committed history has grown past history_summary_threshold."""
+    if not config['history_summary_enabled'] or len(history) <= config['history_summary_keep']:
+        return
+    if estimator.messages(history) <= config['history_summary_threshold']:
+        return
+    _summary_pool.submit(summarize_history, session_key)
+def summary_message(summary: str | None) -> list:
+    return [{"role": "system", "content": f"Summary of the earlier conversation: {summary}"}] if summary else []
+def summarize_history(session_key: str) -> bool:
+    """Fold all but the newest history_summary_keep messages into summary:<session>."""
+    lock_key = f"summarylock:{session_key}"
     try:
-        redis_client.setex(f"ratelimit:{session_key}", config['rate_limit_seconds'], str(timestamp))
+        if not redis_client.set(lock_key, 1, nx=True, ex=120):
+            return False # another worker is already on it
+        items = redis_client.lrange(f"history:{session_key}", 0, -1)
+        previous = redis_client.get(f"summary:{session_key}")
     except redis.RedisError as e:
-        logger.warning(f"Redis unavailable for rate_limit {session_key}: {str(e)}, using in-memory")
-        rate_limits[session_key] = timestamp
-def check_rate_limit(session_key: str) -> bool:
+        logger.warning(f"Redis unavailable for history summary {session_key}: {str(e)}")
+        return False
     try:
-        last_time = redis_client.get(f"ratelimit:{session_key}")
-        if last_time and (time.time() - float(last_time)) < config['rate_limit_seconds']:
+        older = items[:-config['history_summary_keep']] if config['history_summary_keep'] else items
+        if not older:
             return False
-        return True
-    except redis.RedisError as e:
-        logger.warning(f"Redis unavailable for check_rate_limit {session_key}: {str(e)}, using in-memory")
-        last_time = rate_limits.get(session_key)
-        return last_time is None or (time.time() - last_time) >= config['rate_limit_seconds']
-def update_image_limit(image_key: str, timestamp: float) -> None:
-    try:
-        redis_client.setex(f"imagelimit:{image_key}", config['image_cooldown'], str(timestamp))
-    except redis.RedisError as e:
-        logger.warning(f"Redis unavailable for image_limit {image_key}: {str(e)}, using in-memory")
-        image_limits[image_key] = timestamp
-def check_image_limit(image_key: str) -> bool:
-    try:
-        last_time = redis_client.get(f"imagelimit:{image_key}")
-        if last_time and (time.time() - float(last_time)) < config['image_cooldown']:
+        transcript = '\n'.join(f"{m['role']}: {m['content'][:2000]}" for m in map(json.loads, older))
+        start = time.time()
+        with track('xai'):
+            response = get_xai_client().chat.completions.create(
+                model=config['history_summary_model'],
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT.format(words=int(config['history_summary_max_tokens'] * 0.7))},
+                    {"role": "user", "content": (f"Previous summary: {previous}\n\n" if previous else '') + f"Transcript:\n{transcript}"},
+                ],
+                temperature=0.2,
+                max_tokens=config['history_summary_max_tokens'],
+                timeout=config['api_timeout'],
+            )
+        metrics.tokens(response.usage)
+        summary = (response.choices[0].message.content or '').strip()
+        if not summary:
             return False
-        return True
-    except redis.RedisError as e:
-        logger.warning(f"Redis unavailable for check_image_limit {image_key}: {str(e)}, using in-memory")
-        last_time = image_limits.get(image_key)
-        return last_time is None or (time.time() - last_time) >= config['image_cooldown']
-# Email limit functions
-def update_email_limit(email_key: str, timestamp: float) -> None:
+        done = compact_history_script(keys=[f"history:{session_key}", f"summary:{session_key}"], args=[summary, len(older), older[0], HISTORY_TTL])
+        logger.info(f"Summarized {len(older)} history messages for {session_key} in {time.time() - start:.2f}s"
+                    f"{'' if done else ' (history changed meanwhile, discarded)'}")
+        return bool(done)
+    except Exception as e:
+        logger.warning(f"History summary failed for {session_key}: {type(e).__name__}: {str(e)}")
+        return False
+    finally:
+        try:
+            redis_client.delete(lock_key)
+        except redis.RedisError:
+            pass
+# ------------------------------------------------------------------------------
+# Reply cache (Redis, shared by every worker/node) for repeated, non-personal questions
+# ------------------------------------------------------------------------------
+# Words that tie a question to the asker or to earlier turns ("my", "it", "again"...) - never cached
+_CONTEXTUAL_RE = re.compile(r"\b(?:i|i'm|i've|i'd|me|my|mine|myself|we|our|us|it|its|that|this|those|these|he|she|him|her|his|hers|they|them|their|again|more|else|previous|earlier|above|same)\b", re.IGNORECASE)
+# Prompt/model settings are part of the key so a config change never serves stale-styled replies
+_reply_cache_version = hashlib.sha256(f"{config['system_prompt']}|{config['max_tokens']}|{config['temperature']}".encode()).hexdigest()[:12]
+def normalize_cache_text(message: str) -> str:
+    m = re.sub(r"\s+", " ", (message or "").lower()).strip()
+    return re.sub(r"[?.!,;:\s]+$", "", m)
+def reply_cache_key(message: str, intents: dict, search_params: dict) -> str | None:
+    """Key from the normalized message, intent flags and search mode; None if the turn mustn't be cached."""
+    if not config['reply_cache_enabled'] or intents['time']:
+        return None
+    normalized = normalize_cache_text(message)
+    if len(normalized) < 4 or _CONTEXTUAL_RE.search(normalized):
+        return None
+    flags = ','.join(sorted(k for k, v in intents.items() if v))
+    mode = search_params.get('mode', 'off')
+    digest = hashlib.sha256(f"{_reply_cache_version}|{normalized}|{flags}|{mode}".encode()).hexdigest()
+    return f"replycache:{digest}"
+def reply_cache_ttl(intents: dict) -> int:
+    ttls = config['reply_cache_ttls']
+    for name in ('news', 'video', 'search'):
+        if intents.get(name):
+            return int(ttls.get(name, ttls['default']))
+    return int(ttls['default'])
+def reply_cache_get(key: str) -> str | None:
+    reply = None
     try:
-        redis_client.setex(f"emaillimit:{email_key}", config['email_cooldown'], str(timestamp))
+        with track('redis'):
+            reply = redis_client.get(key)
     except redis.RedisError as e:
-        logger.warning(f"Redis unavailable for email_limit {email_key}: {str(e)}, using in-memory")
-        email_limits[email_key] = timestamp
-def check_email_limit(email_key: str) -> bool:
+        logger.warning(f"Redis unavailable for reply cache: {str(e)}")
+    metrics.cache_lookup('reply', reply is not None)
+    return reply
+def reply_cache_put(key: str, reply: str, intents: dict) -> None:
     try:
-        last_time = redis_client.get(f"emaillimit:{email_key}")
-        if last_time and (time.time() - float(last_time)) < config['email_cooldown']:
-            return False
-        return True
+        with track('redis'):
+            redis_client.setex(key, reply_cache_ttl(intents), reply)
     except redis.RedisError as e:
-        logger.warning(f"Redis unavailable for check_email_limit {email_key}: {str(e)}, using in-memory")
-        last_time = email_limits.get(email_key)
-        return last_time is None or (time.time() - last_time) >= config['email_cooldown']
+        logger.warning(f"Redis unavailable for reply cache store: {str(e)}")
+def reply_cache_stats() -> dict:
+    values = metrics.snapshot()
+    lookups = int(metrics.counter_value('grok_cache_lookups_total', {'cache': 'reply'}, values))
+    hits = int(metrics.counter_value('grok_cache_hits_total', {'cache': 'reply'}, values))
+    return {'lookups': lookups, 'hits': hits, 'misses': lookups - hits, 'hit_ratio': round(hits / lookups, 3) if lookups else 0.0}
 # ------------------------------------------------------------------------------
 # Flask
 # ------------------------------------------------------------------------------
-logger.info("Initializing Flask app")
-app = Flask(__name__)
-app.secret_key = os.urandom(24)
-app.start_time = time.time()
+# Routes live on a blueprint; create_app() (end of file) builds the Flask app around it
+bp = Blueprint('grok', __name__)
 # Static file serving for images
-@app.route('/generate/<path:filename>')
+@bp.route('/generate/<path:filename>')
 def serve_image(filename):
     return send_from_directory(config['image_save_dir'], filename)
+@bp.before_app_request
+def reset_debug_sampling():
+    log_debug.set(log_debug_default) # a sync worker thread serves many requests; /chat re-samples its own
+@bp.after_app_request
+def record_chat_metrics(response):
+    if 'chat_start' in g: # streamed replies are timed to the first byte, not the end of the stream
+        record_chat_request(g.get('chat_branch', 'generic'), response.status_code, time.time() - g.chat_start)
+        if g.get('chat_streamed'): # stream_chat_reply finishes the trace when the body ends
+            trace = tracing.current()
+        else:
+            trace = tracing.finish(status=response.status_code)
+        if trace:
+            response.headers['X-Request-ID'] = trace.request_id
+    return response
 logger.info(f"Python version: {sys.version}")
 logger.info(f"Flask version: {flask.__version__}")
 logger.info(f"OpenAI version: {openai.__version__}")
 logger.info(f"Gunicorn command: {' '.join(sys.argv)}")
-logger.info(f"Environment: {json.dumps(dict(os.environ), indent=2)}")
 if not config['xai_api_key']:
     logger.error("XAI_API_KEY not provided in config or environment"); sys.exit(1)
 # ------------------------------------------------------------------------------
-# Time intent detection
-# ------------------------------------------------------------------------------
-TIME_PATTERNS = [
-    r"\bwhat(?:'s|\s+is)?\s+(?:the\s+)?time\b", # what's the time
-    r"\bwhat(?:'s|\s+is)?\s+(?:the\s+)?time\s+(?:in|for)\s+.+", # what's the time in/for X
-    r"\b(?:current|local)\s+time\b", # current time / local time
-    r"\btime\s+(?:right\s+)?now\b", # time now / time right now
-    r"^\s*now\??\s*$", # "now?"
-    r"\bwhat(?:'s|\s+is)?\s+(?:the\s+)?date\b", # what's the date
-    r"\btoday'?s?\s+date\b", # today's date
-    r"\bdate\s+today\b", # date today
-    r"\bwhat\s+day\s+is\s+it\b", # what day is it
-    r"\bday\s+of\s+week\b", # day of week
-    r"\byesterday\b", # yesterday
-    r"\btime\s+(?:in|for)\s+.+", # time in/for X
-]
-def has_time_intent(msg: str) -> bool:
-    m = (msg or "").strip().lower()
-    return any(re.search(p, m, re.IGNORECASE) for p in TIME_PATTERNS)
-# Weather intent detection
-WEATHER_PATTERNS = [
-    r"\bweather\b", r"\bforecast\b", r"\btemperature\b", r"\brain\b",
-    r"\bsnow(?:ing)?\b",
-    r"\bwhat(?:'s|\s+is)?\s+(?:the\s+)?weather\b",
-    r"\bweather\s+(?:in|for)\s+.+",
-]
-
-def has_weather_intent(msg: str) -> bool:
-    m = (msg or "").strip().lower()
-    matches = [re.search(p, m, re.IGNORECASE) for p in WEATHER_PATTERNS]
-    if any(matches):
-        # Optional: Add extra check for "snow" to require context (e.g., location or time)
-        if re.search(r"\bsnow(?:ing)?\b", m, re.IGNORECASE):
-            if not re.search(r"\b(in|for|today|tomorrow|now|outside)\b", m, re.IGNORECASE):
-                return False  # Skip if "snow" lacks weather context
-        return True
-    return False
-# Image intent detection
-IMAGE_INTENT_PATTERNS = [
-    r"\b(generate|create|draw|make)\s+(?:an?\s+)?image\b",
-    r"\bimage\s+of\s+(?!my|your|his|her|our|their|this|that\b)",
-    r"\bpicture\s+of\s+(?!my|your|his|her|our|their|this|that\b)",
-    r"\bgenerate\s+(?:art|illustration|photo|graphic)\b",
-    r"\bdraw\s+me\b",
-]
-def has_image_intent(msg: str) -> bool:
-    m = (msg or "").strip().lower()
-    return any(re.search(p, m, re.IGNORECASE) for p in IMAGE_INTENT_PATTERNS)
-# Video/YouTube intent detection
-VIDEO_INTENT_PATTERNS = [
-    r"\byoutube\s+link\b",
-    r"\bvideo\s+(?:of|for|to)\b",
-    r"\blink\s+to\s+(?:youtube|video)\b",
-    r"\b(?:give|find|share|play|watch)\s+(?:me\s+)?a\s+(?:youtube|video)\s+link\b",
-    r"\bsong\s+(?:video|link)\b",
-    r"\bmusic\s+video\b",
-    r"\bfunny\s+video\b"
-]
-def has_video_intent(msg: str) -> bool:
-    m = (msg or "").strip().lower()
-    return any(re.search(p, m, re.IGNORECASE) for p in VIDEO_INTENT_PATTERNS)
-# Email intent detection
-EMAIL_PATTERNS = [
-    r"\bsend\s+(?:an?\s+)?email\b",
-    r"\bping\s+.+@.+\b",
-    r"\bcontact\s+ceo\b"
-]
-def has_email_intent(msg: str) -> bool:
-    m = (msg or "").strip().lower()
-    return any(re.search(p, m, re.IGNORECASE) for p in EMAIL_PATTERNS)
-# News intent detection
-NEWS_PATTERNS = [
-    r"\bnews\b",
-    r"\b(give|tell|what's|what is) (?:me )?(?:the )?news\b",
-    r"\bnews (?:for|in|about) (.+)\b",
-    r"\bheadlines\b",
-    r"\btop stories\b",
-    r"\bcurrent events\b",
-    r"\bbreaking news\b"
-]
-def has_news_intent(msg: str) -> bool:
-    m = (msg or "").strip().lower()
-    return any(re.search(p, m, re.IGNORECASE) for p in NEWS_PATTERNS)
-# ------------------------------------------------------------------------------
 # Response text normalizer (fix odd contractions/phrasing)
 # ------------------------------------------------------------------------------
 _CONTRACTION_FIXES = [
@@ -348,31 +629,6 @@ def normalize_reply_text(text: str) -> str:
         place = m.group(1).strip()
         out = _START_THEYVE_CHECKED.sub(f"In {place}, ", out, count=1)
     return out
-
-def chunked_reply(text: str, max_line_len: int = 380) -> list[str]:
-    """Chunk text into IRC-safe lines: preserve newlines, wrap long lines on spaces, ensure first chunk is single unbroken line."""
-    if not text:
-        return [text]
-    # Split on natural newlines first
-    paragraphs = text.split('\n')
-    chunks = []
-    for para in paragraphs:
-        para = para.rstrip()  # Trim trailing spaces
-        if not para:
-            continue
-        # If para is already short, keep as-is (allows newlines)
-        if len(para) <= max_line_len:
-            chunks.append(para)
-        else:
-            # Wrap long para on spaces to avoid mid-word splits
-            wrapped = textwrap.wrap(para, width=max_line_len, break_long_words=False, replace_whitespace=False)
-            chunks.extend(wrapped)
-    # Ensure first chunk is a "single line" (no internal wraps if possible, but under limit)
-    if len(chunks) > 0 and len(chunks[0]) > max_line_len:
-        # Rare case; force wrap first para if oversized
-        first_para = chunks[0]
-        chunks[0] = textwrap.wrap(first_para, width=max_line_len, break_long_words=False, replace_whitespace=False)[0]
-    return chunks
 # ------------------------------------------------------------------------------
 # local time for common cities (offline)
 # ------------------------------------------------------------------------------
@@ -397,30 +653,6 @@ CITY_TZ = {
     "rio": "America/Sao_Paulo", "são paulo": "America/Sao_Paulo", "sao paulo": "America/Sao_Paulo",
     "buenos aires": "America/Argentina/Buenos_Aires",
 }
-_LOC_RE = re.compile(r"\b(?:time|weather)\s+(?:in|for)\s+([^,]+(?:,\s*[a-zA-Z]+)?)(?=\s*(tomorrow|today|yesterday|$))", re.IGNORECASE)
-# News location extraction
-_LOC_NEWS_RE = re.compile(r"\b(?:give me the )?news\s+(?:for\s+(?:the\s+)?|in\s+)?(.+?)(?:\s+please)?\b", re.IGNORECASE)
-def extract_news_location(q: str) -> str | None:
-    """Pull 'X' out of phrases like 'news for/in X'."""
-    m = _LOC_NEWS_RE.search(q or "")
-    if not m:
-        return None
-    loc = m.group(1).strip().lower()
-    loc = re.sub(r"[?.!,;:\s]+$", "", loc)
-    # Map common names to standard
-    loc_map = {
-        'uk': 'UK', 'united kingdom': 'UK', 'britain': 'UK', 'great britain': 'UK',
-        'us': 'US', 'usa': 'US', 'united states': 'US', 'america': 'US'
-    }
-    return loc_map.get(loc, loc.title()) if loc else None
-def _extract_location(q: str) -> str | None:
-    """Pull 'X' out of phrases like 'time/weather in X' or 'for X'."""
-    m = _LOC_RE.search(q or "")
-    if not m:
-        return None
-    loc = m.group(1).strip().lower()
-    loc = re.sub(r"[?.!,;:\s]+$", "", loc)
-    return loc if loc else None
 def _local_time_string(now_utc: datetime, tz_name: str, city_label: str) -> str:
     try:
         if ZoneInfo is None:
@@ -431,234 +663,624 @@ def _local_time_string(now_utc: datetime, tz_name: str, city_label: str) -> str:
         return local.strftime(f"It’s %I:%M %p {abbr} on %A, %B %d, %Y in {city_label}.")
     except ValueError:
         return now_utc.strftime(f"It’s %I:%M %p UTC on %A, %B %d, %Y (timezone error).")
-# Weather fetch functions
-def fetch_weather_met(location: str) -> str:
+# ------------------------------------------------------------------------------
+# Geocoding cache (SQLite on disk, mirrored into Redis, Nominatim throttled across workers)
+# ------------------------------------------------------------------------------
+_geocode_local = threading.local() # one SQLite connection per thread
+_geocode_throttle_lock = threading.Lock()
+_geocode_last_call = [0.0] # fallback throttle when Redis is down (per process)
+def normalize_place(name: str) -> str:
+    """'  Glasgow ,UK? ' -> 'glasgow, uk'"""
+    name = re.sub(r"\s*,\s*", ", ", re.sub(r"\s+", " ", (name or "").lower()))
+    return name.strip(" ,.?!;:")
+def _geocode_db() -> sqlite3.Connection:
+    conn = getattr(_geocode_local, 'conn', None)
+    if conn is None or getattr(_geocode_local, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(config['geocode_db_path'], timeout=5.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS geocode (name TEXT PRIMARY KEY, lat REAL, lon REAL, display_name TEXT, found INTEGER NOT NULL, updated REAL NOT NULL)")
+        _geocode_local.conn, _geocode_local.pid = conn, os.getpid()
+    return conn
+def _geocode_ttl(entry: dict) -> int:
+    return int(config['geocode_ttl'] if entry['found'] else config['geocode_negative_ttl'])
+def _geocode_cache_get(name: str) -> dict | None:
+    try:
+        cached = redis_client.get(f"geocode:{name}")
+        if cached:
+            return json.loads(cached)
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for geocode cache: {str(e)}")
+    try:
+        row = _geocode_db().execute("SELECT lat, lon, display_name, found, updated FROM geocode WHERE name = ?", (name,)).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Geocode store read failed: {str(e)}")
+        return None
+    if not row:
+        return None
+    entry = {'lat': row[0], 'lon': row[1], 'display_name': row[2], 'found': bool(row[3]), 'updated': row[4]}
+    remaining = _geocode_ttl(entry) - (time.time() - entry['updated'])
+    if remaining <= 0:
+        return None
+    try:
+        redis_client.setex(f"geocode:{name}", int(remaining) + 1, json.dumps(entry)) # re-warm Redis from disk
+    except redis.RedisError:
+        pass
+    return entry
+def _geocode_cache_put(name: str, entry: dict) -> None:
+    try:
+        with _geocode_db() as conn:
+            conn.execute("INSERT OR REPLACE INTO geocode (name, lat, lon, display_name, found, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                         (name, entry['lat'], entry['lon'], entry['display_name'], int(entry['found']), entry['updated']))
+    except sqlite3.Error as e:
+        logger.warning(f"Geocode store write failed: {str(e)}")
+    try:
+        redis_client.setex(f"geocode:{name}", _geocode_ttl(entry), json.dumps(entry))
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for geocode cache store: {str(e)}")
+def _geocode_slot() -> bool:
+    """Wait for this worker's turn at Nominatim (one call per geocode_min_interval across all workers)."""
+    interval_ms = int(float(config['geocode_min_interval']) * 1000)
+    deadline = time.monotonic() + float(config['geocode_max_wait'])
+    while True:
+        try:
+            if redis_client.set('geocode:throttle', os.getpid(), px=interval_ms, nx=True):
+                return True
+            wait = max(redis_client.pttl('geocode:throttle'), 10) / 1000
+        except redis.RedisError:
+            with _geocode_throttle_lock:
+                wait = _geocode_last_call[0] + interval_ms / 1000 - time.monotonic()
+                if wait <= 0:
+                    _geocode_last_call[0] = time.monotonic()
+                    return True
+        if time.monotonic() + wait > deadline:
+            return False
+        time.sleep(wait)
+def geocode_place(name: str) -> dict | None:
+    """Cached geolocator.geocode(): {'lat', 'lon', 'display_name'} or None when the place isn't known."""
+    key = normalize_place(name)
+    if not key:
+        return None
+    entry = _geocode_cache_get(key)
+    metrics.cache_lookup('geocode', entry is not None)
+    if entry is None:
+        if not _geocode_slot():
+            logger.warning(f"Geocode throttle wait exceeded for {key}; skipping lookup")
+            return None
+        from geopy.exc import GeopyError
+        try:
+            with track('nominatim'):
+                loc = get_geolocator().geocode(key, timeout=10)
+        except GeopyError as e:
+            logger.error(f"Geocode failed for {key}: {type(e).__name__}: {str(e)}")
+            return None # errors aren't cached, only real "not found" answers
+        entry = {'lat': loc.latitude, 'lon': loc.longitude, 'display_name': loc.address, 'found': True} if loc else \
+                {'lat': None, 'lon': None, 'display_name': None, 'found': False}
+        entry['updated'] = time.time()
+        _geocode_cache_put(key, entry)
+        logger.info(f"Geocoded {key}: {entry['display_name'] or 'not found'}")
+    return entry if entry['found'] else None
+# ------------------------------------------------------------------------------
+# Met Office site list (refreshed in the background, indexed by name and position)
+# ------------------------------------------------------------------------------
+class MetSiteIndex:
+    """In-memory lookup over the DataPoint sitelist: exact name, name prefix, trigram substring, nearest site."""
+    GRID = 0.5 # degrees per spatial bucket
+    def __init__(self, sites: list[dict]):
+        self.sites = [{'id': str(s['id']), 'name': s['name'], 'lat': float(s['latitude']), 'lon': float(s['longitude'])} for s in sites]
+        self.names = [s['name'].lower() for s in self.sites]
+        self.exact = {}
+        self.trigrams = {}
+        self.grid = {}
+        for i, (site, name) in enumerate(zip(self.sites, self.names)):
+            self.exact.setdefault(name, i)
+            for j in range(len(name) - 2):
+                self.trigrams.setdefault(name[j:j + 3], set()).add(i)
+            self.grid.setdefault(self._cell(site['lat'], site['lon']), []).append(i)
+        self.sorted_names = sorted((name, i) for i, name in enumerate(self.names))
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return int(math.floor(lat / self.GRID)), int(math.floor(lon / self.GRID))
+    def find(self, query: str) -> dict | None:
+        """Exact name, else the first site whose name starts with, else contains, the query."""
+        q = (query or "").strip().lower()
+        if not q:
+            return None
+        if q in self.exact:
+            return self.sites[self.exact[q]]
+        start = bisect.bisect_left(self.sorted_names, (q, -1))
+        prefixed = [i for name, i in itertools.takewhile(lambda item: item[0].startswith(q), self.sorted_names[start:])]
+        if prefixed:
+            return self.sites[min(prefixed)]
+        if len(q) < 3:
+            return None
+        candidates = set.intersection(*(self.trigrams.get(q[j:j + 3], set()) for j in range(len(q) - 2)))
+        matches = [i for i in candidates if q in self.names[i]]
+        return self.sites[min(matches)] if matches else None
+    def nearest(self, lat: float, lon: float, max_km: float) -> dict | None:
+        """Closest site within max_km, checking only the grid cells that radius can reach."""
+        row, col = self._cell(lat, lon)
+        cell_km = 111.0 * self.GRID
+        rows = int(max_km / cell_km) + 1
+        cols = int(max_km / (cell_km * max(math.cos(math.radians(lat)), 0.01))) + 1
+        best, best_km = None, max_km
+        for r in range(row - rows, row + rows + 1):
+            for c in range(col - cols, col + cols + 1):
+                for i in self.grid.get((r, c), ()):
+                    km = _haversine_km(lat, lon, self.sites[i]['lat'], self.sites[i]['lon'])
+                    if km <= best_km:
+                        best, best_km = self.sites[i], km
+        return best
+def _haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 12742.0 * math.asin(math.sqrt(a))
+met_sites = {'index': None, 'mtime': 0.0, 'pid': None} # per worker
+_met_sites_lock = threading.Lock()
+def _download_met_sitelist() -> bool:
+    """Fetch the sitelist and replace the local copy atomically; one worker at a time via a Redis lock."""
+    try:
+        if not redis_client.set('metsites:refresh', os.getpid(), ex=120, nx=True):
+            return False # another worker is already downloading
+    except redis.RedisError:
+        pass
     try:
         api_key = config['met_api_key']
-        # Get sites
-        sites_url = f"http://datapoint.metoffice.gov.uk/public/data/val/wxfcs/all/json/sitelist?key={api_key}"
-        sites_resp = requests.get(sites_url, timeout=10)
+        sites_url = f"{config['provider_urls']['met']}/public/data/val/wxfcs/all/json/sitelist?key={api_key}"
+        with track('met'):
+            sites_resp = requests.get(sites_url, timeout=30)
         sites_resp.raise_for_status()
         sites = sites_resp.json()['Locations']['Location']
-        # Find matching site (simple name match; improve with geocode if needed)
-        site = next((s for s in sites if location.lower() in s['name'].lower()), None)
-        if not site:
-            return None
-        site_id = site['id']
-        forecast_url = f"http://datapoint.metoffice.gov.uk/public/data/val/wxfcs/all/json/{site_id}?res=3hourly&key={api_key}"
-        forecast_resp = requests.get(forecast_url, timeout=10)
-        forecast_resp.raise_for_status()
-        data = forecast_resp.json()['SiteRep']['DV']['Location']['Period'][0]['Rep'][0]
-        temp = data['T']
-        weather_code = data['W'] # Map to text
-        # Expanded mapping from MET Office codes
-        condition_map = {
-            "NA": "Not available",
-            "-1": "Trace rain",
-            "0": "Clear night",
-            "1": "Sunny day",
-            "2": "Partly cloudy (night)",
-            "3": "Partly cloudy (day)",
-            "4": "Not used",
-            "5": "Mist",
-            "6": "Fog",
-            "7": "Cloudy",
-            "8": "Overcast",
-            "9": "Light rain shower (night)",
-            "10": "Light rain shower (day)",
-            "11": "Drizzle",
-            "12": "Light rain",
-            "13": "Heavy rain shower (night)",
-            "14": "Heavy rain shower (day)",
-            "15": "Heavy rain",
-            "16": "Sleet shower (night)",
-            "17": "Sleet shower (day)",
-            "18": "Sleet",
-            "19": "Hail shower (night)",
-            "20": "Hail shower (day)",
-            "21": "Hail",
-            "22": "Light snow shower (night)",
-            "23": "Light snow shower (day)",
-            "24": "Light snow",
-            "25": "Heavy snow shower (night)",
-            "26": "Heavy snow shower (day)",
-            "27": "Heavy snow",
-            "28": "Thunder shower (night)",
-            "29": "Thunder shower (day)",
-            "30": "Thunder"
-        }
-        condition = condition_map.get(weather_code, 'Unknown')
-        return f"Weather in {location.title()}: {temp}°C, {condition}."
-    except requests.RequestException as e:
-        logger.error(f"MET fetch failed: {str(e)}")
-        return None
-    except KeyError as e:
-        logger.error(f"MET data parse failed: {str(e)}")
+        path = config['met_sitelist_path']
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(sites, f)
+        os.replace(tmp_path, path)
+        logger.info(f"Met Office sitelist refreshed: {len(sites)} sites saved to {path}")
+        return True
+    except (requests.RequestException, KeyError, ValueError, OSError) as e:
+        logger.error(f"Met Office sitelist refresh failed: {type(e).__name__}: {str(e)}")
+        return False
+def _load_met_sitelist() -> None:
+    """(Re)build this worker's index when the local copy on disk is newer than the one loaded."""
+    path = config['met_sitelist_path']
+    try:
+        mtime = os.path.getmtime(path)
+        if mtime <= met_sites['mtime']:
+            return
+        with open(path) as f:
+            index = MetSiteIndex(json.load(f))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.error(f"Met Office sitelist load failed: {type(e).__name__}: {str(e)}")
+        return
+    met_sites['index'], met_sites['mtime'] = index, mtime
+    logger.info(f"Met Office site index loaded: {len(index.sites)} sites")
+def _met_sitelist_age() -> float:
+    try:
+        return time.time() - os.path.getmtime(config['met_sitelist_path'])
+    except OSError:
+        return float('inf')
+def _met_sitelist_loop() -> None:
+    interval = float(config['met_sitelist_refresh'])
+    while True:
+        if _met_sitelist_age() >= interval:
+            _download_met_sitelist()
+        _load_met_sitelist()
+        time.sleep(min(interval, 600) + random.uniform(0, 30)) # jitter so workers don't wake together
+def get_met_site_index() -> MetSiteIndex | None:
+    """This worker's site index; loads (or first downloads) it and starts the refresh thread on first use."""
+    if met_sites['pid'] != os.getpid():
+        with _met_sites_lock:
+            if met_sites['pid'] != os.getpid():
+                met_sites.update({'index': None, 'mtime': 0.0, 'pid': os.getpid()})
+                if _met_sitelist_age() == float('inf'):
+                    _download_met_sitelist()
+                _load_met_sitelist()
+                threading.Thread(target=_met_sitelist_loop, name='met-sitelist', daemon=True).start()
+    return met_sites['index']
+def find_met_site(location: str) -> dict | None:
+    index = get_met_site_index()
+    if index is None:
         return None
-def fetch_weather_openweather(location: str) -> str:
+    site = index.find(location)
+    if site is None:
+        place = geocode_place(location) # not a site name: take the nearest site to the geocoded place
+        if place:
+            site = index.nearest(place['lat'], place['lon'], float(config['met_nearest_max_km']))
+            if site:
+                logger.debug(f"Met Office nearest site to {location}: {site['name']}")
+    return site
+# ------------------------------------------------------------------------------
+# Weather (providers normalized to one payload, cached per provider + coordinates)
+# ------------------------------------------------------------------------------
+MET_CONDITIONS = {
+    "NA": "Not available",
+    "-1": "Trace rain",
+    "0": "Clear night",
+    "1": "Sunny day",
+    "2": "Partly cloudy (night)",
+    "3": "Partly cloudy (day)",
+    "4": "Not used",
+    "5": "Mist",
+    "6": "Fog",
+    "7": "Cloudy",
+    "8": "Overcast",
+    "9": "Light rain shower (night)",
+    "10": "Light rain shower (day)",
+    "11": "Drizzle",
+    "12": "Light rain",
+    "13": "Heavy rain shower (night)",
+    "14": "Heavy rain shower (day)",
+    "15": "Heavy rain",
+    "16": "Sleet shower (night)",
+    "17": "Sleet shower (day)",
+    "18": "Sleet",
+    "19": "Hail shower (night)",
+    "20": "Hail shower (day)",
+    "21": "Hail",
+    "22": "Light snow shower (night)",
+    "23": "Light snow shower (day)",
+    "24": "Light snow",
+    "25": "Heavy snow shower (night)",
+    "26": "Heavy snow shower (day)",
+    "27": "Heavy snow",
+    "28": "Thunder shower (night)",
+    "29": "Thunder shower (day)",
+    "30": "Thunder"
+}
+# WMO weather code mapping (from Open-Meteo docs)
+WMO_CONDITIONS = {
+    0: "Clear sky",
+    1: "Mainly clear",
+    2: "Partly cloudy",
+    3: "Overcast",
+    45: "Fog",
+    48: "Depositing rime fog",
+    51: "Light drizzle",
+    53: "Moderate drizzle",
+    55: "Dense drizzle",
+    56: "Light freezing drizzle",
+    57: "Dense freezing drizzle",
+    61: "Slight rain",
+    63: "Moderate rain",
+    65: "Heavy rain",
+    66: "Light freezing rain",
+    67: "Heavy freezing rain",
+    71: "Slight snow fall",
+    73: "Moderate snow fall",
+    75: "Heavy snow fall",
+    77: "Snow grains",
+    80: "Slight rain showers",
+    81: "Moderate rain showers",
+    82: "Violent rain showers",
+    85: "Slight snow showers",
+    86: "Heavy snow showers",
+    95: "Thunderstorm",
+    96: "Thunderstorm with slight hail",
+    99: "Thunderstorm with heavy hail"
+}
+weather_cache = {} # fallback: cache key -> (payload, expires), oldest first
+WEATHER_CACHE_MAX = 1000 # fallback entries kept; places beyond that push out the oldest
+weather_cache_lock = threading.Lock()
+def resolve_weather_location(location: str, provider: str) -> dict | None:
+    """Place name -> {'lat', 'lon'} (plus 'site_id' for the Met Office), None if unknown."""
     try:
-        loc = geolocator.geocode(location)
-        if not loc:
-            return None
-        lat, lon = loc.latitude, loc.longitude
-        api_key = config['openweather_api_key']
-        # Current weather
-        url = f"https://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}&units=metric"
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        # Expanded details
-        temp = data['main']['temp']
-        condition = data['weather'][0]['description']
-        humidity = data['main']['humidity']
-        wind_speed = data['wind']['speed']
-        pressure = data['main']['pressure']
-        visibility = data['visibility'] / 1000 # km
-        # Optional: Add 5-day forecast summary (next call; free tier ok)
-        forecast_url = f"https://api.openweathermap.org/data/2.5/forecast?lat={lat}&lon={lon}&appid={api_key}&units=metric"
-        forecast_resp = requests.get(forecast_url, timeout=10)
-        forecast_resp.raise_for_status()
-        forecast_data = forecast_resp.json()
-        # Simple next-day forecast
-        next_day = forecast_data['list'][8] # ~24h ahead (adjust index as needed)
-        next_temp = next_day['main']['temp']
-        next_condition = next_day['weather'][0]['description']
-        return f"Weather in {location.title()}: {temp}°C, {condition}. Humidity: {humidity}%, Wind: {wind_speed} m/s, Pressure: {pressure} hPa, Visibility: {visibility} km. Tomorrow: {next_temp}°C, {next_condition}."
+        if provider == 'met':
+            site = find_met_site(location)
+            return {'lat': site['lat'], 'lon': site['lon'], 'site_id': site['id']} if site else None
+        place = geocode_place(location)
+        return {'lat': place['lat'], 'lon': place['lon']} if place else None
     except requests.RequestException as e:
-        logger.error(f"OpenWeather fetch failed: {str(e)}")
+        logger.error(f"Weather location lookup failed for {location} ({provider}): {type(e).__name__}: {str(e)}")
         return None
-    except KeyError as e:
-        logger.error(f"OpenWeather parse failed: {str(e)}")
+    except (KeyError, ValueError) as e:
+        logger.error(f"Weather location parse failed for {location} ({provider}): {str(e)}")
         return None
-# Open-Meteo fetch (no key needed)
-from datetime import date, timedelta # Add if not already imported
-def fetch_weather_openmeteo(location: str) -> str:
+def fetch_weather_met(place: dict) -> dict:
+    api_key = config['met_api_key']
+    forecast_url = f"{config['provider_urls']['met']}/public/data/val/wxfcs/all/json/{place['site_id']}?res=3hourly&key={api_key}"
+    forecast_resp = requests.get(forecast_url, timeout=10)
+    forecast_resp.raise_for_status()
+    periods = forecast_resp.json()['SiteRep']['DV']['Location']['Period']
+    if isinstance(periods, dict): # a single period isn't wrapped in a list
+        periods = [periods]
+    now = periods[0]['Rep'][0]
+    daily = []
+    for period in periods:
+        reps = period['Rep'] if isinstance(period['Rep'], list) else [period['Rep']]
+        temps = [float(r['T']) for r in reps]
+        midday = next((r for r in reps if r.get('$') == '720'), reps[len(reps) // 2])
+        daily.append({'date': period['value'][:10], 'temp_max': max(temps), 'temp_min': min(temps),
+                      'condition': MET_CONDITIONS.get(midday['W'], 'Unknown')})
+    return {'current': {'temp': now['T'], 'condition': MET_CONDITIONS.get(now['W'], 'Unknown')}, 'daily': daily}
+def fetch_weather_openweather(place: dict) -> dict:
+    lat, lon = place['lat'], place['lon']
+    api_key = config['openweather_api_key']
+    # Current weather
+    url = f"{config['provider_urls']['openweather']}/data/2.5/weather?lat={lat}&lon={lon}&appid={api_key}&units=metric"
+    resp = requests.get(url, timeout=10)
+    resp.raise_for_status()
+    data = resp.json()
+    # 5-day / 3-hour forecast (free tier ok)
+    forecast_url = f"{config['provider_urls']['openweather']}/data/2.5/forecast?lat={lat}&lon={lon}&appid={api_key}&units=metric"
+    forecast_resp = requests.get(forecast_url, timeout=10)
+    forecast_resp.raise_for_status()
+    entries = forecast_resp.json()['list']
+    days = {}
+    for entry in entries:
+        days.setdefault(entry['dt_txt'][:10], []).append(entry)
+    daily = []
+    for day, items in days.items():
+        temps = [e['main']['temp'] for e in items]
+        midday = next((e for e in items if e['dt_txt'][11:13] == '12'), items[len(items) // 2])
+        daily.append({'date': day, 'temp_max': max(temps), 'temp_min': min(temps), 'condition': midday['weather'][0]['description']})
+    next_day = entries[8] # ~24h ahead
+    return {
+        'current': {
+            'temp': data['main']['temp'],
+            'condition': data['weather'][0]['description'],
+            'humidity': data['main']['humidity'],
+            'wind': f"{data['wind']['speed']} m/s",
+            'pressure': data['main']['pressure'],
+            'visibility': data['visibility'] / 1000, # km
+        },
+        'next_day': {'temp': next_day['main']['temp'], 'condition': next_day['weather'][0]['description']},
+        'daily': daily,
+    }
+def fetch_weather_openmeteo(place: dict) -> dict:
+    lat, lon = place['lat'], place['lon']
+    # Current weather + details (add daily params for 7 days)
+    url = f"{config['provider_urls']['openmeteo']}/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,apparent_temperature,is_day,precipitation,rain,showers,snowfall,weather_code,cloud_cover,pressure_msl,surface_pressure,wind_speed_10m,wind_direction_10m,wind_gusts_10m&daily=temperature_2m_max,temperature_2m_min,weather_code&forecast_days=8"
+    resp = requests.get(url, timeout=10)
+    resp.raise_for_status()
+    json_data = resp.json()
+    current = json_data['current']
+    daily_data = json_data['daily']
+    daily = [{'date': day, 'temp_max': daily_data['temperature_2m_max'][i], 'temp_min': daily_data['temperature_2m_min'][i],
+              'condition': WMO_CONDITIONS.get(daily_data['weather_code'][i], 'Unknown')}
+             for i, day in enumerate(daily_data['time'])]
+    return {
+        'current': {
+            'temp': current['temperature_2m'],
+            'condition': WMO_CONDITIONS.get(current['weather_code'], 'Unknown'),
+            'humidity': current['relative_humidity_2m'],
+            'wind': f"{current['wind_speed_10m']} km/h",
+            'pressure': current['pressure_msl'],
+        },
+        'daily': daily,
+    }
+WEATHER_FETCHERS = {'met': fetch_weather_met, 'openweather': fetch_weather_openweather, 'openmeteo': fetch_weather_openmeteo}
+def weather_cache_key(provider: str, place: dict) -> str:
+    # ~1km grid, so "glasgow" and "glasgow, uk" share an entry
+    return f"weather:{provider}:{place['lat']:.2f},{place['lon']:.2f}"
+def weather_cache_get(key: str) -> dict | None:
     try:
-        loc = geolocator.geocode(location)
-        if not loc:
-            return None
-        lat, lon = loc.latitude, loc.longitude
-        # Current weather + details (add daily params for 7 days)
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current=temperature_2m,relative_humidity_2m,apparent_temperature,is_day,precipitation,rain,showers,snowfall,weather_code,cloud_cover,pressure_msl,surface_pressure,wind_speed_10m,wind_direction_10m,wind_gusts_10m&daily=temperature_2m_max,temperature_2m_min,weather_code&forecast_days=8"
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-        json_data = resp.json()
-        current = json_data['current']
-        temp = current['temperature_2m']
-        condition_code = current['weather_code']
-        # WMO weather code mapping (from Open-Meteo docs)
-        condition_map = {
-            0: "Clear sky",
-            1: "Mainly clear",
-            2: "Partly cloudy",
-            3: "Overcast",
-            45: "Fog",
-            48: "Depositing rime fog",
-            51: "Light drizzle",
-            53: "Moderate drizzle",
-            55: "Dense drizzle",
-            56: "Light freezing drizzle",
-            57: "Dense freezing drizzle",
-            61: "Slight rain",
-            63: "Moderate rain",
-            65: "Heavy rain",
-            66: "Light freezing rain",
-            67: "Heavy freezing rain",
-            71: "Slight snow fall",
-            73: "Moderate snow fall",
-            75: "Heavy snow fall",
-            77: "Snow grains",
-            80: "Slight rain showers",
-            81: "Moderate rain showers",
-            82: "Violent rain showers",
-            85: "Slight snow showers",
-            86: "Heavy snow showers",
-            95: "Thunderstorm",
-            96: "Thunderstorm with slight hail",
-            99: "Thunderstorm with heavy hail"
-        }
-        condition = condition_map.get(condition_code, 'Unknown')
-        humidity = current['relative_humidity_2m']
-        wind_speed = current['wind_speed_10m']
-        pressure = current['pressure_msl']
-        # 7-day forecast (days 1 to 7, skipping today [0])
-        daily_data = json_data['daily']
-        forecast = []
-        today = date.today() # Use current date for labels
-        for day in range(1, 8):
-            day_date = (today + timedelta(days=day)).strftime("%b %d")
-            avg_temp = (daily_data['temperature_2m_max'][day] + daily_data['temperature_2m_min'][day]) / 2
-            day_code = daily_data['weather_code'][day]
-            day_condition = condition_map.get(day_code, 'Unknown')
-            forecast.append(f"{day_date}: ~{avg_temp:.1f}°C, {day_condition}.")
-        forecast_str = "\n".join(forecast)
-        return f"Weather in {location.title()}: {temp}°C, {condition}. Humidity: {humidity}%, Wind: {wind_speed} km/h, Pressure: {pressure} hPa.\n7-Day Forecast:\n{forecast_str}"
-    except requests.RequestException as e:
-        logger.error(f"Open-Meteo fetch failed: {str(e)}")
+        payload = redis_client.get(key)
+        return json.loads(payload) if payload else None
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for weather cache: {str(e)}")
+        with weather_cache_lock:
+            payload, expires = weather_cache.get(key, (None, 0))
+            if expires <= time.time():
+                weather_cache.pop(key, None)
+                return None
+            return payload
+def weather_cache_put(key: str, payload: dict, provider: str) -> None:
+    # Kept past its TTL for the stale grace period; freshness is judged from fetched_at
+    expiry = int(config['weather_cache_ttls'].get(provider, 900)) + int(config['weather_stale_grace'])
+    try:
+        redis_client.setex(key, expiry, json.dumps(payload))
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for weather cache store: {str(e)}")
+        now = time.time()
+        with weather_cache_lock:
+            weather_cache.pop(key, None)
+            if len(weather_cache) >= WEATHER_CACHE_MAX:
+                for stale in [k for k, (_, expires) in weather_cache.items() if expires <= now]:
+                    del weather_cache[stale]
+            while len(weather_cache) >= WEATHER_CACHE_MAX:
+                weather_cache.pop(next(iter(weather_cache)))
+            weather_cache[key] = (payload, now + expiry)
+def get_weather_payload(location: str, provider: str) -> dict | None:
+    """Normalized provider payload for a place, fresh from cache, refetched, or stale within the grace period."""
+    place = resolve_weather_location(location, provider)
+    if not place:
         return None
-    except KeyError as e:
-        logger.error(f"Open-Meteo parse failed: {str(e)}")
+    key = weather_cache_key(provider, place)
+    cached = weather_cache_get(key)
+    ttl = int(config['weather_cache_ttls'].get(provider, 900))
+    age = time.time() - cached['fetched_at'] if cached else None
+    metrics.cache_lookup('weather', bool(cached and age < ttl))
+    if cached and age < ttl:
+        logger.debug(f"Weather cache hit for {key} (age: {age:.0f}s)")
+        return cached
+    try:
+        with track(provider):
+            payload = WEATHER_FETCHERS[provider](place)
+    except (requests.RequestException, KeyError, IndexError, TypeError, ValueError) as e:
+        logger.error(f"{provider} weather fetch failed: {type(e).__name__}: {str(e)}")
+        if cached and age < ttl + config['weather_stale_grace']:
+            logger.warning(f"Serving stale weather for {key} (age: {age:.0f}s)")
+            return cached
         return None
-  
-def get_weather(message: str, session_id: str) -> str | None:
-    loc = _extract_location(message) or "Falkirk" # Default
+    payload.update({'provider': provider, 'lat': place['lat'], 'lon': place['lon'], 'fetched_at': time.time()})
+    weather_cache_put(key, payload, provider)
+    return payload
+def format_weather(payload: dict, label: str, span: str | None = None) -> str:
+    """Reply for 'now' (span None, the provider's usual reply), 'tomorrow' or 'week' from one payload."""
+    current, daily = payload['current'], payload.get('daily', [])
+    line = f"Weather in {label}: {current['temp']}°C, {current['condition']}."
+    details = [f"{name}: {current[key]}{unit}" for name, key, unit in
+               (('Humidity', 'humidity', '%'), ('Wind', 'wind', ''), ('Pressure', 'pressure', ' hPa'), ('Visibility', 'visibility', ' km'))
+               if key in current]
+    if details:
+        line += f" {', '.join(details)}."
+    if span == 'tomorrow' and len(daily) > 1:
+        day = daily[1]
+        return f"Weather in {label} tomorrow ({datetime.strptime(day['date'], '%Y-%m-%d').strftime('%b %d')}): {day['temp_min']}-{day['temp_max']}°C, {day['condition']}."
+    if span == 'week' or (span is None and payload['provider'] == 'openmeteo'):
+        forecast = [f"{datetime.strptime(day['date'], '%Y-%m-%d').strftime('%b %d')}: ~{(day['temp_max'] + day['temp_min']) / 2:.1f}°C, {day['condition']}."
+                    for day in daily[1:8]]
+        if forecast:
+            return f"{line}\n{len(forecast)}-Day Forecast:\n" + "\n".join(forecast)
+    if 'next_day' in payload:
+        line += f" Tomorrow: {payload['next_day']['temp']}°C, {payload['next_day']['condition']}."
+    return line
+def get_weather(location: str | None, session_id: str, span: str | None = None) -> str | None:
+    loc = location or "Falkirk" # Default
     provider = config['weather_provider']
-    if provider == 'none':
+    if provider not in WEATHER_FETCHERS:
         return None
-    reply = None
-    if provider == 'met':
-        reply = fetch_weather_met(loc)
-    elif provider == 'openweather':
-        reply = fetch_weather_openweather(loc)
-    elif provider == 'openmeteo':
-        reply = fetch_weather_openmeteo(loc)
-    if reply:
-        logger.info(f"Weather fetched via {provider} for {loc} (session: {session_id})")
-        return reply
+    payload = get_weather_payload(loc, provider)
+    if not payload:
+        return None
+    logger.info(f"Weather via {provider} for {loc}, span {span or 'now'} (session: {session_id})")
+    return format_weather(payload, loc.title(), span)
+# YouTube link validation using oEmbed (no API key needed), cached per video ID across workers
+_YOUTUBE_ID_RE = re.compile(r"(?:[?&]v=|youtu\.be/)([\w-]{6,})")
+youtube_valid_cache = {} # fallback: video id -> (valid, expires), oldest first
+YOUTUBE_VALID_CACHE_MAX = 5000 # fallback verdicts kept; videos beyond that push out the oldest
+youtube_valid_cache_lock = threading.Lock()
+_validate_pool = {'pool': None, 'pid': None}
+def youtube_video_id(url: str) -> str | None:
+    m = _YOUTUBE_ID_RE.search(url or "")
+    return m.group(1) if m else None
+def youtube_valid_ttl(valid: bool) -> int:
+    return int(config['youtube_valid_ttl'] if valid else config['youtube_invalid_ttl'])
+def youtube_valid_cache_get(keys: list[str]) -> dict:
+    """Fallback verdicts ('1'/'0') still fresh for these video ids, for when Redis is unavailable."""
+    now = time.time()
+    cached = {}
+    with youtube_valid_cache_lock:
+        for key in keys:
+            valid, expires = youtube_valid_cache.get(key, (None, 0))
+            if expires <= now:
+                youtube_valid_cache.pop(key, None)
+            else:
+                cached[key] = '1' if valid else '0'
+    return cached
+def youtube_valid_cache_put(key: str, valid: bool) -> None:
+    now = time.time()
+    with youtube_valid_cache_lock:
+        youtube_valid_cache.pop(key, None)
+        if len(youtube_valid_cache) >= YOUTUBE_VALID_CACHE_MAX:
+            for stale in [k for k, (_, expires) in youtube_valid_cache.items() if expires <= now]:
+                del youtube_valid_cache[stale]
+        while len(youtube_valid_cache) >= YOUTUBE_VALID_CACHE_MAX:
+            youtube_valid_cache.pop(next(iter(youtube_valid_cache)))
+        youtube_valid_cache[key] = (valid, now + youtube_valid_ttl(valid))
+def oembed_verdict(status: int, data: dict | None) -> bool | None:
+    """True/False for a definite oEmbed answer, None for a transient failure that mustn't be cached."""
+    if status == 200:
+        return bool(data) and 'html' in data and 'title' in data
+    if status in (400, 401, 403, 404):
+        return False # removed, private or not embeddable
     return None
-# YouTube link validation using oEmbed (no API key needed)
-def validate_youtube_link(url: str) -> bool:
+def _check_youtube_link(url: str) -> bool | None:
     try:
-        oembed_url = f"https://www.youtube.com/oembed?url={url}&format=json"
-        resp = requests.get(oembed_url, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
-        return 'html' in data and 'title' in data
-    except Exception as e:
+        with track('youtube'):
+            resp = requests.get(config['provider_urls']['youtube_oembed'], params={'url': url, 'format': 'json'}, timeout=10)
+        return oembed_verdict(resp.status_code, resp.json() if resp.status_code == 200 else None)
+    except (requests.RequestException, ValueError) as e:
         logger.error(f"YouTube validation failed for {url}: {str(e)}")
+        return None
+def validate_youtube_links(urls: list[str]) -> bool:
+    """True if every link is a live video; cached verdicts first, the rest checked concurrently."""
+    by_id = {}
+    for url in urls:
+        by_id.setdefault(youtube_video_id(url) or url, url) # one check per video, however it's linked
+    keys = list(by_id)
+    try:
+        cached = dict(zip(keys, redis_client.mget([f"ytvalid:{key}" for key in keys]))) if keys else {}
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for YouTube validity cache: {str(e)}")
+        cached = youtube_valid_cache_get(keys)
+    for key in keys:
+        metrics.cache_lookup('youtube', cached.get(key) in ('0', '1'))
+    if '0' in cached.values():
         return False
+    pending = [key for key in keys if cached.get(key) != '1']
+    if not pending:
+        return True
+    if _validate_pool['pid'] != os.getpid():
+        _validate_pool.update({'pool': ThreadPoolExecutor(max_workers=4, thread_name_prefix='oembed'), 'pid': os.getpid()})
+    verdicts = list(_validate_pool['pool'].map(tracing.wrap(_check_youtube_link), [by_id[key] for key in pending]))
+    for key, valid in zip(pending, verdicts):
+        if valid is None:
+            continue
+        try:
+            redis_client.setex(f"ytvalid:{key}", youtube_valid_ttl(valid), '1' if valid else '0')
+        except redis.RedisError:
+            youtube_valid_cache_put(key, valid)
+    return all(verdicts)
+def validate_youtube_link(url: str) -> bool:
+    return validate_youtube_links([url])
+# YouTube Data API: discovery document parsed once per process, one service object per worker thread
+_youtube_discovery = {'doc': None}
+_youtube_local = threading.local()
+def _youtube_discovery_doc() -> dict:
+    """youtube v3 discovery document: the copy bundled with google-api-python-client, else fetched once and saved."""
+    if _youtube_discovery['doc'] is None:
+        from googleapiclient.discovery_cache import get_static_doc
+        content = get_static_doc('youtube', 'v3')
+        path = config['youtube_discovery_path']
+        if content is None and os.path.exists(path):
+            with open(path) as f:
+                content = f.read()
+        if content is None:
+            resp = requests.get(f"{config['provider_urls']['youtube_api']}/$discovery/rest?version=v3", timeout=10)
+            resp.raise_for_status()
+            content = resp.text
+            with open(path, 'w') as f:
+                f.write(content)
+        _youtube_discovery['doc'] = json.loads(content)
+    return _youtube_discovery['doc']
+def get_youtube_service(api_key: str):
+    """This thread's YouTube client, reusing its keep-alive HTTP connection between searches."""
+    service = getattr(_youtube_local, 'service', None)
+    if service is None or _youtube_local.key != (api_key, os.getpid()):
+        import httplib2
+        from googleapiclient.discovery import build_from_document
+        # httplib2.Http isn't thread-safe, so each thread gets its own transport
+        service = build_from_document(_youtube_discovery_doc(), developerKey=api_key, http=httplib2.Http(timeout=10),
+                                      client_options={'api_endpoint': config['provider_urls']['youtube_api']})
+        _youtube_local.service, _youtube_local.key = service, (api_key, os.getpid())
+        logger.info(f"Built YouTube service (pid: {os.getpid()}, thread: {threading.current_thread().name})")
+    return service
+def youtube_execute(request):
+    with track('youtube'):
+        return request.execute()
 # Fetch YouTube video link using API
 def fetch_youtube_video_link(query: str, max_results: int = 1) -> dict | None:
     api_key = config.get('youtube_api_key')
     if not api_key:
         logger.warning("No YouTube API key; cannot fetch video link.")
         return None
+    from googleapiclient.errors import HttpError
     try:
-        youtube = build('youtube', 'v3', developerKey=api_key)
+        youtube = get_youtube_service(api_key)
         # Check if it's a "latest" query
         latest_match = re.search(r"latest\s+(.+?)\s+(song|video)", query, re.IGNORECASE)
         if latest_match:
             artist = latest_match.group(1).strip()
             # Search for official channel
-            channel_search = youtube.search().list(
+            channel_search = youtube_execute(youtube.search().list(
                 part='snippet',
                 q=artist + " official channel",
                 type='channel',
                 maxResults=1
-            ).execute()
+            ))
             channels = channel_search.get('items', [])
             if not channels:
                 logger.warning(f"No official channel found for artist: {artist}")
                 return None
             channel_id = channels[0]['id']['channelId']
             # Search for latest video in the channel
-            video_search = youtube.search().list(
+            video_search = youtube_execute(youtube.search().list(
                 part='snippet',
                 channelId=channel_id,
                 type='video',
                 order='date',
                 maxResults=1
-            ).execute()
+            ))
             videos = video_search.get('items', [])
             if not videos:
                 return None
@@ -670,13 +1292,13 @@ def fetch_youtube_video_link(query: str, max_results: int = 1) -> dict | None:
             return {'url': url, 'title': title}
         else:
             # Original logic for non-latest queries
-            search_response = youtube.search().list(
+            search_response = youtube_execute(youtube.search().list(
                 part='snippet',
                 q=query + " ",
                 type='video',
                 maxResults=max_results,
                 order='date'
-            ).execute()
+            ))
             items = search_response.get('items', [])
             if not items:
                 return None
@@ -716,7 +1338,7 @@ def send_email(to: str, subject: str, body: str, photo_path: str = None, session
             with open(photo_path, 'rb') as f:
                 img_data = f.read()
                 msg.add_attachment(img_data, maintype='image', subtype='jpeg', filename=os.path.basename(photo_path))
-        with smtplib.SMTP(config['smtp_server'], config['smtp_port']) as s:
+        with track('smtp'), smtplib.SMTP(config['smtp_server'], config['smtp_port']) as s:
             s.starttls()
             s.login(config['smtp_user'], config['smtp_pass'])
             s.send_message(msg)
@@ -725,62 +1347,130 @@ def send_email(to: str, subject: str, body: str, photo_path: str = None, session
     except Exception as e:
         logger.error(f"Email send failed (to: {to}, session: {session_id}): {type(e).__name__}: {str(e)}")
         return "Failed to send email."
+# Image download: streamed to a temp file in image_save_dir in chunks (memory stays flat however large the
+# image), size-capped, named by the format its magic bytes show, renamed into place when complete
+IMAGE_CHUNK_BYTES = 64 * 1024
+IMAGE_SIGNATURES = ((b'\xff\xd8\xff', 'jpg'), (b'\x89PNG\r\n\x1a\n', 'png'), (b'GIF87a', 'gif'), (b'GIF89a', 'gif'))
+_image_http = {'session': None, 'pid': None}
+def image_http() -> requests.Session:
+    """Pooled session for image downloads, one per worker process."""
+    if _image_http['pid'] != os.getpid():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=max(4, int(config['image_job_workers'])))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _image_http.update({'session': session, 'pid': os.getpid()})
+    return _image_http['session']
+def sniff_image_format(head: bytes) -> str | None:
+    """File extension for the image format in the first bytes, None if it isn't an image we keep."""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return next((ext for magic, ext in IMAGE_SIGNATURES if head.startswith(magic)), None)
+def image_filename(digest: str, ext: str) -> str:
+    """Content-addressed name: the same bytes always land in the same file."""
+    return f"{config['image_filename_prefix']}_{digest[:32]}.{ext}"
+def save_image_stream(chunks) -> str:
+    """Write chunks to a hidden temp file, check size and format, rename into place under the SHA-256 of
+    the content (an identical image already stored is kept and the copy dropped); returns the filename."""
+    max_bytes = int(config['image_max_bytes'])
+    tmp_path = os.path.join(config['image_save_dir'], f".{uuid.uuid4().hex}.part")
+    try:
+        size, head, digest = 0, b'', hashlib.sha256()
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                if len(head) < 16:
+                    head = (head + chunk)[:16]
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"Image larger than {max_bytes} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+        ext = sniff_image_format(head)
+        if ext is None:
+            raise ValueError(f"Downloaded file is not an image (starts {head[:8]!r})")
+        filename = image_filename(digest.hexdigest(), ext)
+        path = os.path.join(config['image_save_dir'], filename)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            logger.debug(f"Image {filename} already stored, dropped the duplicate download")
+        else:
+            os.replace(tmp_path, path)
+            logger.debug(f"Saved {size} byte {ext} image as {filename}")
+        return filename
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+def download_image(url: str) -> str:
+    """Stream the provider's image to image_save_dir (3 tries for network errors); returns the filename."""
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            with track('image_download'), image_http().get(url, stream=True, timeout=30) as resp:
+                resp.raise_for_status()
+                length = int(resp.headers.get('Content-Length') or 0)
+                if length > int(config['image_max_bytes']):
+                    raise ValueError(f"Image larger than {config['image_max_bytes']} bytes ({length})")
+                return save_image_stream(resp.iter_content(IMAGE_CHUNK_BYTES))
+        except requests.RequestException:
+            if attempt == max_retries - 1:
+                raise
+            time.sleep(2) # Backoff
 # Image generation (updated for multiple providers)
-def generate_image(client: OpenAI, prompt: str, session_id: str) -> str:
-    """Generate image via selected provider, download & save locally, return local URL."""
-    # Add jailbreak keyword block
+def check_image_prompt(prompt: str) -> str:
+    """Refuse jailbreak attempts and cap the length; raises ValueError."""
     jailbreak_keywords = ['ignore', 'override', 'system', 'prompt', 'instructions', 'jailbreak', 'developer mode']
     if any(kw in prompt.lower() for kw in jailbreak_keywords):
         logger.warning(f"Jailbreak attempt detected in image prompt: {prompt}")
         raise ValueError("Invalid prompt detected.")
-    # Cap prompt length
-    prompt = prompt[:500]
+    return prompt[:500]
+def generate_image_file(client: OpenAI, prompt: str, session_id: str) -> str:
+    """Generate image via selected provider, download & save locally, return the filename in image_save_dir."""
+    prompt = check_image_prompt(prompt)
     provider = config['image_provider']
     try:
         api_start = time.time()
         if provider == 'stability':
             # Stability AI setup (using OpenAI client compatibility)
-            client = OpenAI(
-                base_url='https://api.stability.ai/v1',
-                api_key=config['stability_api_key']
-            )
-            response = client.images.generate(
-                model='stable-diffusion-3', # Or your preferred Stability model
-                prompt=prompt,
-                n=config['image_n'],
-                size=config['image_size'],
-                response_format='url', # Returns URL
-                timeout=config['api_timeout']
-            )
+            client = get_client(config['stability_api_key'], config['provider_urls']['stability'], config)
+            with track('stability'):
+                response = client.images.generate(
+                    model='stable-diffusion-3', # Or your preferred Stability model
+                    prompt=prompt,
+                    n=config['image_n'],
+                    size=config['image_size'],
+                    response_format='url', # Returns URL
+                    timeout=config['api_timeout']
+                )
             xai_url = response.data[0].url # Adjust if response format differs
             logger.info(f"Image generated from Stability AI (session: {session_id}): {xai_url}")
         elif provider == 'hf':
             # Hugging Face (using InferenceClient if not OpenAI-compatible)
             from huggingface_hub import InferenceClient
             hf_client = InferenceClient(model="stabilityai/stable-diffusion-xl-base-1.0", token=config['hf_api_key'])
-            image_bytes = hf_client.text_to_image(prompt, num_images_per_prompt=config['image_n'])
-            # Save bytes locally and generate URL (adapt download/save logic below)
-            # For simplicity, assume first image; save as file
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            safe_prompt = re.sub(r'[^a-z0-9\s]', '', prompt.lower())
-            safe_prompt = re.sub(r'\s+', '_', safe_prompt)[:50]
-            filename = f"{config['image_filename_prefix']}_{safe_prompt}_{timestamp}.jpg"
-            filepath = os.path.join(config['image_save_dir'], filename)
-            with open(filepath, 'wb') as f:
-                f.write(image_bytes)
-            local_url = f"{config['image_host_url']}/generate/{filename}"
-            logger.info(f"Image generated from Hugging Face and saved locally (session: {session_id}): {local_url}")
-            return local_url
+            with track('huggingface'):
+                image = hf_client.text_to_image(prompt, num_images_per_prompt=config['image_n'])
+            # The client returns a PIL image; encode it and save it the same way as a download
+            if not isinstance(image, bytes):
+                buffer = io.BytesIO()
+                image.save(buffer, format='PNG')
+                image = buffer.getvalue()
+            filename = save_image_stream([image])
+            logger.info(f"Image generated from Hugging Face and saved locally (session: {session_id}): {filename}")
+            return filename
         else:
             # Default xAI
-            response = client.images.generate(
-                model=config['image_model'], # Ensure config has "grok-2-image"
-                prompt=prompt,
-                n=config['image_n'],
-                response_format='url', # Explicit for xAI (returns URL)
-                # NO size or quality - xAI doesn't support them
-                timeout=config['api_timeout']
-            )
+            with track('xai'):
+                response = client.images.generate(
+                    model=config['image_model'], # Ensure config has "grok-2-image"
+                    prompt=prompt,
+                    n=config['image_n'],
+                    response_format='url', # Explicit for xAI (returns URL)
+                    # NO size or quality - xAI doesn't support them
+                    timeout=config['api_timeout']
+                )
             xai_url = response.data[0].url
             logger.info(f"Image generated from xAI (session: {session_id}): {xai_url}")
         global last_api_success
@@ -789,37 +1479,380 @@ def generate_image(client: OpenAI, prompt: str, session_id: str) -> str:
         # Download and save locally (for xAI or Stability; skip if already saved for HF)
         if provider != 'hf':
             download_start = time.time()
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    img_response = requests.get(xai_url, timeout=30)
-                    img_response.raise_for_status()
-                    break
-                except Exception as e:
-                    if attempt == max_retries - 1:
-                        raise
-                    time.sleep(2) # Backoff
-            # Sanitize filename: lowercase, replace non-alnum with _, prefix, timestamp
-            safe_prompt = re.sub(r'[^a-z0-9\s]', '', prompt.lower())
-            safe_prompt = re.sub(r'\s+', '_', safe_prompt)[:50] # Truncate to 50 chars
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{config['image_filename_prefix']}_{safe_prompt}_{timestamp}.jpg" # JPG for xAI/Stability
-            filepath = os.path.join(config['image_save_dir'], filename)
-            with open(filepath, 'wb') as f:
-                f.write(img_response.content)
+            filename = download_image(xai_url)
             download_duration = time.time() - download_start
-            local_url = f"{config['image_host_url']}/generate/{filename}"
-            logger.info(f"Image saved locally (session: {session_id}, duration: {download_duration:.2f}s): {local_url}")
-        return local_url
+            logger.info(f"Image saved locally (session: {session_id}, duration: {download_duration:.2f}s): {filename}")
+        return filename
     except Exception as e:
         logger.error(f"Image generation failed with {provider}: {type(e).__name__}: {str(e)}")
         raise
+# Renditions: a smaller web copy for IRC links and a gallery thumbnail, made in a process pool (Pillow holds the GIL)
+_image_process_pool = {'pool': None, 'pid': None}
+def image_process_pool() -> ProcessPoolExecutor:
+    if _image_process_pool['pid'] != os.getpid():
+        _image_process_pool.update({'pool': ProcessPoolExecutor(max_workers=int(config['image_process_workers']), initializer=image_pipeline.watch_parent),
+                                      'pid': os.getpid()})
+    return _image_process_pool['pool']
+def make_renditions(filename: str) -> dict | None:
+    """Web copy and thumbnail of a saved image, {kind: {file, bytes, width, height}}; None if it couldn't be done."""
+    if config['image_process_workers'] <= 0:
+        return None
+    try:
+        with track('image_render'):
+            future = image_process_pool().submit(image_pipeline.render, config['image_save_dir'], filename, config['image_rendition_format'],
+                                                 int(config['image_web_max_px']), int(config['image_thumb_max_px']), int(config['image_rendition_quality']))
+            renditions = future.result(timeout=60)
+    except BrokenProcessPool as e:
+        logger.error(f"Image render pool broke on {filename}: {str(e)}, restarting it")
+        _image_process_pool['pid'] = None
+        return None
+    except Exception as e:
+        logger.error(f"Image renditions failed for {filename}: {type(e).__name__}: {str(e)}")
+        return None
+    for kind, rendition in renditions.items():
+        metrics.inc('grok_image_bytes_total', {'rendition': kind}, rendition['bytes'])
+    logger.info(f"Renditions of {filename}: " + ', '.join(f"{kind} {r['bytes']} bytes" for kind, r in renditions.items()))
+    return renditions
+# ------------------------------------------------------------------------------
+# Image store: files named by content hash, reference counted, indexed by normalized prompt
+# ------------------------------------------------------------------------------
+# image:<filename> holds the file's reference count (jobs linking to it) and its renditions, and
+# image:<filename>:jobs the ids of those jobs, so a reference dies with its job: the job reaper releases ids
+# whose imagejob:<id> has expired (image_job_ttl). images:referenced lists the files that have references.
+# imageprompt:<hash> points a normalized prompt (with provider, model and size) at the file it produced
+# for image_dedupe_window seconds, so a repeat is answered from disk without a paid generation
+IMAGE_FILES = 'images:referenced'
+# KEYS: image:<filename>, image:<filename>:jobs, images:referenced; ARGV: job id, filename
+# Returns the references held (this job's counted once), 0 if the file isn't in the store
+ACQUIRE_IMAGE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('SADD', KEYS[3], ARGV[2])
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], 'refs', 1)
+end
+return tonumber(redis.call('HGET', KEYS[1], 'refs'))
+"""
+# Same KEYS and ARGV; returns the references left, -1 if this job held none
+RELEASE_IMAGE_LUA = """
+if redis.call('SREM', KEYS[2], ARGV[1]) == 0 then
+    return -1
+end
+local refs = redis.call('HINCRBY', KEYS[1], 'refs', -1)
+if refs <= 0 then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    redis.call('SREM', KEYS[3], ARGV[2])
+end
+return refs
+"""
+acquire_image_script = redis_client.register_script(ACQUIRE_IMAGE_LUA)
+release_image_script = redis_client.register_script(RELEASE_IMAGE_LUA)
+def image_ref_keys(filename: str) -> list[str]:
+    return [f"image:{filename}", f"image:{filename}:jobs", IMAGE_FILES]
+def image_prompt_key(prompt: str) -> str:
+    basis = f"{config['image_provider'] or 'xai'}|{config['image_model']}|{config['image_size']}|{normalize_cache_text(prompt)}"
+    return f"imageprompt:{hashlib.sha256(basis.encode()).hexdigest()[:32]}"
+def find_prompt_image(prompt: str, job_id: str) -> dict | None:
+    """The image a recent identical prompt produced, with a reference taken on it for job_id; None on a miss."""
+    if config['image_dedupe_window'] <= 0:
+        return None
+    key = image_prompt_key(prompt)
+    try:
+        filename = redis_client.get(key)
+        hit = bool(filename) and acquire_image_script(keys=image_ref_keys(filename), args=[job_id, filename]) > 0
+        if hit and not os.path.exists(os.path.join(config['image_save_dir'], filename)): # removed behind our back
+            release_image_script(keys=image_ref_keys(filename), args=[job_id, filename])
+            hit = False
+        metrics.cache_lookup('image_prompt', hit)
+        if not hit:
+            if filename:
+                redis_client.delete(key)
+            return None
+        renditions = redis_client.hget(f"image:{filename}", 'renditions')
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for image prompt index: {str(e)}")
+        return None
+    return {'file': filename, 'renditions': json.loads(renditions) if renditions else {'original': {'file': filename}}}
+def store_image(filename: str, prompt: str, renditions: dict, job_id: str) -> None:
+    """Take job_id's reference on a newly generated file and index the prompt that produced it."""
+    try:
+        with redis_client.pipeline() as pipe:
+            pipe.hset(f"image:{filename}", mapping={'renditions': json.dumps(renditions), 'created': time.time()})
+            acquire_image_script(keys=image_ref_keys(filename), args=[job_id, filename], client=pipe)
+            if config['image_dedupe_window'] > 0:
+                pipe.setex(image_prompt_key(prompt), int(config['image_dedupe_window']), filename)
+            pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for image store, {filename} is not indexed: {str(e)}")
+def release_image(filename: str, job_id: str) -> int | None:
+    """Drop job_id's reference; with the last one the file and its renditions are deleted.
+    Returns the references left, None if the job held none or Redis is unavailable (nothing is deleted then)."""
+    try:
+        refs = release_image_script(keys=image_ref_keys(filename), args=[job_id, filename])
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for image release of {filename}: {str(e)}")
+        return None
+    if refs < 0:
+        return None
+    if refs == 0:
+        names = [filename] + [image_pipeline.rendition_name(filename, kind, fmt) for kind in ('web', 'thumb') for fmt in image_pipeline.EXTENSIONS]
+        for name in names:
+            try:
+                os.remove(os.path.join(config['image_save_dir'], name))
+            except FileNotFoundError:
+                pass
+        logger.info(f"Deleted image {filename}: no references left")
+    return refs
+def release_expired_image_refs() -> int:
+    """Release the references of jobs whose hash has expired (image_job_ttl); returns how many.
+    Without this a file outlived by its jobs would never be deleted. Raises redis.RedisError."""
+    released = 0
+    for filename in redis_client.smembers(IMAGE_FILES):
+        job_ids = list(redis_client.smembers(f"image:{filename}:jobs"))
+        if not job_ids:
+            redis_client.srem(IMAGE_FILES, filename) # hash gone without a release (evicted or flushed)
+            continue
+        with redis_client.pipeline(transaction=False) as pipe:
+            for job_id in job_ids:
+                pipe.exists(f"imagejob:{job_id}")
+            alive = pipe.execute()
+        for job_id, exists in zip(job_ids, alive):
+            if not exists and release_image(filename, job_id) is not None:
+                released += 1
+                logger.info(f"Released {filename} for expired image job {job_id}")
+    return released
+# ------------------------------------------------------------------------------
+# Image jobs: /generate-image and the chat image intent queue a job and answer straight away;
+# job threads (in each worker, or a `python3 grok.py --image-worker` process) generate and save it
+# ------------------------------------------------------------------------------
+# imagejob:<id> is a hash (status queued/running/done/failed, prompt, nick, image_url, error, times).
+# Ids wait on imagejobs:queue and move to imagejobs:processing while a thread works on them, so a job
+# whose process died mid-run is put back on the queue once image_job_timeout has passed
+IMAGE_JOB_QUEUE = 'imagejobs:queue'
+IMAGE_JOB_PROCESSING = 'imagejobs:processing'
+IMAGE_JOB_MAX_ATTEMPTS = 3
+IMAGE_JOB_FINISHED = ('done', 'failed', 'deleted')
+image_jobs = {} # fallback: job id -> job, run on this worker's threads
+_image_job_threads = {'pid': None, 'queue': None, 'reaped': 0.0} # per worker
+_image_job_lock = threading.Lock()
+def image_job_url(job_id: str) -> str:
+    """Link for IRC: redirects to the image once it's done, reports progress until then."""
+    return f"{config['image_host_url']}/image-jobs/{job_id}/image"
+def image_file_url(filename: str) -> str:
+    return f"{config['image_host_url']}/generate/{filename}"
+def parse_image_job(job: dict) -> dict:
+    """Redis hash (all strings) or fallback entry -> job with typed times and renditions."""
+    job = dict(job)
+    job['renditions'] = json.loads(job['renditions']) if job.get('renditions') else {}
+    for field in ('created', 'started', 'finished'):
+        job[field] = float(job[field]) if job.get(field) else None
+    job['attempts'] = int(job.get('attempts') or 0)
+    job['deduped'] = bool(int(job.get('deduped') or 0))
+    return job
+def image_job_view(job: dict) -> dict:
+    """What the status endpoint shows: no prompt/nick, just progress and the result."""
+    view = {k: job.get(k) for k in ('job_id', 'status', 'created', 'started', 'finished')}
+    if job['status'] == 'done':
+        view['image_url'] = job['image_url']
+        view['renditions'] = {kind: {**r, 'url': image_file_url(r['file'])} for kind, r in job['renditions'].items()}
+        view['deduped'] = job['deduped']
+    elif job['status'] == 'failed':
+        view['error'] = job.get('error', '')
+    elif job['status'] != 'deleted':
+        view['status_url'] = f"{config['image_host_url']}/image-jobs/{job['job_id']}"
+    return view
+def get_image_job(job_id: str) -> dict | None:
+    try:
+        job = redis_client.hgetall(f"imagejob:{job_id}")
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for image job {job_id}: {str(e)}, using in-memory")
+        job = None
+    job = job or image_jobs.get(job_id)
+    return parse_image_job(job) if job else None
+def update_image_job(job_id: str, **fields) -> None:
+    fields = {k: v for k, v in fields.items() if v is not None}
+    try:
+        with redis_client.pipeline() as pipe:
+            pipe.hset(f"imagejob:{job_id}", mapping=fields)
+            pipe.expire(f"imagejob:{job_id}", int(config['image_job_ttl']))
+            pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable updating image job {job_id}: {str(e)}, using in-memory")
+        image_jobs.setdefault(job_id, {'job_id': job_id}).update(fields)
+def enqueue_image_job(prompt: str, nick: str, session_id: str) -> dict:
+    """Queue a generation and return the job; the caller answers with its id/link without waiting."""
+    job = {'job_id': uuid.uuid4().hex, 'status': 'queued', 'prompt': check_image_prompt(prompt), 'nick': nick, 'session_id': session_id, 'created': time.time(), 'attempts': 0}
+    try:
+        with redis_client.pipeline() as pipe:
+            pipe.hset(f"imagejob:{job['job_id']}", mapping=job)
+            pipe.expire(f"imagejob:{job['job_id']}", int(config['image_job_ttl']))
+            pipe.lpush(IMAGE_JOB_QUEUE, job['job_id'])
+            pipe.execute()
+        if config['image_job_workers'] > 0:
+            start_image_job_threads(config['image_job_workers'])
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for image job queue: {str(e)}, running {job['job_id']} on this worker")
+        image_jobs[job['job_id']] = job
+        start_image_job_threads(max(1, config['image_job_workers']))
+        _image_job_threads['queue'].put(job['job_id'])
+    metrics.inc('grok_image_jobs_total', {'status': 'queued'})
+    logger.info(f"Image job {job['job_id']} queued for {nick} (session: {session_id})")
+    return job
+def wait_image_job(job_id: str, timeout: float) -> dict | None:
+    """Poll until the job finishes or timeout passes; for clients that still want the image inline."""
+    deadline = time.time() + timeout
+    while True:
+        job = get_image_job(job_id)
+        if job is None or job['status'] in IMAGE_JOB_FINISHED or time.time() >= deadline:
+            return job
+        time.sleep(0.5)
+def remove_image_job(job: dict) -> int | None:
+    """Mark a finished job deleted and drop its reference on the file (deleted along with the last one);
+    returns the references other jobs still hold, None if there was nothing to release. Raises redis.RedisError."""
+    if not redis_client.hsetnx(f"imagejob:{job['job_id']}", 'released', 1): # a concurrent delete got there first
+        return None
+    update_image_job(job['job_id'], status='deleted')
+    return release_image(job['image_file'], job['job_id']) if job.get('image_file') else None
+def run_image_job(job_id: str) -> None:
+    job = get_image_job(job_id)
+    if job is None or job['status'] in IMAGE_JOB_FINISHED: # expired, or finished by a thread presumed lost
+        _release_image_job(job_id)
+        return
+    started = time.time()
+    update_image_job(job_id, status='running', started=started, attempts=job['attempts'] + 1, worker=f"{os.uname().nodename}:{os.getpid()}")
+    try:
+        image = find_prompt_image(job['prompt'], job_id)
+        if image:
+            filename, renditions = image['file'], image['renditions']
+            logger.info(f"Image job {job_id}: same prompt as a recent image, reusing {filename}")
+        else:
+            filename = generate_image_file(get_xai_client(), job['prompt'], job.get('session_id') or job_id)
+            renditions = make_renditions(filename) or {'original': {'file': filename}}
+            store_image(filename, job['prompt'], renditions, job_id)
+        fields = {'status': 'done', 'image_file': filename, 'deduped': int(bool(image)),
+                  'image_url': image_file_url(renditions.get('web', renditions['original'])['file']), 'renditions': json.dumps(renditions)}
+    except Exception as e:
+        logger.error(f"Image job {job_id} failed: {type(e).__name__}: {str(e)}")
+        logger.debug(f"Stack trace: {traceback.format_exc()}")
+        fields = {'status': 'failed', 'error': str(e)}
+        refund_image_cooldown(job.get('nick', ''))
+    fields['finished'] = time.time()
+    update_image_job(job_id, **fields)
+    _release_image_job(job_id)
+    metrics.inc('grok_image_jobs_total', {'status': fields['status']})
+    metrics.observe('grok_image_job_seconds', fields['finished'] - (job['created'] or started), {'status': fields['status']})
+    logger.info(f"Image job {job_id} {fields['status']} in {fields['finished'] - started:.2f}s after {started - (job['created'] or started):.2f}s queued")
+# KEYS: imagelimit:<nick> (also returned by chat's begin_turn script); ARGV: now, image_cooldown
+# Returns the start of a running cooldown, or nil once this request has started one
+CLAIM_IMAGE_COOLDOWN_LUA = """
+local last = redis.call('GET', KEYS[1])
+if last and tonumber(ARGV[1]) - tonumber(last) < tonumber(ARGV[2]) then
+    return last
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', math.max(1, math.ceil(tonumber(ARGV[2]))))
+return false
+"""
+claim_image_cooldown_script = redis_client.register_script(CLAIM_IMAGE_COOLDOWN_LUA)
+def claim_image_cooldown(nick: str, now: float) -> float | None:
+    """Start the nick's image cooldown unless one is running; returns the running one's start time.
+    Jobs may fail on another worker, so the cooldown lives in Redis and image_limits is only the fallback."""
+    try:
+        with track('redis'):
+            last = claim_image_cooldown_script(keys=[f"imagelimit:{nick}"], args=[now, config['image_cooldown']])
+        return float(last) if last is not None else None
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for image cooldown {nick}: {str(e)}, using in-memory")
+        last = image_limits.get(nick)
+        if last is not None and now - last < config['image_cooldown']:
+            return last
+        image_limits[nick] = now
+        return None
+def refund_image_cooldown(nick: str) -> None:
+    """A failed job doesn't cost the nick its image for the day."""
+    image_limits.pop(nick, None)
+    try:
+        redis_client.delete(f"imagelimit:{nick}")
+    except redis.RedisError:
+        pass
+def _release_image_job(job_id: str) -> None:
+    try:
+        redis_client.lrem(IMAGE_JOB_PROCESSING, 1, job_id)
+    except redis.RedisError:
+        pass
+def requeue_stale_image_jobs() -> int:
+    """Put jobs whose thread vanished (worker killed or recycled mid-run) back on the queue."""
+    requeued = 0
+    now = time.time()
+    for job_id in redis_client.lrange(IMAGE_JOB_PROCESSING, 0, -1):
+        job = get_image_job(job_id)
+        if job is not None and now - (job['started'] or job['created'] or now) < config['image_job_timeout']:
+            continue
+        if not redis_client.lrem(IMAGE_JOB_PROCESSING, 1, job_id): # another worker's reaper got there first
+            continue
+        if job is None or job['status'] in IMAGE_JOB_FINISHED:
+            continue
+        if job['attempts'] >= IMAGE_JOB_MAX_ATTEMPTS:
+            update_image_job(job_id, status='failed', error='Image generation did not finish.', finished=now)
+            refund_image_cooldown(job.get('nick', ''))
+            metrics.inc('grok_image_jobs_total', {'status': 'failed'})
+            continue
+        update_image_job(job_id, status='queued')
+        redis_client.rpush(IMAGE_JOB_QUEUE, job_id) # front of the queue: it has waited long enough
+        requeued += 1
+        logger.warning(f"Image job {job_id} requeued after {now - (job['started'] or job['created']):.0f}s (attempt {job['attempts']})")
+    return requeued
+def _next_image_job() -> str | None:
+    local = _image_job_threads['queue']
+    try:
+        return local.get_nowait()
+    except queue.Empty:
+        pass
+    try:
+        return redis_client.brpoplpush(IMAGE_JOB_QUEUE, IMAGE_JOB_PROCESSING, timeout=5)
+    except redis.RedisError:
+        try:
+            return local.get(timeout=5) # Redis down: only this worker's fallback jobs
+        except queue.Empty:
+            return None
+def _image_job_loop() -> None:
+    while True:
+        try:
+            job_id = _next_image_job()
+            if job_id:
+                run_image_job(job_id)
+            if time.time() - _image_job_threads['reaped'] > 60:
+                _image_job_threads['reaped'] = time.time()
+                requeue_stale_image_jobs()
+                release_expired_image_refs()
+        except redis.RedisError as e:
+            logger.warning(f"Image job loop: Redis unavailable: {str(e)}")
+            time.sleep(5)
+        except Exception as e:
+            logger.error(f"Image job loop error: {type(e).__name__}: {str(e)}")
+            time.sleep(1)
+def start_image_job_threads(count: int) -> None:
+    """Start this process's job threads once (per pid, so each gunicorn worker runs its own)."""
+    if _image_job_threads['pid'] == os.getpid():
+        return
+    with _image_job_lock:
+        if _image_job_threads['pid'] != os.getpid():
+            _image_job_threads.update({'pid': os.getpid(), 'queue': queue.SimpleQueue(), 'reaped': 0.0})
+            for n in range(count):
+                threading.Thread(target=_image_job_loop, name=f'image-job-{n}', daemon=True).start()
+            logger.info(f"Started {count} image job threads (pid: {os.getpid()})")
+def image_job_stats() -> dict:
+    try:
+        queued, processing = redis_client.llen(IMAGE_JOB_QUEUE), redis_client.llen(IMAGE_JOB_PROCESSING)
+    except redis.RedisError:
+        queued = processing = None
+    return {'queued': queued, 'processing': processing, 'local': len(image_jobs)}
 # ------------------------------------------------------------------------------
 # Startup ping
 # ------------------------------------------------------------------------------
 def test_api_connectivity():
     global last_api_success
-    logger.info("Initializing OpenAI client for connectivity test")
+    logger.info("Running startup API connectivity test")
     # Validate configuration
     if not config['xai_api_key']:
         logger.error("No xai_api_key provided in config")
@@ -829,38 +1862,37 @@ def test_api_connectivity():
         return False
     # Test network connectivity
     try:
-        import httpx
         response = httpx.get(config['api_base_url'], timeout=5.0)
         logger.info(f"Network test to {config['api_base_url']}: {response.status_code}")
     except Exception as e:
         logger.warning(f"Network test to {config['api_base_url']} failed: {type(e).__name__}: {str(e)}")
-    max_attempts = 3
-    for attempt in range(1, max_attempts + 1):
-        try:
-            client = OpenAI(api_key=config['xai_api_key'], base_url=config['api_base_url'])
-            response = client.chat.completions.create(
-                model="grok-3",
-                messages=[{"role": "user", "content": "ping"}],
-                max_tokens=10,
-                timeout=config['api_timeout'] # Use 30s from config
-            )
-            last_api_success = time.time()
-            logger.info(f"API connectivity test successful: {response.choices[0].message.content}")
-            return True
-        except Exception as e:
-            logger.warning(f"API connectivity test attempt {attempt}/{max_attempts} failed: {type(e).__name__}: {str(e)}")
-            if attempt == max_attempts:
-                logger.error(f"API connectivity test failed after {max_attempts} attempts: {type(e).__name__}: {str(e)}")
-                logger.debug(f"Stack trace: {traceback.format_exc()}")
-                return False
-            time.sleep(2 ** attempt) # Exponential backoff: 2s, 4s, 8s
-    return False
-if config['run_startup_test']:
-    logger.info("Running startup API connectivity test")
+    result = probe(config['xai_api_key'], config['api_base_url'], config['api_timeout'])
+    if result['ok']:
+        last_api_success = result['at']
+    return result['ok']
+# Under gunicorn.conf.py the master runs the probe once, before forking, and publishes the result
+# here as JSON ({"pending": true} until it has run); workers only read it
+STARTUP_PROBE_ENV = 'GROK_STARTUP_PROBE'
+def published_startup_probe() -> dict | None:
+    try:
+        return json.loads(os.environ[STARTUP_PROBE_ENV])
+    except (KeyError, ValueError):
+        return None
+def apply_startup_probe() -> None:
+    global last_api_success
+    result = published_startup_probe() or {}
+    if result.get('ok'):
+        last_api_success = result['at']
+boot_step('setup')
+if published_startup_probe() is not None:
+    logger.info("Startup API connectivity test runs once in the gunicorn master")
+    apply_startup_probe()
+elif config['run_startup_test']:
     if not test_api_connectivity():
         logger.warning("Startup API connectivity test failed, but proceeding with server startup")
 else:
     logger.info("Startup API connectivity test disabled in config")
+boot_step('startup_test')
 # ------------------------------------------------------------------------------
 # Prompt, parsing, fallback
 # ------------------------------------------------------------------------------
@@ -946,7 +1978,7 @@ def calculate_time_fallback(query: str, current_time: str) -> str | None:
         if re.search(r"\byesterday\b", lower):
             return (now_utc - timedelta(days=1)).strftime('Yesterday was %A, %B %d, %Y (UTC).')
         # time in/for CITY
-        loc = _extract_location(query)
+        loc = extract_location(query)
         if loc:
             # best-effort mapping
             tz_name = CITY_TZ.get(loc)
@@ -985,13 +2017,120 @@ def process_grok_response(response, message: str, timestamp: str) -> str:
     reply = normalize_reply_text(reply)
     return reply
 # ------------------------------------------------------------------------------
+# Chat pipeline helpers (shared with the async server in grok_asgi.py)
+# ------------------------------------------------------------------------------
+NO_CACHE = 'no-store, no-cache, must-revalidate, max-age=0'
+RICKROLL_URL = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+JOKE_FALLBACK = "The naughty spud got caught shagging in the stew!"
+_YOUTUBE_LINK_RE = re.compile(r'(https?://(?:www\.)?(?:youtube\.com/watch\?v=[\w-]+|youtu\.be/[\w-]+))', re.IGNORECASE)
+def find_youtube_links(reply: str) -> list[str]:
+    return _YOUTUBE_LINK_RE.findall(reply)
+def format_cooldown(time_left: float) -> str:
+    hours_left = int(time_left // 3600)
+    minutes_left = int((time_left % 3600) // 60)
+    return f"{hours_left} hours and {minutes_left} minutes"
+def build_email(nick: str, message: str) -> tuple[str, str]:
+    """Default subject/body (customize based on context; could use model to generate if needed)."""
+    subject = "Message from Grok Chat Bot"
+    body = "Hello,\n\nThis is a test email sent via the Grok chat bot on behalf of {nick}.\n\nOriginal message: {message}\n\nBest regards,\nGrok".format(nick=nick, message=message)
+    return subject, body
+def build_joke_messages(history: deque) -> list:
+    # Get recent jokes from history (last 3 assistant responses with "joke" intent)
+    recent_jokes = [msg['content'] for msg in list(history)[-6:] if msg['role'] == 'assistant' and 'joke' in msg.get('content', '').lower()]
+    recent_jokes_str = "; ".join(recent_jokes) if recent_jokes else "none"
+    joke_prompt = (
+        f"Generate a crude, adult-themed joke in British English with varied themes/slange (e.g., 'shagging', 'knob'). "
+        f"Keep it cheeky for IRC, distinct from recent: {recent_jokes_str}. One sentence."
+    )
+    return [
+        {"role": "system", "content": joke_prompt},
+        {"role": "user", "content": "Tell me a crude NSFW joke."}
+    ]
+def prompt_token_budget(intents: dict) -> int:
+    budgets = config['prompt_token_budgets']
+    for name in ('news', 'search', 'video'):
+        if intents.get(name) and name in budgets:
+            return budgets[name]
+    return budgets['default']
+def build_conversation(message: str, history: deque, session_id: str, timestamp: str, intents: dict, slots: dict, summary: str | None = None) -> tuple[list, dict]:
+    """Base system prompt + conditional instructions + history summary + history + new message, and the Live Search params."""
+    base_system = generate_system_prompt(session_id, timestamp)[0] # Just the base dict
+    conversation = [base_system] # Start with base system
+    # Conditional appendages (as separate system messages to minimize when not needed)
+    needs_search = intents['search']
+    if needs_search:
+        conversation.append({"role": "system", "content": SEARCH_INSTRUCTION})
+    if intents['video']:
+        conversation.append({"role": "system", "content": VIDEO_INSTRUCTION})
+        conversation.append({"role": "system", "content": VIDEO_COPYRIGHT_GUIDANCE})
+    # Handle news intent specifically
+    if intents['news']:
+        country = slots['news_country'] or 'UK'  # Default to UK for general news queries
+        conversation.append({"role": "system", "content": NEWS_INSTRUCTION})
+        conversation.append({"role": "system", "content": f"Provide a summary of the latest news headlines specifically for {country}. Use real-time search to fetch current news from reliable sources in or about {country}. Summarize the top 3-5 stories briefly."})
+        needs_search = True  # Ensure search is enabled for news
+    # Always add anti-jailbreak for safety
+    conversation.append({"role": "system", "content": ANTI_JAILBREAK_INSTRUCTION})
+    conversation += summary_message(summary)
+    # Add as much recent history as the intent's token budget leaves room for, then the new message
+    conversation, tokens = fit_prompt(conversation, list(history), {"role": "user", "content": message}, prompt_token_budget(intents))
+    logger.info(f"Prompt tokens for {session_id}: system={tokens['system']} history={tokens['history']} message={tokens['message']} "
+                f"total={tokens['total']}/{tokens['budget']} (history kept {tokens['history_kept']}, dropped {tokens['history_dropped']}"
+                f"{', oldest truncated' if tokens['truncated'] else ''})")
+    search_params = {}
+    if intents['video'] or needs_search:
+        search_params = {'mode': 'on', 'max_search_results': config['max_search_results']}
+    return conversation, search_params
+def upstream_headers(session_id: str, timestamp: str) -> dict:
+    nonce = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+    return {
+        'X-Cache-Bypass': f"{time.time()}-{nonce}",
+        'X-Request-ID': tracing.request_id() or str(random.randint(100000, 999999)),
+        'X-Session-ID': session_id,
+        'X-Timestamp': timestamp,
+        **({'traceparent': tracing.traceparent()} if tracing.current() else {})
+    }
+def chat_completion_kwargs(conversation: list, search_params: dict, session_id: str, timestamp: str) -> dict:
+    """Arguments for the main grok-3 call, identical for the sync and async clients."""
+    headers = upstream_headers(session_id, timestamp)
+    logger.debug(f"Request headers: {headers}")
+    return dict(
+        model="grok-3",
+        messages=conversation,
+        temperature=config['temperature'],
+        max_tokens=config['max_tokens'],
+        extra_headers=headers,
+        extra_body={'search_parameters': search_params} if search_params else {},
+        timeout=config['api_timeout']
+    )
+def record_chat_request(branch: str, status: int, seconds: float) -> None:
+    metrics.inc('grok_chat_requests_total', {'intent': branch, 'status': status})
+    metrics.observe('grok_chat_request_seconds', seconds, {'intent': branch})
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+def can_stream(intents: dict) -> bool:
+    """Video replies are link-validated and retried, time replies may be swapped for a local fallback,
+    so both need the full text before anything is sent."""
+    return not intents['video'] and not intents['time']
+def sse_event(data: str, event: str | None = None) -> str:
+    return (f"event: {event}\n" if event else '') + f"data: {data}\n\n"
+def sse_from_payload(payload: dict, status: int) -> list[str]:
+    """Replay a plain /chat JSON result as /chat/stream events: one per reply line, then done/error."""
+    events = [sse_event(line) for line in (payload.get('reply') or '').split('\n') if line]
+    extra = {k: v for k, v in payload.items() if k != 'reply'}
+    extra['status'] = status
+    events.append(sse_event(json.dumps(extra), event='error' if status >= 400 else 'done'))
+    return events
+# ------------------------------------------------------------------------------
 # Endpoints
 # ------------------------------------------------------------------------------
-@app.route('/health', methods=['GET'])
+@bp.route('/health', methods=['GET'])
 def health():
     logger.info("Health check called")
-    return jsonify({'status': 'healthy'}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0'}
-@app.route('/debug', methods=['GET'])
+    return jsonify({'status': 'healthy'}), 200, {'Cache-Control': NO_CACHE}
+@bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE, headers={'Cache-Control': NO_CACHE})
+@bp.route('/debug', methods=['GET'])
 def debug():
     logger.info("Debug endpoint called")
     try:
@@ -1001,7 +2140,7 @@ def debug():
         recent_logs = [f"Error reading log file: {str(e)}"]
     status = {
         'config': {k: '****' if k == 'xai_api_key' else v for k, v in config.items()},
-        'uptime': time.time() - app.start_time,
+        'uptime': time.time() - current_app.start_time,
         'python_version': sys.version,
         'flask_version': flask.__version__,
         'openai_version': openai.__version__,
@@ -1011,11 +2150,14 @@ def debug():
         'flask_port': config['flask_port'],
         # Debug history and rates (anonymized)
         'history_count': len(history_store),
-        'rate_limit_count': len(rate_limits)
+        'rate_limit_count': len(rate_limits),
+        'reply_cache': reply_cache_stats(),
+        'image_jobs': image_job_stats(),
+        'startup': boot_times
     }
-    return jsonify(status), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0'}
+    return jsonify(status), 200, {'Cache-Control': NO_CACHE}
 # Dedicated image generation endpoint
-@app.route('/generate-image', methods=['POST'])
+@bp.route('/generate-image', methods=['POST'])
 def generate_image_endpoint():
     start_time = time.time()
     session_id = str(uuid.uuid4())
@@ -1024,48 +2166,145 @@ def generate_image_endpoint():
     prompt = data.get('prompt', '').strip()
     nick = data.get('nick', 'unknown')
     # Sanitize prompt
-    prompt = bleach.clean(prompt, tags=[], strip=True)
+    prompt = sanitize_text(prompt)
     logger.info(f"Image gen session: {session_id}, Timestamp: {timestamp}, Prompt: {prompt}, Nick: {nick}")
     if not config['enable_image_generation']:
         logger.info(f"Image generation disabled via config for session: {session_id}")
         return jsonify({'error': 'Image generation is disabled.', 'fallback': 'Sorry, image generation is turned off!'}), 403
     if not prompt:
         logger.error(f"Session ID: {session_id}, No prompt provided")
-        return jsonify({'error': 'No prompt provided', 'fallback': 'Please provide a prompt!'}), 400, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0'}
+        return jsonify({'error': 'No prompt provided', 'fallback': 'Please provide a prompt!'}), 400, {'Cache-Control': NO_CACHE}
     # Add ignore_inputs check for image prompts
     if prompt.lower().strip() in config['ignore_inputs']:
         logger.info(f"Ignored non-substantive image prompt: {prompt}")
-        return jsonify({'reply': '', 'image_url': ''}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        return jsonify({'reply': '', 'image_url': ''}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
     # Check image generation rate limit
     now = time.time()
     image_key = nick
-    if image_key in image_limits and (now - image_limits[image_key]) < config['image_cooldown']:
-        time_left = config['image_cooldown'] - (now - image_limits[image_key])
+    last = claim_image_cooldown(image_key, now)
+    if last is not None:
+        time_left = config['image_cooldown'] - (now - last)
         hours_left = int(time_left // 3600)
         minutes_left = int((time_left % 3600) // 60)
         logger.info(f"Image rate limit hit for {image_key}")
         return jsonify({
             'error': 'Image generation rate limited. One image per user per day.',
             'fallback': f"Please wait {hours_left} hours and {minutes_left} minutes before generating another image."
-        }), 429, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        }), 429, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+    # Queue the job and answer with its id; "wait": N (seconds) keeps the old inline behaviour for clients that want it
+    headers = {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+    try:
+        job = enqueue_image_job(prompt, nick, session_id)
+    except ValueError as e:
+        logger.error(f"Image prompt refused: {str(e)}")
+        refund_image_cooldown(image_key)
+        return jsonify({'error': f"Image generation failed: {str(e)}", 'fallback': 'Sorry, couldn\'t generate the image!'}), 500, headers
+    wait = min(float(data.get('wait') or 0), float(config['image_job_max_wait']))
+    if wait > 0:
+        job = wait_image_job(job['job_id'], wait) or job
+        if job['status'] == 'done':
+            logger.info(f"Total time: {time.time() - start_time:.2f}s")
+            return jsonify({'image_url': job['image_url'], 'job_id': job['job_id']}), 200, headers
+        if job['status'] == 'failed':
+            return jsonify({'error': f"Image generation failed: {job.get('error', '')}", 'fallback': 'Sorry, couldn\'t generate the image!', 'job_id': job['job_id']}), 500, headers
+    logger.info(f"Total time: {time.time() - start_time:.2f}s (image job {job['job_id']} {job['status']})")
+    return jsonify({
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'status_url': f"{config['image_host_url']}/image-jobs/{job['job_id']}",
+        'image_url': image_job_url(job['job_id'])
+    }), 202, headers
+# Image job progress: JSON status, and a link that redirects to the image once it's ready
+@bp.route('/image-jobs/<job_id>', methods=['GET'])
+def image_job_status(job_id):
+    job = get_image_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired image job'}), 404, {'Cache-Control': NO_CACHE}
+    return jsonify(image_job_view(job)), 200, {'Cache-Control': NO_CACHE}
+@bp.route('/image-jobs/<job_id>', methods=['DELETE'])
+def image_job_delete(job_id):
+    """Delete a finished image for the nick that asked for it; the file goes once no other job links to it."""
+    job = get_image_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired image job'}), 404, {'Cache-Control': NO_CACHE}
+    nick = request.args.get('nick') or (request.get_json(silent=True) or {}).get('nick')
+    if nick != job.get('nick'):
+        return jsonify({'error': 'Only the nick that asked for this image can delete it'}), 403, {'Cache-Control': NO_CACHE}
+    if job['status'] != 'done':
+        return jsonify({'error': f"Image job is {job['status']}, only finished images can be deleted"}), 409, {'Cache-Control': NO_CACHE}
+    try:
+        refs = remove_image_job(job)
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable to delete image job {job_id}: {str(e)}")
+        return jsonify({'error': 'Image store unavailable, try again later'}), 503, {'Cache-Control': NO_CACHE}
+    logger.info(f"Image job {job_id} deleted by {nick} ({refs} other references to {job.get('image_file')})")
+    return jsonify({'job_id': job_id, 'status': 'deleted', 'shared_with': refs or 0}), 200, {'Cache-Control': NO_CACHE}
+@bp.route('/image-jobs/<job_id>/image', methods=['GET'])
+def image_job_image(job_id):
+    job = get_image_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired image job'}), 404, {'Cache-Control': NO_CACHE}
+    if job['status'] == 'done':
+        return redirect(job['image_url'], code=302)
+    if job['status'] == 'failed':
+        return jsonify(image_job_view(job)), 500, {'Cache-Control': NO_CACHE}
+    if job['status'] == 'deleted':
+        return jsonify(image_job_view(job)), 410, {'Cache-Control': NO_CACHE}
+    return jsonify(image_job_view(job)), 202, {'Cache-Control': NO_CACHE, 'Retry-After': '5'}
+def stream_chat_reply(upstream, message: str, history: deque, session_key: str, start_time: float, cache_key: str | None = None, intents: dict | None = None, trace=None):
+    """Relay a streamed completion as SSE, one event per IRC line as soon as the chunker finalises it."""
+    global last_api_success
+    tracing.resume(trace) # the view has returned; this trace ends with the stream, not the response headers
+    chunker = IncrementalChunker()
+    lines = []
+    status = 499 # client went away before the end
     try:
-        logger.info("Initializing client for image gen")
-        client = OpenAI(api_key=config['xai_api_key'], base_url=config['api_base_url']) # Default, overridden in generate_image if needed
-        image_url = generate_image(client, prompt, session_id)
-        image_limits[image_key] = now
+        try:
+            with tracing.span('stream'):
+                for event in upstream:
+                    delta = event.choices[0].delta.content if event.choices else None
+                    if not delta:
+                        continue
+                    for line in chunker.feed(delta):
+                        if not lines:
+                            logger.info(f"First line streamed after {time.time() - start_time:.2f}s (session: {session_key})")
+                        lines.append(normalize_reply_text(line))
+                        yield sse_event(lines[-1])
+                for line in chunker.flush():
+                    lines.append(normalize_reply_text(line))
+                    yield sse_event(lines[-1])
+            last_api_success = time.time()
+        except (APIError, APIConnectionError, BadRequestError, httpx.HTTPError) as e: # httpx: connection dropped mid-stream
+            logger.error(f"Streamed API call failed: {type(e).__name__}: {str(e)}")
+            status = 500
+            yield sse_event(json.dumps({'error': f"API call failed: {str(e)}", 'fallback': 'Sorry, I couldn\'t connect to Grok!', 'status': 500}), event='error')
+            return
+        reply = '\n'.join(lines)
+        logger.info(f"Streamed reply (len={len(reply)}, lines={len(lines)}): {reply}")
+        with tracing.span('commit'):
+            if cache_key and reply:
+                reply_cache_put(cache_key, reply, intents)
+            commit_turn(session_key, history, message, reply)
         logger.info(f"Total time: {time.time() - start_time:.2f}s")
-        return jsonify({'image_url': image_url}), 200, {
-            'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
-            'X-Session-ID': session_id,
-            'X-Timestamp': timestamp
-        }
-    except Exception as e: # Broadened to catch all (incl. BadRequestError, Timeout)
-        logger.error(f"Image API call failed: {type(e).__name__}: {str(e)}")
-        logger.debug(f"Stack trace: {traceback.format_exc()}")
-        return jsonify({'error': f"Image generation failed: {str(e)}", 'fallback': 'Sorry, couldn\'t generate the image!'}), 500, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
-@app.route('/chat', methods=['GET', 'POST'])
-def chat():
-    start_time = time.time()
+        status = 200
+        yield sse_event(json.dumps({'status': 200}), event='done')
+    finally:
+        tracing.finish(status=status, lines=len(lines))
+@bp.route('/chat/stream', methods=['GET', 'POST'])
+def chat_stream():
+    """/chat as Server-Sent Events. Model replies stream line by line; every other branch is replayed as events."""
+    rv = chat(stream=True)
+    if isinstance(rv, Response) and rv.mimetype == 'text/event-stream':
+        return rv
+    resp = current_app.make_response(rv)
+    events = sse_from_payload(resp.get_json(silent=True) or {}, resp.status_code)
+    headers = {k: v for k, v in resp.headers.items() if k.startswith('X-')}
+    headers['Cache-Control'] = NO_CACHE
+    return Response(events, status=resp.status_code, mimetype='text/event-stream', headers=headers)
+@bp.route('/chat', methods=['GET', 'POST'])
+def chat(stream: bool = False):
+    start_time = g.chat_start = time.time()
+    tracing.start('chat', request.headers.get('X-Request-ID'), request.headers.get('traceparent'))
     timestamp = str(time.time())
     if request.method == 'GET':
         message = request.args.get('message', '')
@@ -1081,275 +2320,234 @@ def chat():
     # Use nick:channel as session key
     session_key = f"{nick}:{channel}"
     session_id = session_key # Use as ID for logging
-    logger.debug(f"Session key: {session_id}, Timestamp: {timestamp}, Request details: {json.dumps(request_details, indent=2)}")
+    sample_debug(session_key)
+    if debug_payloads():
+        logger.debug(f"Session key: {session_id}, Timestamp: {timestamp}, Request details: {json.dumps(request_details, indent=2)}")
     if not message:
         logger.error(f"Session ID: {session_id}, Timestamp: {timestamp}, No message provided")
-        return jsonify({'error': 'No message provided', 'fallback': 'Please provide a message!'}), 400, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0'}
+        return jsonify({'error': 'No message provided', 'fallback': 'Please provide a message!'}), 400, {'Cache-Control': NO_CACHE}
     # Sanitize message
-    message = bleach.clean(message, tags=[], strip=True)
+    with tracing.span('sanitize'):
+        message = sanitize_text(message)
+    # Every /chat request is logged in this format before any branch (replay_log.py reads it back)
+    logger.info(f"Session ID: {session_id}, Timestamp: {timestamp}, Request from nick: {nick}, channel: {channel}, message: {message}")
     # Detect potential jailbreak in message
-    jailbreak_keywords = ['ignore', 'override', 'prompt', 'instructions', 'jailbreak', 'developer mode']
-    if any(kw in message.lower() for kw in jailbreak_keywords):
+    with tracing.span('route'):
+        intents, slots = route_message(message)
+    g.chat_branch = chat_branch(intents)
+    tracing.annotate(session=session_key, intent=g.chat_branch, stream=stream)
+    if intents['jailbreak']:
         logger.warning(f"Jailbreak attempt detected in chat message: {message}")
         return jsonify({'reply': 'Invalid request'}), 400
     if message.lower().strip() in config['ignore_inputs']:
         logger.info(f"Ignored non-substantive input from nick: {nick}, channel: {channel}, message: {message}")
-        return jsonify({'reply': ''}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        return jsonify({'reply': ''}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
     if message.lower().strip() == "clear my context":
         try:
-            redis_client.delete(f"history:{session_key}")
+            redis_client.delete(f"history:{session_key}", f"summary:{session_key}")
         except redis.RedisError:
             if session_key in history_store:
                 del history_store[session_key]
         reply = "Your context has been cleared."
         reply = '\n'.join(chunked_reply(reply))
         logger.info(f"Cleared history for session: {session_id}")
-        return jsonify({'reply': reply}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        return jsonify({'reply': reply}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
     # Rate limiting per nick:channel
+    # (check-and-set in the same round trip that loads history and the email/image cooldowns)
     now = time.time()
-    if not check_rate_limit(session_key):
+    turn = begin_turn(session_key, nick, now)
+    if not turn['allowed']:
         logger.info(f"Rate limit hit for {session_key}")
-        return jsonify({'error': 'Rate limited. Please wait.', 'fallback': 'Please wait a few seconds before asking again!'}), 429, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
-    update_rate_limit(session_key, now)
-    # Load history
-    history = get_history(session_key)
+        return jsonify({'error': 'Rate limited. Please wait.', 'fallback': 'Please wait a few seconds before asking again!'}), 429, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+    history = turn['history']
     # Email intent handling
-    if has_email_intent(message):
+    if intents['email']:
         email_key = nick
-        if not check_email_limit(email_key):
-            time_left = config['email_cooldown'] - (now - float(redis_client.get(f"emaillimit:{email_key}") or email_limits.get(email_key, 0)))
-            hours_left = int(time_left // 3600)
-            minutes_left = int((time_left % 3600) // 60)
+        if turn['email_last'] is not None and now - turn['email_last'] < config['email_cooldown']:
+            time_left = config['email_cooldown'] - (now - turn['email_last'])
             logger.info(f"Email rate limit hit for {email_key} (session: {session_id})")
             return jsonify({
                 'error': 'Email sending rate limited. One email per user per day.',
-                'fallback': f"Please wait {hours_left} hours and {minutes_left} minutes before sending another email."
-            }), 429, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+                'fallback': f"Please wait {format_cooldown(time_left)} before sending another email."
+            }), 429, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
         # Extract 'to' address (e.g., "send an email to jordan@boxlabs.co.uk")
-        to_match = re.search(r"\b(?:send\s+(?:an?\s+)?email\s+to|ping|contact)\s+([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})\b", message, re.IGNORECASE)
-        to = to_match.group(1).strip() if to_match else None
+        to = slots['email_target']
         if not to:
             logger.warning(f"Email intent detected but no valid 'to' address extracted: {message}")
             return jsonify({'reply': 'Please specify a valid email address to send to.'}), 400
-        # For simplicity, use default subject/body (customize based on context; could use model to generate if needed)
-        subject = "Message from Grok Chat Bot"
-        body = "Hello,\n\nThis is a test email sent via the Grok chat bot on behalf of {nick}.\n\nOriginal message: {message}\n\nBest regards,\nGrok".format(nick=nick, message=message)
+        subject, body = build_email(nick, message)
         photo_path = None  # If photo upload endpoint added, pull from session or data
-        email_reply = send_email(to, subject, body, photo_path, session_id)
-        if "sent successfully" in email_reply:
-            update_email_limit(email_key, now)
+        with tracing.span('email'):
+            email_reply = send_email(to, subject, body, photo_path, session_id)
+        email_limit = ('emaillimit', email_key, config['email_cooldown'], now) if "sent successfully" in email_reply else None
         email_reply = '\n'.join(chunked_reply(email_reply))
-        history.append({"role": "user", "content": message})
-        history.append({"role": "assistant", "content": email_reply})
-        save_history(session_key, history)
+        commit_turn(session_key, history, message, email_reply, email_limit)
         logger.info(f"Total time for email: {time.time() - start_time:.2f}s")
-        return jsonify({'reply': email_reply}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        return jsonify({'reply': email_reply}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
     # Handle joke intent
-    if "joke" in message.lower():
+    if intents['joke']:
         try:
-            logger.info("Initializing OpenAI client for NSFW joke")
-            client = OpenAI(api_key=config['xai_api_key'], base_url=config['api_base_url'])
-            # Get recent jokes from history (last 3 assistant responses with "joke" intent)
-            recent_jokes = [msg['content'] for msg in list(history)[-6:] if msg['role'] == 'assistant' and 'joke' in msg.get('content', '').lower()]
-            recent_jokes_str = "; ".join(recent_jokes) if recent_jokes else "none"
-            joke_prompt = (
-                f"Generate a crude, adult-themed joke in British English with varied themes/slange (e.g., 'shagging', 'knob'). "
-                f"Keep it cheeky for IRC, distinct from recent: {recent_jokes_str}. One sentence."
-            )
-            response = client.chat.completions.create(
-                model="grok-3",
-                messages=[
-                    {"role": "system", "content": joke_prompt},
-                    {"role": "user", "content": "Tell me a crude NSFW joke."}
-                ],
-                temperature=0.9, # Increased for more randomness
-                max_tokens=50,
-                timeout=config['api_timeout']
-            )
+            client = get_xai_client()
+            with track('xai'):
+                response = client.chat.completions.create(
+                    model="grok-3",
+                    messages=build_joke_messages(history),
+                    temperature=0.9, # Increased for more randomness
+                    max_tokens=50,
+                    timeout=config['api_timeout']
+                )
+            metrics.tokens(response.usage)
             reply = response.choices[0].message.content.strip()
             logger.info(f"Generated NSFW joke: {reply}")
-        except (APIError, APIConnectionError, Timeout, BadRequestError) as e:
+        except (APIError, APIConnectionError, BadRequestError) as e:
             logger.error(f"Joke API call failed: {type(e).__name__}: {str(e)}")
-            reply = "The naughty spud got caught shagging in the stew!"
+            reply = JOKE_FALLBACK
         reply = '\n'.join(chunked_reply(reply))
-        history.append({"role": "user", "content": message})
-        history.append({"role": "assistant", "content": reply})
-        save_history(session_key, history)
-        return jsonify({'reply': reply}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        commit_turn(session_key, history, message, reply)
+        return jsonify({'reply': reply}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
     # Weather intent
-    if has_weather_intent(message):
-        weather_reply = get_weather(message, session_id)
+    if intents['weather']:
+        with tracing.span('weather'):
+            weather_reply = get_weather(slots['location'], session_id, slots['weather_span'])
         if weather_reply:
             weather_reply = '\n'.join(chunked_reply(weather_reply))
-            history.append({"role": "user", "content": message})
-            history.append({"role": "assistant", "content": weather_reply})
-            save_history(session_key, history)
-            return jsonify({'reply': weather_reply}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+            commit_turn(session_key, history, message, weather_reply)
+            return jsonify({'reply': weather_reply}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
         else:
             logger.info(f"Weather offload failed; falling back to Grok for: {message}")
     # Check for image intent and route to image gen
-    if has_image_intent(message):
+    if intents['image']:
         if not config['enable_image_generation']:
             logger.info(f"Image intent detected but disabled via config: {message}")
             return jsonify({'reply': 'Image generation is disabled.'}), 200
         logger.info(f"Detected image intent in message: {message}. Routing to image generation.")
-        # Extract prompt: simple heuristic, take everything after "generate image of" or similar
-        prompt_match = re.search(r"(?:generate|create|draw|make)\s+(?:an?\s+)?(?:image|picture|art|illustration|photo|graphic)\s+(?:of\s+)?(.+)", message, re.IGNORECASE)
-        prompt = prompt_match.group(1).strip() if prompt_match else message.strip()
+        prompt = slots['image_prompt']
         # Add ignore_inputs check for extracted image prompts
         if prompt.lower().strip() in config['ignore_inputs']:
             logger.info(f"Ignored non-substantive image prompt from chat: {prompt}")
-            return jsonify({'reply': '', 'image_url': ''}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
-        # Check image generation rate limit
+            return jsonify({'reply': '', 'image_url': ''}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        # Check image generation rate limit; claimed up front, since begin_turn only serializes this nick:channel
         image_key = nick
-        if not check_image_limit(image_key):
-            time_left = config['image_cooldown'] - (now - float(redis_client.get(f"imagelimit:{image_key}") or image_limits.get(image_key, 0)))
-            hours_left = int(time_left // 3600)
-            minutes_left = int((time_left % 3600) // 60)
+        last = claim_image_cooldown(image_key, now)
+        if last is not None:
+            time_left = config['image_cooldown'] - (now - last)
             logger.info(f"Image rate limit hit for {image_key}")
             return jsonify({
                 'error': 'Image generation rate limited. One image per user per day.',
-                'fallback': f"Please wait {hours_left} hours and {minutes_left} minutes before generating another image."
-            }), 429, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+                'fallback': f"Please wait {format_cooldown(time_left)} before generating another image."
+            }), 429, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        # Queued, not generated here: the reply carries a link that turns into the image when the job is done
+        job = None
         try:
-            logger.info("Initializing OpenAI client for image gen")
-            client = OpenAI(api_key=config['xai_api_key'], base_url=config['api_base_url']) # Default, overridden in generate_image
-            image_url = generate_image(client, prompt, session_id)
-            update_image_limit(image_key, now)
-            reply = f"Here's the generated image based on your request: {image_url}"
+            with tracing.span('image'):
+                job = enqueue_image_job(prompt, nick, session_id)
+        except Exception as e:
+            logger.error(f"Image gen in chat failed: {type(e).__name__}: {str(e)}")
+            # Fallback to text chat if the prompt is refused or the job can't be queued
+            refund_image_cooldown(image_key)
+        if job:
+            image_url = image_job_url(job['job_id'])
+            reply = f"Generating your image, it'll be here shortly: {image_url}"
             reply = '\n'.join(chunked_reply(reply))
-            # Append to history (image as assistant response)
-            history.append({"role": "user", "content": message})
-            history.append({"role": "assistant", "content": reply})
-            save_history(session_key, history)
+            # Append to history (image link as assistant response)
+            commit_turn(session_key, history, message, reply)
             logger.info(f"Total time: {time.time() - start_time:.2f}s")
-            return jsonify({'reply': reply, 'image_url': image_url}), 200, {
-                'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
+            return jsonify({'reply': reply, 'image_url': image_url, 'job_id': job['job_id']}), 200, {
+                'Cache-Control': NO_CACHE,
                 'X-Session-ID': session_id,
                 'X-Timestamp': timestamp
             }
-        except Exception as e:
-            logger.error(f"Image gen in chat failed: {type(e).__name__}: {str(e)}")
-            # Fallback to text chat if image fails
-            pass
     # Handle funny video with rickroll
-    if has_video_intent(message) and ('funny video' in message.lower() or 'rickroll' in message.lower()):
-        rickroll_url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
-        if validate_youtube_link(rickroll_url):
-            reply = f"Here's a cracking funny video for you: {rickroll_url}"
+    if intents['rickroll']:
+        if validate_youtube_link(RICKROLL_URL):
+            reply = f"Here's a cracking funny video for you: {RICKROLL_URL}"
         else:
             reply = "Unable to get real-time results."
         reply = '\n'.join(chunked_reply(reply))
-        history.append({"role": "user", "content": message})
-        history.append({"role": "assistant", "content": reply})
-        save_history(session_key, history)
-        return jsonify({'reply': reply}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        commit_turn(session_key, history, message, reply)
+        return jsonify({'reply': reply}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
     # Check for video intent and handle with YouTube API primarily
-    video_intent = has_video_intent(message)
+    video_intent = intents['video']
     if video_intent:
         logger.info(f"Detected video/YouTube intent in message: {message}. Using YouTube API.")
-        # Extract query
-        video_query_match = re.search(r"(?:link to|video of|song video|music video|give me a link to|give me a youtube link to)\s+(.+)", message, re.IGNORECASE)
-        video_query = video_query_match.group(1).strip() if video_query_match else message.strip()
-        video_info = fetch_youtube_video_link(video_query)
+        with tracing.span('video'):
+            video_info = fetch_youtube_video_link(slots['video_query'])
         if video_info:
             reply = f"Here's the link to '{video_info['title']}': {video_info['url']}"
             reply = '\n'.join(chunked_reply(reply))
-            history.append({"role": "user", "content": message})
-            history.append({"role": "assistant", "content": reply})
-            save_history(session_key, history)
+            commit_turn(session_key, history, message, reply)
             logger.info(f"Total time: {time.time() - start_time:.2f}s")
             return jsonify({'reply': reply}), 200, {
-                'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
+                'Cache-Control': NO_CACHE,
                 'X-Session-ID': session_id,
                 'X-Timestamp': timestamp
             }
         else:
             logger.warning("YouTube API failed; falling back to Grok model.")
-    logger.info(f"Session ID: {session_id}, Timestamp: {timestamp}, Request from nick: {nick}, channel: {channel}, message: {message}")
     try:
         # Build conversation with history + new message
-        base_system = generate_system_prompt(session_id, timestamp)[0] # Just the base dict
-        conversation = [base_system] # Start with base system
-        # Conditional appendages (as separate system messages to minimize when not needed)
-        search_keywords = ['weather', 'death', 'died', 'recent', 'news', 'what happened', 'update', 'breaking', 'today', 'happening', 'current events', 'youtube', 'video', 'link', 'song', 'music', 'clip', 'president', 'who']
-        needs_search = any(keyword in message.lower() for keyword in search_keywords)
-        if needs_search:
-            conversation.append({"role": "system", "content": SEARCH_INSTRUCTION})
-        if video_intent:
-            conversation.append({"role": "system", "content": VIDEO_INSTRUCTION})
-            # Your existing insertion (now using the constant)
-            conversation.append({"role": "system", "content": VIDEO_COPYRIGHT_GUIDANCE})
-        # Handle news intent specifically
-        news_intent = has_news_intent(message)
-        if news_intent:
-            country = extract_news_location(message) or 'UK'  # Default to UK for general news queries
-            conversation.append({"role": "system", "content": NEWS_INSTRUCTION})
-            conversation.append({"role": "system", "content": f"Provide a summary of the latest news headlines specifically for {country}. Use real-time search to fetch current news from reliable sources in or about {country}. Summarize the top 3-5 stories briefly."})
-            needs_search = True  # Ensure search is enabled for news
-        # Always add anti-jailbreak for safety
-        conversation.append({"role": "system", "content": ANTI_JAILBREAK_INSTRUCTION})
-        # Add history and new message
-        conversation += list(history) + [{"role": "user", "content": message}]
+        with tracing.span('prompt'):
+            conversation, search_params = build_conversation(message, history, session_id, timestamp, intents, slots, turn['summary'])
     except Exception as e:
         logger.error(f"Prompt generation failed: {type(e).__name__}: {str(e)}")
         logger.debug(f"Stack trace: {traceback.format_exc()}")
-        return jsonify({'error': f"Prompt generation failed: {str(e)}", 'fallback': 'Sorry, I couldn\'t process that!'}), 500, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0'}
+        return jsonify({'error': f"Prompt generation failed: {str(e)}", 'fallback': 'Sorry, I couldn\'t process that!'}), 500, {'Cache-Control': NO_CACHE}
     logger.info(f"History length for {session_key}: {len(history)} messages. Building convo with {len(conversation)} total.")
     logger.debug(f"Last user in history: {list(history)[-1]['content'] if history and list(history)[-1]['role'] == 'user' else 'None'}")
-    # Expanded search keywords for real-time news/music etc
-    search_params = {}
-    if video_intent or needs_search:
-        search_params = {'mode': 'on', 'max_search_results': config['max_search_results']}
+    if search_params:
         logger.info(f"Live Search enabled for query: {message} (video_intent={video_intent})")
-    logger.debug(f"API request payload: {json.dumps(conversation, indent=2)}")
+    # Shared reply cache in front of the model call
+    cache_key = reply_cache_key(message, intents, search_params)
+    cached = reply_cache_get(cache_key) if cache_key else None
+    if cached:
+        reply = '\n'.join(chunked_reply(cached))
+        commit_turn(session_key, history, message, reply)
+        logger.info(f"Reply cache hit for {session_id} ({cache_key}), total time: {time.time() - start_time:.2f}s")
+        return jsonify({'reply': reply}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+    if debug_payloads():
+        logger.debug(f"API request payload: {json.dumps(conversation, indent=2)}")
     try:
-        logger.info("Initializing OpenAI client")
-        client = OpenAI(api_key=config['xai_api_key'], base_url=config['api_base_url'])
+        client = get_xai_client()
+        if stream and can_stream(intents):
+            with track('xai'):
+                upstream = client.chat.completions.create(stream=True, **chat_completion_kwargs(conversation, search_params, session_id, timestamp))
+            g.chat_streamed = True
+            return Response(stream_with_context(stream_chat_reply(upstream, message, history, session_key, start_time, cache_key, intents, tracing.current())), mimetype='text/event-stream', headers={
+                'Cache-Control': NO_CACHE,
+                'X-Accel-Buffering': 'no', # don't let a proxy hold lines back
+                'X-Session-ID': session_id,
+                'X-Timestamp': timestamp
+            })
         max_retries = 3 # Increased to 3
         reply = None
         for attempt in range(max_retries):
             api_start = time.time()
-            nonce = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-            headers = {
-                'X-Cache-Bypass': f"{time.time()}-{nonce}",
-                'X-Request-ID': str(random.randint(100000, 999999)),
-                'X-Session-ID': session_id,
-                'X-Timestamp': timestamp
-            }
-            logger.debug(f"Request headers: {headers}")
-            response = client.chat.completions.create(
-                model="grok-3",
-                messages=conversation,
-                temperature=config['temperature'],
-                max_tokens=config['max_tokens'],
-                extra_headers=headers,
-                extra_body={'search_parameters': search_params} if search_params else {},
-                timeout=config['api_timeout']
-            )
+            with track('xai'):
+                response = client.chat.completions.create(**chat_completion_kwargs(conversation, search_params, session_id, timestamp))
             api_duration = time.time() - api_start
             global last_api_success
             last_api_success = time.time()
             logger.debug(f"API call took {api_duration:.2f}s")
             logger.debug(f"Raw Grok response: {response.choices[0].message.content}")
-            logger.debug(f"Full response: {response.model_dump()}")
-            reply = process_grok_response(response, message, timestamp)
-            reply_hash = hashlib.sha256(reply.encode()).hexdigest()
-            logger.info(f"Reply (len={len(reply)}, hash={reply_hash}): {reply}")
+            if debug_payloads():
+                logger.debug(f"Full response: {response.model_dump()}")
+            metrics.tokens(response.usage)
+            if response.usage:
+                estimator.calibrate(conversation, response.usage.prompt_tokens)
+            with tracing.span('postprocess'):
+                reply = process_grok_response(response, message, timestamp)
+            logger.info(f"Reply (len={len(reply)}): {reply}")
+            if debug_payloads():
+                logger.debug(f"Reply hash: {hashlib.sha256(reply.encode()).hexdigest()}")
             # If video intent and reply mentions copyright/refusal, log and fallback
             if video_intent and ('copyright' in reply.lower() or 'cannot provide' in reply.lower()):
                 logger.warning(f"Video query refused (possible copyright guardrail): {reply}")
                 reply += " (Fallback: Try searching YouTube directly for official videos.)"
+                cache_key = None
             if not video_intent:
                 break
-            # Validate YouTube links
-            youtube_links = re.findall(r'(https?://(?:www\.)?(?:youtube\.com/watch\?v=[\w-]+|youtu\.be/[\w-]+))', reply, re.IGNORECASE)
-            all_valid = True
-            for link in youtube_links:
-                if not validate_youtube_link(link):
-                    all_valid = False
-                    break
-            if all_valid:
+            # Validate YouTube links (cached per video ID, uncached ones checked concurrently)
+            if validate_youtube_links(find_youtube_links(reply)):
                 break
             if attempt < max_retries - 1:
                 logger.info(f"Invalid YouTube link detected, retrying (attempt {attempt+1}/{max_retries})")
@@ -1358,48 +2556,76 @@ def chat():
             else:
                 logger.warning(f"Max retries reached with invalid YouTube links for query: {message}")
                 reply = "Unable to find a valid video link. Try searching YouTube directly."
+                cache_key = None
+        if cache_key and reply:
+            reply_cache_put(cache_key, reply, intents)
         # Apply chunking
-        reply = '\n'.join(chunked_reply(reply))
+        with tracing.span('chunk'):
+            reply = '\n'.join(chunked_reply(reply))
         # Append to history (only after successful/ final reply)
-        history.append({"role": "user", "content": message})
-        history.append({"role": "assistant", "content": reply})
-        save_history(session_key, history)
+        commit_turn(session_key, history, message, reply)
         logger.info(f"Total time: {time.time() - start_time:.2f}s")
         return jsonify({'reply': reply}), 200, {
-            'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0',
+            'Cache-Control': NO_CACHE,
             'X-Session-ID': session_id,
             'X-Timestamp': timestamp
         }
-    except (APIError, APIConnectionError, Timeout, BadRequestError) as e:
+    except (APIError, APIConnectionError, BadRequestError) as e:
         logger.error(f"API call failed: {type(e).__name__}: {str(e)}")
         logger.debug(f"Stack trace: {traceback.format_exc()}")
         # Only use time fallback for explicit time/date intent
-        if has_time_intent(message):
+        if intents['time']:
             fallback = calculate_time_fallback(message, timestamp)
             if fallback:
                 fallback = '\n'.join(chunked_reply(fallback))
                 logger.info(f"Used fallback for time query (API failure): {fallback}")
                 # Append fallback to history
-                history.append({"role": "user", "content": message})
-                history.append({"role": "assistant", "content": fallback})
-                save_history(session_key, history)
-                return jsonify({'reply': fallback}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+                commit_turn(session_key, history, message, fallback)
+                return jsonify({'reply': fallback}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
         # For video intent on API failure, try YouTube fallback
         if video_intent:
-            video_query_match = re.search(r"(?:youtube link to|video of|song video|music video) (.+)", message, re.IGNORECASE)
-            video_query = video_query_match.group(1).strip() if video_query_match else message.strip()
-            video_info = fetch_youtube_video_link(video_query)
+            video_info = fetch_youtube_video_link(slots['video_query'])
             if video_info:
                 reply = f"Here's the link to '{video_info['title']}': {video_info['url']}"
                 reply = '\n'.join(chunked_reply(reply))
-                history.append({"role": "user", "content": message})
-                history.append({"role": "assistant", "content": reply})
-                save_history(session_key, history)
-                return jsonify({'reply': reply}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
-        return jsonify({'error': f"API call failed: {str(e)}", 'fallback': 'Sorry, I couldn\'t connect to Grok!'}), 500, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+                commit_turn(session_key, history, message, reply)
+                return jsonify({'reply': reply}), 200, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+        return jsonify({'error': f"API call failed: {str(e)}", 'fallback': 'Sorry, I couldn\'t connect to Grok!'}), 500, {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+# ------------------------------------------------------------------------------
+# App factory and worker setup
+# ------------------------------------------------------------------------------
+def create_app() -> Flask:
+    """The Flask app: gunicorn grok:app, or grok:create_app() for a fresh one. Config, the Redis pool and
+    the Lua scripts stay module-level (handlers and grok_asgi use them as grok.*); none open a socket here."""
+    logger.info("Initializing Flask app")
+    flask_app = Flask(__name__)
+    flask_app.secret_key = os.urandom(24)
+    flask_app.start_time = time.time()
+    flask_app.register_blueprint(bp)
+    return flask_app
+def init_worker() -> None:
+    """Per-worker setup after a --preload fork (gunicorn.conf.py post_fork): take the startup probe result
+    the master published and start the image job threads. Redis pools (by pid check), clients, thread
+    pools, the log listener and the metrics/trace writers already rebuild themselves per process; the
+    trace file is rotated by the master only."""
+    tracing.configure(config['trace_file'], config['trace_sample_rate'], config['trace_max_bytes'], rotate=False)
+    apply_startup_probe()
+    if config['enable_image_generation'] and config['image_job_workers'] > 0:
+        start_image_job_threads(config['image_job_workers']) # jobs queued before this worker existed get picked up too
+    logger.info(f"Worker initialised (pid: {os.getpid()}, last API success: {last_api_success or 'never'})")
+app = create_app()
+boot_step('routes')
+logger.info(f"Startup took {time.perf_counter() - BOOT_STARTED:.2f}s (pid: {os.getpid()}): " + ', '.join(f"{k} {v:.3f}s" for k, v in boot_times.items()))
 # ------------------------------------------------------------------------------
 # Main
 # ------------------------------------------------------------------------------
 if __name__ == '__main__':
+    if '--migrate-history' in sys.argv[1:]:
+        migrate_history_blobs()
+        sys.exit(0)
+    if '--image-worker' in sys.argv[1:]:
+        # Dedicated image job process (pair with image_job_workers: 0 to keep generation out of the web workers)
+        start_image_job_threads(config['image_worker_threads'])
+        threading.Event().wait()
     logger.info(f"Starting Flask server on {config['flask_host']}:{config['flask_port']}")
     app.run(host=config['flask_host'], port=config['flask_port'], debug=False)
@@ -2,7 +2,6 @@
 
 import os
 import sys
-import subprocess
 import json
 import logging
 import time
@@ -14,9 +13,10 @@ import re
 import traceback
 from datetime import datetime, timedelta, timezone
 from flask import Flask, request, jsonify
-from openai import OpenAI, APIError, APIConnectionError, Timeout
+from openai import APIError, APIConnectionError
 import openai
 import flask
+from xai_client import get_client
 
 # Configure logging early
 logging.basicConfig(
@@ -78,36 +78,6 @@ config = load_config()
 # Track last successful API call
 last_api_success = None
 
-# Install required dependencies
-def install_dependencies():
-    """Install required Python packages if not already installed."""
-    packages = ['flask>=3.0.0', 'openai>=1.0.0', 'gunicorn>=22.0']
-    logger.info("Checking dependencies")
-    try:
-        installed_packages = subprocess.check_output([sys.executable, '-m', 'pip', 'list']).decode('utf-8')
-        logger.debug(f"Installed packages:\n{installed_packages}")
-        for pkg in packages:
-            pkg_name = pkg.split('>=')[0].split('==')[0]
-            try:
-                __import__(pkg_name)
-                logger.info(f"{pkg} already installed")
-            except ImportError:
-                logger.info(f"Installing {pkg}...")
-                subprocess.check_call([sys.executable, '-m', 'pip', 'install', pkg])
-                logger.info(f"Successfully installed {pkg}")
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Dependency installation failed: {str(e)}")
-        sys.exit(1)
-
-# Install dependencies
-logger.info("Installing dependencies")
-try:
-    install_dependencies()
-except Exception as e:
-    logger.error(f"Startup failed during dependency installation: {type(e).__name__}: {str(e)}")
-    logger.debug(f"Stack trace: {traceback.format_exc()}")
-    sys.exit(1)
-
 # Initialize Flask app
 logger.info("Initializing Flask app")
 try:
@@ -137,7 +107,7 @@ def test_api_connectivity():
     global last_api_success
     logger.info("Initializing OpenAI client for connectivity test")
     try:
-        client = OpenAI(api_key=config['xai_api_key'], base_url=config['api_base_url'])
+        client = get_client(config['xai_api_key'], config['api_base_url'], config)
         logger.info("OpenAI client started")
         response = client.chat.completions.create(
             model="grok-4",
@@ -343,7 +313,7 @@ def chat():
 
     try:
         logger.info(f"Session ID: {session_id}, Timestamp: {timestamp}, Initializing OpenAI client")
-        client = OpenAI(api_key=config['xai_api_key'], base_url=config['api_base_url'])
+        client = get_client(config['xai_api_key'], config['api_base_url'], config)
         logger.info(f"Session ID: {session_id}, Timestamp: {timestamp}, OpenAI client started")
         api_start = time.time()
         nonce = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
@@ -377,7 +347,7 @@ def chat():
         logger.info(f"Session ID: {session_id}, Timestamp: {timestamp}, Total request time: {time.time() - start_time:.2f}s")
         return jsonify({'reply': reply}), 200, {'Cache-Control': 'no-store, no-cache, must-revalidate, max-age=0', 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
 
-    except (APIError, APIConnectionError, Timeout) as e:
+    except (APIError, APIConnectionError) as e:
         logger.error(f"Session ID: {session_id}, Timestamp: {timestamp}, API call failed: {type(e).__name__}: {str(e)}")
         logger.debug(f"Stack trace: {traceback.format_exc()}")
         if any(word in message.lower() for word in ['time', 'date', 'today', 'now', 'yesterday']):
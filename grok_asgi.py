@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+# Async (ASGI) server for the Grok API to be used with Eggdrop (grok.tcl)
+#
+# Same routes, intent routing and post-processing as grok.py, but each request is a
+# coroutine on an event loop, so one worker holds many in-flight upstream calls.
+#   gunicorn -w 2 -k uvicorn.workers.UvicornWorker -b 127.0.0.1:5000 grok_asgi:app
+#   uvicorn grok_asgi:app --host 127.0.0.1 --port 5000
+# The sync Flask entry point (grok:app) keeps working unchanged.
+import sys
+import json
+import time
+import uuid
+import asyncio
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from importlib.metadata import version as package_version
+import httpx
+import redis
+import redis.asyncio as aioredis
+import openai
+from openai import APIError, APIConnectionError, BadRequestError
+from quart import Quart, Response, request, jsonify, send_from_directory, g, redirect
+import grok
+from grok import (
+    config, logger, NO_CACHE, JOKE_FALLBACK, RICKROLL_URL, chunked_reply, route_message, find_youtube_links, format_cooldown,
+    build_email, build_joke_messages, build_conversation, chat_completion_kwargs, process_grok_response,
+    calculate_time_fallback, normalize_reply_text, IncrementalChunker, can_stream, sse_event, sse_from_payload,
+    reply_cache_key, reply_cache_ttl, youtube_video_id, youtube_valid_ttl, oembed_verdict,
+    sanitize_text, sample_debug, track, chat_branch, record_chat_request, METRICS_CONTENT_TYPE, turn_keys, begin_turn_args, parse_begin_turn, commit_turn_args,
+    image_job_url, image_job_view,
+)
+from xai_client import get_async_client, aclose_clients
+from prompt_budget import estimator
+import metrics
+import tracing
+
+app = Quart(__name__)
+app.start_time = time.time()
+aredis = None # redis.asyncio client, created per worker once the loop is running
+begin_turn_script = commit_turn_script = None # grok.BEGIN_TURN_LUA / COMMIT_TURN_LUA bound to aredis
+http = None # httpx.AsyncClient for plain-HTTP providers (oEmbed)
+provider_pool = None # threads for SDKs with no async API (geopy, googleapiclient, smtplib, image providers)
+
+@app.before_serving
+async def startup():
+    global aredis, http, provider_pool, begin_turn_script, commit_turn_script
+    aredis = aioredis.Redis(
+        host=config.get('redis_host', 'localhost'), port=config.get('redis_port', 6379),
+        db=config.get('redis_db', 0), decode_responses=True
+    )
+    begin_turn_script = aredis.register_script(grok.BEGIN_TURN_LUA)
+    commit_turn_script = aredis.register_script(grok.COMMIT_TURN_LUA)
+    http = httpx.AsyncClient(timeout=10.0, limits=httpx.Limits(max_connections=50, max_keepalive_connections=10))
+    provider_pool = ThreadPoolExecutor(max_workers=config['asgi_provider_threads'], thread_name_prefix='provider')
+    if config['enable_image_generation'] and config['image_job_workers'] > 0:
+        grok.start_image_job_threads(config['image_job_workers'])
+    logger.info(f"Async server ready (provider threads: {config['asgi_provider_threads']})")
+
+@app.after_serving
+async def shutdown():
+    await aclose_clients()
+    await http.aclose()
+    await aredis.aclose()
+    provider_pool.shutdown(wait=False)
+
+def get_xai_client():
+    return get_async_client(config['xai_api_key'], config['api_base_url'], config)
+
+async def run_blocking(fn, *args):
+    """Run a blocking provider call off the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(provider_pool, tracing.wrap(partial(fn, *args)))
+# ------------------------------------------------------------------------------
+# Redis (async) with the same in-memory fallbacks as grok.py
+# ------------------------------------------------------------------------------
+async def begin_turn(session_key: str, nick: str, now: float) -> dict:
+    """Async grok.begin_turn(): rate limit check-and-set, history and cooldowns in one round trip."""
+    try:
+        with track('redis'):
+            return parse_begin_turn(await begin_turn_script(keys=turn_keys(session_key, nick), args=begin_turn_args(now)))
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for begin_turn {session_key}: {str(e)}, using in-memory")
+        return grok.begin_turn_fallback(session_key, nick, now)
+async def commit_turn(session_key: str, history: deque, message: str, reply: str, limit: tuple | None = None) -> None:
+    history.append({"role": "user", "content": message})
+    history.append({"role": "assistant", "content": reply})
+    try:
+        with track('redis'):
+            await commit_turn_script(*commit_turn_args(session_key, history, limit))
+        grok.schedule_history_summary(session_key, history)
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for commit_turn {session_key}: {str(e)}, using in-memory")
+        grok.history_store[session_key] = history
+        if limit:
+            grok.limit_stores[limit[0]][limit[1]] = limit[3]
+async def reply_cache_get(key: str) -> str | None:
+    reply = None
+    try:
+        with track('redis'):
+            reply = await aredis.get(key)
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for reply cache: {str(e)}")
+    metrics.cache_lookup('reply', reply is not None)
+    return reply
+async def reply_cache_put(key: str, reply: str, intents: dict) -> None:
+    try:
+        with track('redis'):
+            await aredis.setex(key, reply_cache_ttl(intents), reply)
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for reply cache store: {str(e)}")
+# ------------------------------------------------------------------------------
+# Providers
+# ------------------------------------------------------------------------------
+async def check_youtube_link(url: str) -> bool | None:
+    try:
+        with track('youtube'):
+            resp = await http.get(config['provider_urls']['youtube_oembed'], params={'url': url, 'format': 'json'})
+        return oembed_verdict(resp.status_code, resp.json() if resp.status_code == 200 else None)
+    except (httpx.HTTPError, ValueError) as e:
+        logger.error(f"YouTube validation failed for {url}: {str(e)}")
+        return None
+async def validate_youtube_links(urls: list[str]) -> bool:
+    """Async twin of grok.validate_youtube_links(): shared ytvalid:<id> verdicts, the rest checked concurrently."""
+    by_id = {}
+    for url in urls:
+        by_id.setdefault(youtube_video_id(url) or url, url)
+    keys = list(by_id)
+    try:
+        cached = dict(zip(keys, await aredis.mget([f"ytvalid:{key}" for key in keys]))) if keys else {}
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable for YouTube validity cache: {str(e)}")
+        cached = grok.youtube_valid_cache_get(keys)
+    for key in keys:
+        metrics.cache_lookup('youtube', cached.get(key) in ('0', '1'))
+    if '0' in cached.values():
+        return False
+    pending = [key for key in keys if cached.get(key) != '1']
+    verdicts = await asyncio.gather(*(check_youtube_link(by_id[key]) for key in pending))
+    for key, valid in zip(pending, verdicts):
+        if valid is not None:
+            try:
+                await aredis.setex(f"ytvalid:{key}", youtube_valid_ttl(valid), '1' if valid else '0')
+            except redis.RedisError:
+                grok.youtube_valid_cache_put(key, valid)
+    return all(verdicts)
+# ------------------------------------------------------------------------------
+# Endpoints
+# ------------------------------------------------------------------------------
+@app.after_request
+async def record_chat_metrics(response):
+    if 'chat_start' in g:
+        record_chat_request(g.get('chat_branch', 'generic'), response.status_code, time.time() - g.chat_start)
+        if g.get('chat_streamed'): # stream_chat_reply finishes the trace when the body ends
+            trace = tracing.current()
+        else:
+            trace = tracing.finish(status=response.status_code)
+        if trace:
+            response.headers['X-Request-ID'] = trace.request_id
+    return response
+@app.route('/generate/<path:filename>')
+async def serve_image(filename):
+    return await send_from_directory(config['image_save_dir'], filename)
+@app.route('/health', methods=['GET'])
+async def health():
+    logger.info("Health check called")
+    return jsonify({'status': 'healthy'}), 200, {'Cache-Control': NO_CACHE}
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    return Response(await asyncio.to_thread(metrics.render), content_type=METRICS_CONTENT_TYPE, headers={'Cache-Control': NO_CACHE})
+@app.route('/debug', methods=['GET'])
+async def debug():
+    logger.info("Debug endpoint called")
+    try:
+        with open(config['log_file'], 'r') as f:
+            recent_logs = f.readlines()[-5:]
+    except Exception as e:
+        recent_logs = [f"Error reading log file: {str(e)}"]
+    status = {
+        'config': {k: '****' if k == 'xai_api_key' else v for k, v in config.items()},
+        'uptime': time.time() - app.start_time,
+        'python_version': sys.version,
+        'quart_version': package_version('quart'),
+        'openai_version': openai.__version__,
+        'last_api_success': grok.last_api_success if grok.last_api_success else 'Never',
+        'recent_logs': recent_logs,
+        'flask_host': config['flask_host'],
+        'flask_port': config['flask_port'],
+        'history_count': len(grok.history_store),
+        'rate_limit_count': len(grok.rate_limits),
+        'in_flight': len(asyncio.all_tasks()),
+        'reply_cache': await asyncio.to_thread(grok.reply_cache_stats),
+        'image_jobs': await run_blocking(grok.image_job_stats),
+        'startup': grok.boot_times,
+    }
+    return jsonify(status), 200, {'Cache-Control': NO_CACHE}
+@app.route('/generate-image', methods=['POST'])
+async def generate_image_endpoint():
+    start_time = time.time()
+    session_id = str(uuid.uuid4())
+    timestamp = str(time.time())
+    data = await request.get_json(silent=True) or {}
+    prompt = sanitize_text(data.get('prompt', '').strip())
+    nick = data.get('nick', 'unknown')
+    headers = {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+    logger.info(f"Image gen session: {session_id}, Timestamp: {timestamp}, Prompt: {prompt}, Nick: {nick}")
+    if not config['enable_image_generation']:
+        logger.info(f"Image generation disabled via config for session: {session_id}")
+        return jsonify({'error': 'Image generation is disabled.', 'fallback': 'Sorry, image generation is turned off!'}), 403
+    if not prompt:
+        logger.error(f"Session ID: {session_id}, No prompt provided")
+        return jsonify({'error': 'No prompt provided', 'fallback': 'Please provide a prompt!'}), 400, {'Cache-Control': NO_CACHE}
+    if prompt.lower().strip() in config['ignore_inputs']:
+        logger.info(f"Ignored non-substantive image prompt: {prompt}")
+        return jsonify({'reply': '', 'image_url': ''}), 200, headers
+    now = time.time()
+    image_key = nick
+    last = await run_blocking(grok.claim_image_cooldown, image_key, now)
+    if last is not None:
+        time_left = config['image_cooldown'] - (now - last)
+        logger.info(f"Image rate limit hit for {image_key}")
+        return jsonify({
+            'error': 'Image generation rate limited. One image per user per day.',
+            'fallback': f"Please wait {format_cooldown(time_left)} before generating another image."
+        }), 429, headers
+    try:
+        job = await run_blocking(grok.enqueue_image_job, prompt, nick, session_id)
+    except ValueError as e:
+        logger.error(f"Image prompt refused: {str(e)}")
+        await run_blocking(grok.refund_image_cooldown, image_key)
+        return jsonify({'error': f"Image generation failed: {str(e)}", 'fallback': 'Sorry, couldn\'t generate the image!'}), 500, headers
+    wait = min(float(data.get('wait') or 0), float(config['image_job_max_wait']))
+    deadline = time.time() + wait
+    while job['status'] not in grok.IMAGE_JOB_FINISHED and time.time() < deadline:
+        await asyncio.sleep(0.5)
+        job = await run_blocking(grok.get_image_job, job['job_id']) or job
+    if job['status'] == 'done':
+        logger.info(f"Total time: {time.time() - start_time:.2f}s")
+        return jsonify({'image_url': job['image_url'], 'job_id': job['job_id']}), 200, headers
+    if job['status'] == 'failed':
+        return jsonify({'error': f"Image generation failed: {job.get('error', '')}", 'fallback': 'Sorry, couldn\'t generate the image!', 'job_id': job['job_id']}), 500, headers
+    logger.info(f"Total time: {time.time() - start_time:.2f}s (image job {job['job_id']} {job['status']})")
+    return jsonify({
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'status_url': f"{config['image_host_url']}/image-jobs/{job['job_id']}",
+        'image_url': image_job_url(job['job_id'])
+    }), 202, headers
+@app.route('/image-jobs/<job_id>', methods=['GET'])
+async def image_job_status(job_id):
+    job = await run_blocking(grok.get_image_job, job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired image job'}), 404, {'Cache-Control': NO_CACHE}
+    return jsonify(image_job_view(job)), 200, {'Cache-Control': NO_CACHE}
+@app.route('/image-jobs/<job_id>', methods=['DELETE'])
+async def image_job_delete(job_id):
+    job = await run_blocking(grok.get_image_job, job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired image job'}), 404, {'Cache-Control': NO_CACHE}
+    nick = request.args.get('nick') or (await request.get_json(silent=True) or {}).get('nick')
+    if nick != job.get('nick'):
+        return jsonify({'error': 'Only the nick that asked for this image can delete it'}), 403, {'Cache-Control': NO_CACHE}
+    if job['status'] != 'done':
+        return jsonify({'error': f"Image job is {job['status']}, only finished images can be deleted"}), 409, {'Cache-Control': NO_CACHE}
+    try:
+        refs = await run_blocking(grok.remove_image_job, job)
+    except redis.RedisError as e:
+        logger.warning(f"Redis unavailable to delete image job {job_id}: {str(e)}")
+        return jsonify({'error': 'Image store unavailable, try again later'}), 503, {'Cache-Control': NO_CACHE}
+    logger.info(f"Image job {job_id} deleted by {nick} ({refs} other references to {job.get('image_file')})")
+    return jsonify({'job_id': job_id, 'status': 'deleted', 'shared_with': refs or 0}), 200, {'Cache-Control': NO_CACHE}
+@app.route('/image-jobs/<job_id>/image', methods=['GET'])
+async def image_job_image(job_id):
+    job = await run_blocking(grok.get_image_job, job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired image job'}), 404, {'Cache-Control': NO_CACHE}
+    if job['status'] == 'done':
+        return redirect(job['image_url'], code=302)
+    if job['status'] == 'failed':
+        return jsonify(image_job_view(job)), 500, {'Cache-Control': NO_CACHE}
+    if job['status'] == 'deleted':
+        return jsonify(image_job_view(job)), 410, {'Cache-Control': NO_CACHE}
+    return jsonify(image_job_view(job)), 202, {'Cache-Control': NO_CACHE, 'Retry-After': '5'}
+async def stream_chat_reply(upstream, message: str, history: deque, session_key: str, start_time: float, cache_key: str | None = None, intents: dict | None = None, trace=None):
+    tracing.resume(trace) # the view has returned; this trace ends with the stream, not the response headers
+    chunker = IncrementalChunker()
+    lines = []
+    status = 499 # client went away before the end
+    try:
+        try:
+            with tracing.span('stream'):
+                async for event in upstream:
+                    delta = event.choices[0].delta.content if event.choices else None
+                    if not delta:
+                        continue
+                    for line in chunker.feed(delta):
+                        if not lines:
+                            logger.info(f"First line streamed after {time.time() - start_time:.2f}s (session: {session_key})")
+                        lines.append(normalize_reply_text(line))
+                        yield sse_event(lines[-1])
+                for line in chunker.flush():
+                    lines.append(normalize_reply_text(line))
+                    yield sse_event(lines[-1])
+            grok.last_api_success = time.time()
+        except (APIError, APIConnectionError, BadRequestError, httpx.HTTPError) as e: # httpx: connection dropped mid-stream
+            logger.error(f"Streamed API call failed: {type(e).__name__}: {str(e)}")
+            status = 500
+            yield sse_event(json.dumps({'error': f"API call failed: {str(e)}", 'fallback': 'Sorry, I couldn\'t connect to Grok!', 'status': 500}), event='error')
+            return
+        reply = '\n'.join(lines)
+        logger.info(f"Streamed reply (len={len(reply)}, lines={len(lines)}): {reply}")
+        with tracing.span('commit'):
+            if cache_key and reply:
+                await reply_cache_put(cache_key, reply, intents)
+            await commit_turn(session_key, history, message, reply)
+        logger.info(f"Total time: {time.time() - start_time:.2f}s")
+        status = 200
+        yield sse_event(json.dumps({'status': 200}), event='done')
+    finally:
+        tracing.finish(status=status, lines=len(lines))
+@app.route('/chat/stream', methods=['GET', 'POST'])
+async def chat_stream():
+    rv = await chat(stream=True)
+    if isinstance(rv, Response) and rv.mimetype == 'text/event-stream':
+        return rv
+    resp = await app.make_response(rv)
+    events = sse_from_payload(await resp.get_json(silent=True) or {}, resp.status_code)
+    headers = {k: v for k, v in resp.headers.items() if k.startswith('X-')}
+    headers['Cache-Control'] = NO_CACHE
+    return Response(events, status=resp.status_code, mimetype='text/event-stream', headers=headers)
+@app.route('/chat', methods=['GET', 'POST'])
+async def chat(stream: bool = False):
+    start_time = g.chat_start = time.time()
+    tracing.start('chat', request.headers.get('X-Request-ID'), request.headers.get('traceparent'))
+    timestamp = str(time.time())
+    if request.method == 'GET':
+        args = request.args
+    else:
+        args = await request.get_json(silent=True) or {}
+    message = args.get('message', '')
+    nick = args.get('nick', 'unknown')
+    channel = args.get('channel', 'default')
+    session_key = f"{nick}:{channel}"
+    session_id = session_key
+    headers = {'Cache-Control': NO_CACHE, 'X-Session-ID': session_id, 'X-Timestamp': timestamp}
+    sample_debug(session_key)
+    logger.debug(f"Session key: {session_id}, Timestamp: {timestamp}, Request: {request.method} {dict(args)}")
+    if not message:
+        logger.error(f"Session ID: {session_id}, Timestamp: {timestamp}, No message provided")
+        return jsonify({'error': 'No message provided', 'fallback': 'Please provide a message!'}), 400, {'Cache-Control': NO_CACHE}
+    with tracing.span('sanitize'):
+        message = sanitize_text(message)
+    # Every /chat request is logged in this format before any branch (replay_log.py reads it back)
+    logger.info(f"Session ID: {session_id}, Timestamp: {timestamp}, Request from nick: {nick}, channel: {channel}, message: {message}")
+    with tracing.span('route'):
+        intents, slots = route_message(message)
+    g.chat_branch = chat_branch(intents)
+    tracing.annotate(session=session_key, intent=g.chat_branch, stream=stream)
+    if intents['jailbreak']:
+        logger.warning(f"Jailbreak attempt detected in chat message: {message}")
+        return jsonify({'reply': 'Invalid request'}), 400
+    if message.lower().strip() in config['ignore_inputs']:
+        logger.info(f"Ignored non-substantive input from nick: {nick}, channel: {channel}, message: {message}")
+        return jsonify({'reply': ''}), 200, headers
+    if message.lower().strip() == "clear my context":
+        try:
+            await aredis.delete(f"history:{session_key}", f"summary:{session_key}")
+        except redis.RedisError:
+            grok.history_store.pop(session_key, None)
+        logger.info(f"Cleared history for session: {session_id}")
+        return jsonify({'reply': '\n'.join(chunked_reply("Your context has been cleared."))}), 200, headers
+    now = time.time()
+    turn = await begin_turn(session_key, nick, now)
+    if not turn['allowed']:
+        logger.info(f"Rate limit hit for {session_key}")
+        return jsonify({'error': 'Rate limited. Please wait.', 'fallback': 'Please wait a few seconds before asking again!'}), 429, headers
+    history = turn['history']
+    if intents['email']:
+        email_key = nick
+        last_time = turn['email_last']
+        if last_time is not None and (now - last_time) < config['email_cooldown']:
+            logger.info(f"Email rate limit hit for {email_key} (session: {session_id})")
+            return jsonify({
+                'error': 'Email sending rate limited. One email per user per day.',
+                'fallback': f"Please wait {format_cooldown(config['email_cooldown'] - (now - last_time))} before sending another email."
+            }), 429, headers
+        to = slots['email_target']
+        if not to:
+            logger.warning(f"Email intent detected but no valid 'to' address extracted: {message}")
+            return jsonify({'reply': 'Please specify a valid email address to send to.'}), 400
+        subject, body = build_email(nick, message)
+        with tracing.span('email'):
+            email_reply = await run_blocking(grok.send_email, to, subject, body, None, session_id)
+        email_limit = ('emaillimit', email_key, config['email_cooldown'], now) if "sent successfully" in email_reply else None
+        email_reply = '\n'.join(chunked_reply(email_reply))
+        await commit_turn(session_key, history, message, email_reply, email_limit)
+        logger.info(f"Total time for email: {time.time() - start_time:.2f}s")
+        return jsonify({'reply': email_reply}), 200, headers
+    if intents['joke']:
+        try:
+            with track('xai'):
+                response = await get_xai_client().chat.completions.create(
+                    model="grok-3",
+                    messages=build_joke_messages(history),
+                    temperature=0.9,
+                    max_tokens=50,
+                    timeout=config['api_timeout']
+                )
+            metrics.tokens(response.usage)
+            reply = response.choices[0].message.content.strip()
+            logger.info(f"Generated NSFW joke: {reply}")
+        except (APIError, APIConnectionError, BadRequestError) as e:
+            logger.error(f"Joke API call failed: {type(e).__name__}: {str(e)}")
+            reply = JOKE_FALLBACK
+        reply = '\n'.join(chunked_reply(reply))
+        await commit_turn(session_key, history, message, reply)
+        return jsonify({'reply': reply}), 200, headers
+    if intents['weather']:
+        with tracing.span('weather'):
+            weather_reply = await run_blocking(grok.get_weather, slots['location'], session_id, slots['weather_span'])
+        if weather_reply:
+            weather_reply = '\n'.join(chunked_reply(weather_reply))
+            await commit_turn(session_key, history, message, weather_reply)
+            return jsonify({'reply': weather_reply}), 200, headers
+        logger.info(f"Weather offload failed; falling back to Grok for: {message}")
+    if intents['image']:
+        if not config['enable_image_generation']:
+            logger.info(f"Image intent detected but disabled via config: {message}")
+            return jsonify({'reply': 'Image generation is disabled.'}), 200
+        logger.info(f"Detected image intent in message: {message}. Routing to image generation.")
+        prompt = slots['image_prompt']
+        if prompt.lower().strip() in config['ignore_inputs']:
+            logger.info(f"Ignored non-substantive image prompt from chat: {prompt}")
+            return jsonify({'reply': '', 'image_url': ''}), 200, headers
+        image_key = nick
+        last_time = await run_blocking(grok.claim_image_cooldown, image_key, now) # begin_turn only serializes this nick:channel
+        if last_time is not None:
+            logger.info(f"Image rate limit hit for {image_key}")
+            return jsonify({
+                'error': 'Image generation rate limited. One image per user per day.',
+                'fallback': f"Please wait {format_cooldown(config['image_cooldown'] - (now - last_time))} before generating another image."
+            }), 429, headers
+        job = None
+        try:
+            with tracing.span('image'):
+                job = await run_blocking(grok.enqueue_image_job, prompt, nick, session_id)
+        except Exception as e:
+            logger.error(f"Image gen in chat failed: {type(e).__name__}: {str(e)}")
+            await run_blocking(grok.refund_image_cooldown, image_key)
+        if job:
+            image_url = image_job_url(job['job_id'])
+            reply = '\n'.join(chunked_reply(f"Generating your image, it'll be here shortly: {image_url}"))
+            await commit_turn(session_key, history, message, reply)
+            logger.info(f"Total time: {time.time() - start_time:.2f}s")
+            return jsonify({'reply': reply, 'image_url': image_url, 'job_id': job['job_id']}), 200, headers
+    if intents['rickroll']:
+        if await validate_youtube_links([RICKROLL_URL]):
+            reply = f"Here's a cracking funny video for you: {RICKROLL_URL}"
+        else:
+            reply = "Unable to get real-time results."
+        reply = '\n'.join(chunked_reply(reply))
+        await commit_turn(session_key, history, message, reply)
+        return jsonify({'reply': reply}), 200, headers
+    video_intent = intents['video']
+    if video_intent:
+        logger.info(f"Detected video/YouTube intent in message: {message}. Using YouTube API.")
+        with tracing.span('video'):
+            video_info = await run_blocking(grok.fetch_youtube_video_link, slots['video_query'])
+        if video_info:
+            reply = '\n'.join(chunked_reply(f"Here's the link to '{video_info['title']}': {video_info['url']}"))
+            await commit_turn(session_key, history, message, reply)
+            logger.info(f"Total time: {time.time() - start_time:.2f}s")
+            return jsonify({'reply': reply}), 200, headers
+        logger.warning("YouTube API failed; falling back to Grok model.")
+    try:
+        with tracing.span('prompt'):
+            conversation, search_params = build_conversation(message, history, session_id, timestamp, intents, slots, turn['summary'])
+    except Exception as e:
+        logger.error(f"Prompt generation failed: {type(e).__name__}: {str(e)}")
+        logger.debug(f"Stack trace: {traceback.format_exc()}")
+        return jsonify({'error': f"Prompt generation failed: {str(e)}", 'fallback': 'Sorry, I couldn\'t process that!'}), 500, {'Cache-Control': NO_CACHE}
+    if search_params:
+        logger.info(f"Live Search enabled for query: {message} (video_intent={video_intent})")
+    cache_key = reply_cache_key(message, intents, search_params)
+    cached = await reply_cache_get(cache_key) if cache_key else None
+    if cached:
+        reply = '\n'.join(chunked_reply(cached))
+        await commit_turn(session_key, history, message, reply)
+        logger.info(f"Reply cache hit for {session_id} ({cache_key}), total time: {time.time() - start_time:.2f}s")
+        return jsonify({'reply': reply}), 200, headers
+    try:
+        client = get_xai_client()
+        if stream and can_stream(intents):
+            with track('xai'):
+                upstream = await client.chat.completions.create(stream=True, **chat_completion_kwargs(conversation, search_params, session_id, timestamp))
+            g.chat_streamed = True
+            return Response(stream_chat_reply(upstream, message, history, session_key, start_time, cache_key, intents, tracing.current()), mimetype='text/event-stream',
+                            headers={**headers, 'X-Accel-Buffering': 'no'})
+        max_retries = 3
+        reply = None
+        for attempt in range(max_retries):
+            api_start = time.time()
+            with track('xai'):
+                response = await client.chat.completions.create(**chat_completion_kwargs(conversation, search_params, session_id, timestamp))
+            grok.last_api_success = time.time()
+            logger.debug(f"API call took {time.time() - api_start:.2f}s")
+            metrics.tokens(response.usage)
+            if response.usage:
+                estimator.calibrate(conversation, response.usage.prompt_tokens)
+            with tracing.span('postprocess'):
+                reply = process_grok_response(response, message, timestamp)
+            logger.info(f"Reply (len={len(reply)}): {reply}")
+            if video_intent and ('copyright' in reply.lower() or 'cannot provide' in reply.lower()):
+                logger.warning(f"Video query refused (possible copyright guardrail): {reply}")
+                reply += " (Fallback: Try searching YouTube directly for official videos.)"
+                cache_key = None
+            if not video_intent:
+                break
+            # Validate every link in the reply concurrently
+            if await validate_youtube_links(find_youtube_links(reply)):
+                break
+            if attempt < max_retries - 1:
+                logger.info(f"Invalid YouTube link detected, retrying (attempt {attempt+1}/{max_retries})")
+                conversation.append({"role": "assistant", "content": reply})
+                conversation.append({"role": "user", "content": "The link is invalid. Use search to find a real YouTube link."})
+            else:
+                logger.warning(f"Max retries reached with invalid YouTube links for query: {message}")
+                reply = "Unable to find a valid video link. Try searching YouTube directly."
+                cache_key = None
+        if cache_key and reply:
+            await reply_cache_put(cache_key, reply, intents)
+        with tracing.span('chunk'):
+            reply = '\n'.join(chunked_reply(reply))
+        await commit_turn(session_key, history, message, reply)
+        logger.info(f"Total time: {time.time() - start_time:.2f}s")
+        return jsonify({'reply': reply}), 200, headers
+    except (APIError, APIConnectionError, BadRequestError) as e:
+        logger.error(f"API call failed: {type(e).__name__}: {str(e)}")
+        logger.debug(f"Stack trace: {traceback.format_exc()}")
+        if intents['time']:
+            fallback = calculate_time_fallback(message, timestamp)
+            if fallback:
+                fallback = '\n'.join(chunked_reply(fallback))
+                logger.info(f"Used fallback for time query (API failure): {fallback}")
+                await commit_turn(session_key, history, message, fallback)
+                return jsonify({'reply': fallback}), 200, headers
+        if video_intent:
+            video_info = await run_blocking(grok.fetch_youtube_video_link, slots['video_query'])
+            if video_info:
+                reply = '\n'.join(chunked_reply(f"Here's the link to '{video_info['title']}': {video_info['url']}"))
+                await commit_turn(session_key, history, message, reply)
+                return jsonify({'reply': reply}), 200, headers
+        return jsonify({'error': f"API call failed: {str(e)}", 'fallback': 'Sorry, I couldn\'t connect to Grok!'}), 500, headers
+# ------------------------------------------------------------------------------
+# Main
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import uvicorn
+    logger.info(f"Starting async server on {config['flask_host']}:{config['flask_port']}")
+    uvicorn.run(app, host=config['flask_host'], port=config['flask_port'])
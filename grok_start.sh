@@ -1,7 +1,7 @@
 #!/bin/bash
 
 # Script to start Grok Flask API via Gunicorn
-# Usage: ./grok_start.sh
+# Usage: ./grok_start.sh (or GROK_ASYNC=1 ./grok_start.sh for the async server)
 # Stop: kill $(cat /tmp/grok.pid) or use echoed PID
 
 SCRIPT_DIR="$(dirname "$0")"
@@ -19,8 +19,15 @@ source "$VENV_DIR/bin/activate"
 # cd to script dir
 cd "$SCRIPT_DIR" || { echo "Error: Failed to cd to $SCRIPT_DIR"; exit 1; }
 
-# Run Gunicorn in background
-gunicorn -w 4 -b 127.0.0.1:5000 xaiChatApi:app \
+# Run Gunicorn in background (GROK_ASYNC=1 ./grok_start.sh serves the async app, grok_asgi.py)
+if [ "${GROK_ASYNC:-0}" = "1" ]; then
+    APP="grok_asgi:app"
+    WORKER_ARGS="-w 2 -k uvicorn.workers.UvicornWorker"
+else
+    APP="xaiChatApi:app"
+    WORKER_ARGS="-w 4"
+fi
+gunicorn $WORKER_ARGS -b 127.0.0.1:5000 $APP \
     --log-file "$LOG_DIR/gunicorn.log" \
     --access-logfile "$LOG_DIR/gunicorn_access.log" \
     --log-level debug &
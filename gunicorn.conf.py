@@ -0,0 +1,83 @@
+# Gunicorn settings for the Grok Flask API (picked up automatically from this directory)
+#
+#   gunicorn grok:app
+#   gunicorn -k uvicorn.workers.UvicornWorker -w 2 grok_asgi:app
+#
+# For grok.py and grok_asgi.py the app is imported once in the master (preload_app) and forked, so
+# workers share its memory and a recycled worker (max_requests) starts without re-importing anything.
+# post_fork gives each worker its own connections. The xAI startup probe runs once, in the master,
+# before the first fork, bounded by GROK_PROBE_TIMEOUT (5s); its result reaches the workers through
+# the GROK_STARTUP_PROBE environment variable. Other apps (xaiChatApi:app, grok4:app) get only the
+# plain settings below.
+import os
+import sys
+import json
+import time
+import shlex
+import threading
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+PROBE_ENV = 'GROK_STARTUP_PROBE' # grok.STARTUP_PROBE_ENV
+GROK_APPS = ('grok', 'grok_asgi')
+PROBE_TIMEOUT = float(os.getenv('GROK_PROBE_TIMEOUT', 5)) # one attempt; workers stall until it returns
+TRACE_ROTATE_INTERVAL = 30 # seconds between the master's trace_file size checks
+
+def _app_module() -> str:
+    """Module of the APP_MODULE gunicorn was started with, e.g. 'grok' for grok:app."""
+    from gunicorn.config import Config
+    argv = shlex.split(os.getenv('GUNICORN_CMD_ARGS', '')) + sys.argv[1:]
+    apps = Config().parser().parse_known_args(argv)[0].args
+    return apps[-1].split(':')[0] if apps else ''
+
+GROK_APP = _app_module() in GROK_APPS
+
+bind = os.getenv('GROK_BIND', '127.0.0.1:5000')
+workers = int(os.getenv('GROK_WORKERS', 4))
+preload_app = GROK_APP
+timeout = 60
+max_requests = 500
+max_requests_jitter = 50
+
+if GROK_APP:
+    # Set before the app is imported, so a preloaded grok.py leaves the probe to when_ready()
+    os.environ[PROBE_ENV] = json.dumps({'pending': True})
+
+def _rotate_traces(server, tracing):
+    while True:
+        time.sleep(TRACE_ROTATE_INTERVAL)
+        try:
+            if tracing.rotate():
+                server.log.info("Rotated trace file")
+        except OSError as e:
+            server.log.warning(f"Trace file rotation failed: {type(e).__name__}: {str(e)}")
+
+def when_ready(server):
+    """Master, app loaded, no workers yet: run the startup probe once and publish the result."""
+    if not GROK_APP: # another app (xaiChatApi.py, grok4.py) runs its own test
+        return
+    tracing = sys.modules.get('tracing')
+    if tracing is not None: # preloaded: workers append to trace_file, the master alone rotates it
+        threading.Thread(target=_rotate_traces, args=(server, tracing), name='trace-rotate', daemon=True).start()
+    try:
+        with open(os.path.join(APP_DIR, 'config.json')) as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        server.log.warning(f"Startup probe skipped, config.json unreadable: {str(e)}")
+        os.environ[PROBE_ENV] = json.dumps({'ok': None, 'skipped': True})
+        return
+    if not config.get('run_startup_test'):
+        server.log.info("Startup API connectivity test disabled in config")
+        os.environ[PROBE_ENV] = json.dumps({'ok': None, 'skipped': True})
+        return
+    from xai_client import probe
+    result = probe(os.getenv('XAI_API_KEY', config.get('xai_api_key', '')), config['api_base_url'], PROBE_TIMEOUT, attempts=1)
+    os.environ[PROBE_ENV] = json.dumps(result)
+    server.log.info(f"Startup probe {'ok' if result['ok'] else 'failed: ' + str(result.get('error'))}; published to workers")
+
+def post_fork(server, worker):
+    grok = sys.modules.get('grok')
+    if GROK_APP and grok is not None: # preloaded: this worker is a fork of the master's import
+        grok.init_worker()
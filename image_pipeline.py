@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Image renditions for the Grok Flask API (grok.py, grok_asgi.py)
+#
+# Provider images arrive at full resolution (often 1-2 MB). For each saved original, render() writes an
+# optimized copy for the links sent to IRC (web/<name>.webp or .jpg) and a small thumbnail for the
+# generate.php gallery (thumbs/<name>.webp or .jpg), next to the original in image_save_dir, and returns
+# the bytes and pixel size of each. It runs in grok.py's process pool, since resizing and encoding hold
+# the GIL for hundreds of milliseconds. Files are written under a temporary name and renamed into place.
+#
+#   python3 image_pipeline.py /var/www/html/generate              # backfill images saved before renditions
+#   python3 image_pipeline.py /var/www/html/generate --format jpeg --thumb 200
+import os
+import sys
+import time
+import argparse
+import threading
+
+WEB_DIR = 'web'
+THUMB_DIR = 'thumbs'
+EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+def watch_parent() -> None:
+    """Pool initializer: exit when the worker that started this process is gone (killed on a gunicorn
+    timeout, say), instead of lingering with its memory and inherited sockets."""
+    parent = os.getppid()
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(2)
+        os._exit(0)
+    threading.Thread(target=watch, name='parent-watch', daemon=True).start()
+
+def rendition_name(filename: str, kind: str, fmt: str = 'webp') -> str:
+    """Path of a rendition relative to image_save_dir, e.g. thumbs/grok_img_cat.webp"""
+    return f"{WEB_DIR if kind == 'web' else THUMB_DIR}/{os.path.splitext(filename)[0]}.{EXTENSIONS[fmt]}"
+
+def _save(image, path: str, fmt: str, quality: int) -> int:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if fmt == 'jpeg':
+        image.convert('RGB').save(tmp_path, format='JPEG', quality=quality, optimize=True, progressive=True)
+    else:
+        image.save(tmp_path, format='WEBP', quality=quality, method=4)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+def render(save_dir: str, filename: str, fmt: str = 'webp', web_max: int = 1024, thumb_max: int = 256, quality: int = 80) -> dict:
+    """Write the web rendition and thumbnail of save_dir/filename; returns {kind: {file, bytes, width, height}}.
+    The web rendition is skipped (and 'web' points at the original) when it wouldn't be smaller."""
+    from PIL import Image, ImageOps
+    path = os.path.join(save_dir, filename)
+    result = {'original': {'file': filename, 'bytes': os.path.getsize(path)}}
+    with Image.open(path) as opened:
+        image = ImageOps.exif_transpose(opened) # first frame only for animated GIFs
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+        result['original'].update(width=image.width, height=image.height)
+        for kind, max_px in (('web', web_max), ('thumb', thumb_max)):
+            copy = image.copy()
+            copy.thumbnail((max_px, max_px), Image.LANCZOS)
+            name = rendition_name(filename, kind, fmt)
+            os.makedirs(os.path.join(save_dir, os.path.dirname(name)), exist_ok=True)
+            size = _save(copy, os.path.join(save_dir, name), fmt, quality)
+            result[kind] = {'file': name, 'bytes': size, 'width': copy.width, 'height': copy.height}
+    if result['web']['bytes'] >= result['original']['bytes']:
+        os.remove(os.path.join(save_dir, result['web']['file']))
+        result['web'] = dict(result['original'])
+    return result
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Render web copies and thumbnails for saved images")
+    parser.add_argument('save_dir', help="image_save_dir from config.json")
+    parser.add_argument('--format', choices=sorted(EXTENSIONS), default='webp')
+    parser.add_argument('--web', type=int, default=1024, help="longest side of the web rendition, px")
+    parser.add_argument('--thumb', type=int, default=256, help="longest side of the thumbnail, px")
+    parser.add_argument('--quality', type=int, default=80)
+    parser.add_argument('--force', action='store_true', help="redo images that already have a thumbnail")
+    args = parser.parse_args()
+    before = after = 0
+    for filename in sorted(os.listdir(args.save_dir)):
+        if filename.startswith('.') or not os.path.isfile(os.path.join(args.save_dir, filename)):
+            continue
+        if not args.force and os.path.exists(os.path.join(args.save_dir, rendition_name(filename, 'thumb', args.format))):
+            continue
+        try:
+            result = render(args.save_dir, filename, args.format, args.web, args.thumb, args.quality)
+        except Exception as e: # not an image, or one Pillow can't read
+            print(f"skip {filename}: {type(e).__name__}: {e}")
+            continue
+        before += result['original']['bytes']
+        after += result['web']['bytes']
+        print(f"{filename}: {result['original']['bytes']} -> {result['web']['bytes']} bytes, thumb {result['thumb']['bytes']}")
+    if before:
+        print(f"Web renditions: {after} of {before} bytes ({100 * after / before:.1f}%)")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,14 +8,17 @@ def install_dependencies():
     packages = [
         'flask>=3.0.0',
         'openai>=1.0.0',
+        'httpx>=0.24.0', # Pooled transport for the shared xAI client (xai_client.py)
         'gunicorn>=22.0.0',
+        'quart>=0.19.0', # Async serving mode (grok_asgi.py)
+        'uvicorn>=0.30.0', # ASGI server / gunicorn worker class for grok_asgi.py
         'requests>=2.31.0',
         'bleach>=6.1.0',
         'geopy>=2.4.0', # For geocoding in weather
         'cachetools>=5.3.0', # For TTL caches
         'redis>=5.0.0', # For shared state in prod
         'huggingface-hub>=0.23.0', # For HF image gen
-        'Pillow>=10.0.0', # For image handling in huggingface_hub
+        'Pillow>=10.0.0', # Image renditions (image_pipeline.py), huggingface_hub
         'stability-sdk>=0.1.0',  # For Stability AI image gen
         'google-api-python-client>=2.0.0'  # For YouTube API integration
     ]
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Message intent router for the Grok Flask API (grok.py, grok_asgi.py)
+#
+# Every /chat message used to be lowercased and re-scanned by one re.search per pattern per
+# intent (plus the keyword lists). route_message() lowercases once, finds every trigger word
+# in a single scan, and only runs the precompiled pattern of an intent whose trigger showed up;
+# slots (location, forecast span, news country, image prompt, video query, email target) are
+# pulled out only for the intents that fired. bench_intents.py compares it against the old per-pattern checks.
+import re
+
+# ------------------------------------------------------------------------------
+# Intent patterns
+# ------------------------------------------------------------------------------
+TIME_PATTERNS = [
+    r"\bwhat(?:'s|\s+is)?\s+(?:the\s+)?time\b", # what's the time
+    r"\bwhat(?:'s|\s+is)?\s+(?:the\s+)?time\s+(?:in|for)\s+.+", # what's the time in/for X
+    r"\b(?:current|local)\s+time\b", # current time / local time
+    r"\btime\s+(?:right\s+)?now\b", # time now / time right now
+    r"^\s*now\??\s*$", # "now?"
+    r"\bwhat(?:'s|\s+is)?\s+(?:the\s+)?date\b", # what's the date
+    r"\btoday'?s?\s+date\b", # today's date
+    r"\bdate\s+today\b", # date today
+    r"\bwhat\s+day\s+is\s+it\b", # what day is it
+    r"\bday\s+of\s+week\b", # day of week
+    r"\byesterday\b", # yesterday
+    r"\btime\s+(?:in|for)\s+.+", # time in/for X
+]
+WEATHER_PATTERNS = [
+    r"\bweather\b", r"\bforecast\b", r"\btemperature\b", r"\brain\b",
+    r"\bsnow(?:ing)?\b",
+    r"\bwhat(?:'s|\s+is)?\s+(?:the\s+)?weather\b",
+    r"\bweather\s+(?:in|for)\s+.+",
+]
+IMAGE_INTENT_PATTERNS = [
+    r"\b(generate|create|draw|make)\s+(?:an?\s+)?image\b",
+    r"\bimage\s+of\s+(?!my|your|his|her|our|their|this|that\b)",
+    r"\bpicture\s+of\s+(?!my|your|his|her|our|their|this|that\b)",
+    r"\bgenerate\s+(?:art|illustration|photo|graphic)\b",
+    r"\bdraw\s+me\b",
+]
+VIDEO_INTENT_PATTERNS = [
+    r"\byoutube\s+link\b",
+    r"\bvideo\s+(?:of|for|to)\b",
+    r"\blink\s+to\s+(?:youtube|video)\b",
+    r"\b(?:give|find|share|play|watch)\s+(?:me\s+)?a\s+(?:youtube|video)\s+link\b",
+    r"\bsong\s+(?:video|link)\b",
+    r"\bmusic\s+video\b",
+    r"\bfunny\s+video\b"
+]
+EMAIL_PATTERNS = [
+    r"\bsend\s+(?:an?\s+)?email\b",
+    r"\bping\s+.+@.+\b",
+    r"\bcontact\s+ceo\b"
+]
+NEWS_PATTERNS = [
+    r"\bnews\b",
+    r"\b(give|tell|what's|what is) (?:me )?(?:the )?news\b",
+    r"\bnews (?:for|in|about) (.+)\b",
+    r"\bheadlines\b",
+    r"\btop stories\b",
+    r"\bcurrent events\b",
+    r"\bbreaking news\b"
+]
+# Plain substring checks
+JAILBREAK_KEYWORDS = ['ignore', 'override', 'prompt', 'instructions', 'jailbreak', 'developer mode']
+# Keywords that switch on Live Search for real-time news/music etc
+SEARCH_KEYWORDS = ['weather', 'death', 'died', 'recent', 'news', 'what happened', 'update', 'breaking', 'today', 'happening', 'current events', 'youtube', 'video', 'link', 'song', 'music', 'clip', 'president', 'who']
+JOKE_KEYWORDS = ['joke']
+RICKROLL_KEYWORDS = ['funny video', 'rickroll']
+# ------------------------------------------------------------------------------
+# Compiled router tables
+# ------------------------------------------------------------------------------
+def _any_of(patterns: list[str]) -> re.Pattern:
+    return re.compile('|'.join(f"(?:{p})" for p in patterns), re.IGNORECASE)
+_INTENT_RES = {
+    'time': _any_of(TIME_PATTERNS),
+    'weather': _any_of(WEATHER_PATTERNS),
+    'image': _any_of(IMAGE_INTENT_PATTERNS),
+    'video': _any_of(VIDEO_INTENT_PATTERNS),
+    'email': _any_of(EMAIL_PATTERNS),
+    'news': _any_of(NEWS_PATTERNS),
+}
+# Literal text every pattern of an intent needs; no trigger in the message, no regex run
+_INTENT_TRIGGERS = {
+    'time': ['time', 'now', 'date', 'day'],
+    'weather': ['weather', 'forecast', 'temperature', 'rain', 'snow'],
+    'image': ['image', 'picture', 'generate', 'draw'],
+    'video': ['youtube', 'video', 'song'],
+    'email': ['email', '@', 'ceo'],
+    'news': ['news', 'headlines', 'stories', 'events'],
+}
+# Keyword flags are decided by the trigger scan alone
+_KEYWORD_FLAGS = {
+    'jailbreak': JAILBREAK_KEYWORDS,
+    'search': SEARCH_KEYWORDS,
+    'joke': JOKE_KEYWORDS,
+    'rickroll': RICKROLL_KEYWORDS,
+}
+_SNOW_RE = re.compile(r"\bsnow(?:ing)?\b")
+_SNOW_CONTEXT_RE = re.compile(r"\b(in|for|today|tomorrow|now|outside)\b")
+def _build_trigger_table() -> dict[str, frozenset]:
+    """Map each literal to every intent/keyword flag whose literal it contains, so overlaps ('snow' holds 'now') count for both."""
+    owners = {}
+    for name, words in list(_INTENT_TRIGGERS.items()) + list(_KEYWORD_FLAGS.items()):
+        for word in words:
+            owners.setdefault(word, set()).add(name)
+    return {word: frozenset(name for other, names in owners.items() if other in word for name in names) for word in owners}
+_TRIGGER_OWNERS = _build_trigger_table()
+# Zero-width lookahead so overlapping triggers are all seen; longest first so a hit covers its substrings
+_TRIGGER_RE = re.compile('(?=(' + '|'.join(re.escape(w) for w in sorted(_TRIGGER_OWNERS, key=len, reverse=True)) + '))')
+# ------------------------------------------------------------------------------
+# Slot extraction
+# ------------------------------------------------------------------------------
+_LOC_RE = re.compile(r"\b(?:time|weather)\s+(?:in|for)\s+([^,]+(?:,\s*[a-zA-Z]+)?)(?=\s*(tomorrow|today|yesterday|this week|next week|$))", re.IGNORECASE)
+# News location extraction
+_LOC_NEWS_RE = re.compile(r"\b(?:give me the )?news\s+(?:for\s+(?:the\s+)?|in\s+)?(.+?)(?:\s+please)?\b", re.IGNORECASE)
+_NEWS_COUNTRY_MAP = {
+    'uk': 'UK', 'united kingdom': 'UK', 'britain': 'UK', 'great britain': 'UK',
+    'us': 'US', 'usa': 'US', 'united states': 'US', 'america': 'US'
+}
+# Which slice of a forecast a weather question wants; None is the provider's usual reply
+_WEATHER_SPAN_RES = [
+    ('tomorrow', re.compile(r"\btomorrow\b")),
+    ('week', re.compile(r"\b(?:7|seven)[\s-]*days?\b|\bweek(?:ly|'s)?\b|\bweekend\b")),
+]
+_TRAILING_PUNCT_RE = re.compile(r"[?.!,;:\s]+$")
+_EMAIL_TO_RE = re.compile(r"\b(?:send\s+(?:an?\s+)?email\s+to|ping|contact)\s+([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})\b", re.IGNORECASE)
+_IMAGE_PROMPT_RE = re.compile(r"(?:generate|create|draw|make)\s+(?:an?\s+)?(?:image|picture|art|illustration|photo|graphic)\s+(?:of\s+)?(.+)", re.IGNORECASE)
+_VIDEO_QUERY_RE = re.compile(r"(?:link to|video of|song video|music video|give me a link to|give me a youtube link to)\s+(.+)", re.IGNORECASE)
+def extract_news_location(q: str) -> str | None:
+    """Pull 'X' out of phrases like 'news for/in X'."""
+    m = _LOC_NEWS_RE.search(q or "")
+    if not m:
+        return None
+    loc = _TRAILING_PUNCT_RE.sub("", m.group(1).strip().lower())
+    # Map common names to standard
+    return _NEWS_COUNTRY_MAP.get(loc, loc.title()) if loc else None
+def extract_location(q: str) -> str | None:
+    """Pull 'X' out of phrases like 'time/weather in X' or 'for X'."""
+    m = _LOC_RE.search(q or "")
+    if not m:
+        return None
+    loc = _TRAILING_PUNCT_RE.sub("", m.group(1).strip().lower())
+    return loc if loc else None
+def extract_weather_span(q: str) -> str | None:
+    """'tomorrow', 'week' (7-day) or None for current conditions."""
+    lower = (q or "").lower()
+    return next((span for span, span_re in _WEATHER_SPAN_RES if span_re.search(lower)), None)
+def extract_email_target(message: str) -> str | None:
+    """'send an email to jordan@boxlabs.co.uk' -> 'jordan@boxlabs.co.uk'"""
+    m = _EMAIL_TO_RE.search(message)
+    return m.group(1).strip() if m else None
+def extract_image_prompt(message: str) -> str:
+    """Take everything after 'generate image of' or similar; the whole message otherwise."""
+    m = _IMAGE_PROMPT_RE.search(message)
+    return m.group(1).strip() if m else message.strip()
+def extract_video_query(message: str) -> str:
+    m = _VIDEO_QUERY_RE.search(message)
+    return m.group(1).strip() if m else message.strip()
+# ------------------------------------------------------------------------------
+# Router
+# ------------------------------------------------------------------------------
+def _triggered(lower: str) -> set:
+    names = set()
+    for m in _TRIGGER_RE.finditer(lower):
+        names |= _TRIGGER_OWNERS[m.group(1)]
+    return names
+def _matches(name: str, lower: str, triggered: set) -> bool:
+    if name not in triggered or not _INTENT_RES[name].search(lower):
+        return False
+    if name == 'weather' and _SNOW_RE.search(lower) and not _SNOW_CONTEXT_RE.search(lower):
+        return False # "snow" alone isn't a weather question
+    return True
+def route_message(message: str) -> tuple[dict, dict]:
+    """Intent flags and extracted slots for a chat message, from one normalization and one trigger scan."""
+    lower = (message or "").strip().lower()
+    triggered = _triggered(lower)
+    video = _matches('video', lower, triggered)
+    intents = {
+        'jailbreak': 'jailbreak' in triggered,
+        'email': _matches('email', lower, triggered),
+        'joke': 'joke' in triggered,
+        'weather': _matches('weather', lower, triggered),
+        'image': _matches('image', lower, triggered),
+        'video': video,
+        'rickroll': video and 'rickroll' in triggered,
+        'news': _matches('news', lower, triggered),
+        'search': 'search' in triggered,
+        'time': _matches('time', lower, triggered),
+    }
+    # Case-preserving slots come from the original text, the rest from the lowered copy
+    slots = {
+        'location': extract_location(lower) if intents['weather'] or intents['time'] else None,
+        'weather_span': extract_weather_span(lower) if intents['weather'] else None,
+        'news_country': extract_news_location(lower) if intents['news'] else None,
+        'image_prompt': extract_image_prompt(message) if intents['image'] else None,
+        'video_query': extract_video_query(message) if video else None,
+        'email_target': extract_email_target(message) if intents['email'] else None,
+    }
+    return intents, slots
+CHAT_BRANCHES = ('email', 'joke', 'weather', 'image', 'video', 'news', 'time') # metrics label, in chat() dispatch order
+def chat_branch(intents: dict) -> str:
+    return next((name for name in CHAT_BRANCHES if intents.get(name)), 'generic')
+def has_intent(name: str, msg: str) -> bool:
+    """Single-intent check ('time', 'weather', 'image', 'video', 'email', 'news')."""
+    lower = (msg or "").strip().lower()
+    return _matches(name, lower, _triggered(lower))
+def has_time_intent(msg: str) -> bool:
+    return has_intent('time', msg)
+def has_weather_intent(msg: str) -> bool:
+    return has_intent('weather', msg)
+def has_image_intent(msg: str) -> bool:
+    return has_intent('image', msg)
+def has_video_intent(msg: str) -> bool:
+    return has_intent('video', msg)
+def has_email_intent(msg: str) -> bool:
+    return has_intent('email', msg)
+def has_news_intent(msg: str) -> bool:
+    return has_intent('news', msg)
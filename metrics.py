@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# Prometheus-style metrics for the Grok Flask API (grok.py, grok_asgi.py)
+#
+# Each worker counts into a local buffer (no Redis round trip on the request path); a background
+# thread adds the buffer to one Redis hash every few seconds, so /metrics on any worker reports
+# the totals of every worker and node sharing that Redis. Without Redis the buffer just keeps
+# growing locally and /metrics shows this worker's own numbers.
+import os
+import re
+import time
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY = 'metrics:grok'
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# name -> (type, help); histograms use LATENCY_BUCKETS
+METRICS = {
+    'grok_chat_requests_total': ('counter', "/chat requests by intent branch and HTTP status"),
+    'grok_chat_request_seconds': ('histogram', "/chat time to response by intent branch"),
+    'grok_dependency_seconds': ('histogram', "Upstream call latency by dependency"),
+    'grok_dependency_errors_total': ('counter', "Upstream calls that raised, by dependency"),
+    'grok_cache_lookups_total': ('counter', "Cache lookups by cache"),
+    'grok_cache_hits_total': ('counter', "Cache hits by cache"),
+    'grok_tokens_total': ('counter', "Tokens reported by the xAI API, by kind (prompt/completion)"),
+    'grok_image_jobs_total': ('counter', "Image jobs by status (queued, then done or failed)"),
+    'grok_image_job_seconds': ('histogram', "Image job time from queueing to finish, by outcome"),
+    'grok_image_bytes_total': ('counter', "Bytes of generated images saved, by rendition (original, web, thumb)"),
+}
+_SERIES_RE = re.compile(r'^([a-z_]+)(\{.*\})?$')
+_pending = {} # series -> value not yet added to Redis
+_lock = threading.Lock()
+_owner_pid = os.getpid()
+_flush_thread = None
+_redis = None
+_flush_interval = 5.0
+
+def _reset_after_fork() -> None:
+    global _lock, _owner_pid, _flush_thread
+    _pending.clear()
+    _lock = threading.Lock()
+    _owner_pid = os.getpid()
+    _flush_thread = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def configure(redis_client, flush_interval: float = 5.0) -> None:
+    """Aggregate through redis_client, flushing every flush_interval seconds (0: only when /metrics renders)."""
+    global _redis, _flush_interval
+    _redis = redis_client
+    _flush_interval = float(flush_interval)
+
+def _series(name: str, labels: dict | None) -> str:
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{str(v)}"' for k, v in sorted(labels.items())) + '}'
+
+def _add(series: str, amount: float) -> None:
+    global _flush_thread
+    if os.getpid() != _owner_pid:
+        _reset_after_fork()
+    with _lock:
+        _pending[series] = _pending.get(series, 0) + amount
+        if _flush_thread is None and _redis is not None and _flush_interval > 0:
+            _flush_thread = threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True)
+            _flush_thread.start()
+
+def inc(name: str, labels: dict | None = None, amount: float = 1) -> None:
+    _add(_series(name, labels), amount)
+
+def observe(name: str, value: float, labels: dict | None = None) -> None:
+    """Record one histogram sample (cumulative buckets, _sum and _count)."""
+    labels = labels or {}
+    for bound in LATENCY_BUCKETS:
+        if value <= bound:
+            _add(_series(f"{name}_bucket", {**labels, 'le': bound}), 1)
+    _add(_series(f"{name}_bucket", {**labels, 'le': '+Inf'}), 1)
+    _add(_series(f"{name}_sum", labels), value)
+    _add(_series(f"{name}_count", labels), 1)
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    inc('grok_cache_lookups_total', {'cache': cache})
+    if hit:
+        inc('grok_cache_hits_total', {'cache': cache})
+
+def tokens(usage) -> None:
+    """Count prompt/completion tokens from an OpenAI-style usage object (None is ignored)."""
+    if usage is None:
+        return
+    inc('grok_tokens_total', {'kind': 'prompt'}, usage.prompt_tokens or 0)
+    inc('grok_tokens_total', {'kind': 'completion'}, usage.completion_tokens or 0)
+
+@contextmanager
+def track(dependency: str):
+    """Time an upstream call; exceptions count as errors and propagate."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc('grok_dependency_errors_total', {'dependency': dependency})
+        raise
+    finally:
+        observe('grok_dependency_seconds', time.perf_counter() - start, {'dependency': dependency})
+
+def flush() -> bool:
+    """Add the local buffer to the shared Redis hash; on failure it is kept for the next try."""
+    if _redis is None:
+        return False
+    with _lock:
+        batch = dict(_pending)
+        _pending.clear()
+    if not batch:
+        return True
+    try:
+        pipe = _redis.pipeline(transaction=False)
+        for series, amount in batch.items():
+            pipe.hincrbyfloat(REDIS_KEY, series, amount)
+        pipe.execute()
+        return True
+    except Exception as e:
+        logger.warning(f"Metrics flush failed ({len(batch)} series kept locally): {type(e).__name__}: {str(e)}")
+        with _lock:
+            for series, amount in batch.items():
+                _pending[series] = _pending.get(series, 0) + amount
+        return False
+
+def _flush_loop() -> None:
+    while True:
+        time.sleep(_flush_interval)
+        flush()
+
+def snapshot() -> dict:
+    """series -> value, cluster-wide when Redis is reachable, else this worker's own counts."""
+    values = {}
+    if flush():
+        try:
+            values = {k: float(v) for k, v in _redis.hgetall(REDIS_KEY).items()}
+        except Exception as e:
+            logger.warning(f"Metrics read failed: {type(e).__name__}: {str(e)}")
+    with _lock:
+        for series, amount in _pending.items():
+            values[series] = values.get(series, 0) + amount
+    return values
+
+def _sort_key(series: str) -> tuple:
+    """Group a histogram's lines by label set: buckets in le order, then _sum, then _count."""
+    name, labels = _SERIES_RE.match(series).groups()
+    le = re.search(r'le="([^"]+)"', labels or '')
+    rank = 0 if name.endswith('_bucket') else 1 if name.endswith('_sum') else 2
+    return (re.sub(r',?le="[^"]+"', '', labels or ''), rank, float(le.group(1)) if le else 0)
+
+def _number(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
+
+def render(values: dict | None = None) -> str:
+    """Prometheus text exposition (version 0.0.4) of snapshot(), plus cache hit ratio gauges."""
+    values = snapshot() if values is None else values
+    families = {name: [] for name in METRICS}
+    for series in values:
+        match = _SERIES_RE.match(series)
+        if not match:
+            continue
+        base = re.sub(r'_(bucket|sum|count)$', '', match.group(1)) if match.group(1) not in METRICS else match.group(1)
+        if base in families:
+            families[base].append(series)
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        lines += [f"{series} {_number(values[series])}" for series in sorted(families[name], key=_sort_key)]
+    lines += ["# HELP grok_cache_hit_ratio Cache hits / lookups by cache", "# TYPE grok_cache_hit_ratio gauge"]
+    for series in sorted(families['grok_cache_lookups_total']):
+        labels = _SERIES_RE.match(series).group(2)
+        lookups, hits = values[series], values.get(f"grok_cache_hits_total{labels}", 0)
+        lines.append(f"grok_cache_hit_ratio{labels} {round(hits / lookups, 4) if lookups else 0}")
+    return '\n'.join(lines) + '\n'
+
+def counter_value(name: str, labels: dict | None = None, values: dict | None = None) -> float:
+    values = snapshot() if values is None else values
+    return values.get(_series(name, labels), 0)
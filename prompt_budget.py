@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# Token-budgeted prompt assembly for the Grok Flask API (grok.py, grok_asgi.py)
+#
+# The Grok tokenizer isn't published, so token counts are estimated locally from word and
+# punctuation pieces and scaled by a ratio calibrated against the prompt_tokens the API reports.
+# fit_prompt() keeps the system messages and the new user message whole, fills what is left of
+# the budget with history newest-first (the oldest message that straddles the limit is cut down
+# from the front), drops anything older, and returns a per-section token report.
+import re
+import threading
+
+PIECE_RE = re.compile(r"[A-Za-z]+|\d|[^\sA-Za-z\d]") # words, single digits, single symbols
+MESSAGE_OVERHEAD = 4 # role and separator tokens per chat message
+MIN_TRUNCATED_TOKENS = 32 # below this a cut-down message isn't worth keeping
+TRUNCATION_MARK = '[...] '
+
+class TokenEstimator:
+    """Word/punctuation piece count scaled by a ratio learnt from the API's usage figures."""
+    def __init__(self, ratio: float = 1.0, smoothing: float = 0.1):
+        self.ratio = ratio
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+    @staticmethod
+    def pieces(text: str) -> int:
+        # Long words split into several BPE tokens; roughly one extra per 6 letters past the first 6
+        return sum(1 + (len(p) - 1) // 6 for p in PIECE_RE.findall(text or ''))
+    def count(self, text: str) -> int:
+        return int(round(self.pieces(text) * self.ratio))
+    def message(self, msg: dict) -> int:
+        return self.count(msg.get('content') or '') + MESSAGE_OVERHEAD
+    def messages(self, msgs: list) -> int:
+        return sum(self.message(m) for m in msgs)
+    def calibrate(self, msgs: list, actual: int | None) -> None:
+        """Nudge the ratio towards the API's prompt_tokens for a prompt we estimated."""
+        raw = sum(self.pieces(m.get('content') or '') for m in msgs)
+        if not actual or not raw:
+            return
+        observed = (actual - MESSAGE_OVERHEAD * len(msgs)) / raw
+        with self._lock:
+            self.ratio = min(2.0, max(0.5, (1 - self.smoothing) * self.ratio + self.smoothing * observed))
+
+estimator = TokenEstimator()
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """Keep the end of text (the part nearest the next turn) within roughly `tokens`."""
+    total = estimator.count(text)
+    if total <= tokens:
+        return text
+    keep = int(len(text) * tokens / max(total, 1))
+    while keep > 0 and estimator.count(TRUNCATION_MARK + text[-keep:]) > tokens:
+        keep = int(keep * 0.9)
+    return TRUNCATION_MARK + text[-keep:] if keep > 0 else ''
+
+def fit_prompt(system: list, history: list, user: dict, budget: int) -> tuple[list, dict]:
+    """system + as much recent history as fits the budget + user -> (messages, token report)."""
+    system_tokens = estimator.messages(system)
+    message_tokens = estimator.message(user)
+    room = budget - system_tokens - message_tokens
+    kept = []
+    history_tokens = 0
+    truncated = False
+    for msg in reversed(history):
+        cost = estimator.message(msg)
+        if history_tokens + cost <= room:
+            kept.append(msg)
+            history_tokens += cost
+            continue
+        left = room - history_tokens - MESSAGE_OVERHEAD
+        if left >= MIN_TRUNCATED_TOKENS:
+            msg = {**msg, 'content': truncate_to_tokens(msg.get('content') or '', left)}
+            kept.append(msg)
+            history_tokens += estimator.message(msg)
+            truncated = True
+        break
+    kept.reverse()
+    report = {
+        'system': system_tokens,
+        'history': history_tokens,
+        'message': message_tokens,
+        'total': system_tokens + history_tokens + message_tokens,
+        'budget': budget,
+        'history_kept': len(kept),
+        'history_dropped': len(history) - len(kept),
+        'truncated': truncated,
+    }
+    return system + kept + [user], report
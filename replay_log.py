@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# Log-replay load generator for the Grok Flask API (grok.py, grok_asgi.py)
+#
+# Reads the /chat and /generate-image requests back out of log_file (rotated copies too) or an
+# NDJSON capture and replays them with their original nick:channel sessions, messages and gaps
+# (divided by --speed), so bursts, channel mix and intent mix are those of real traffic. Requests
+# are sent on schedule whether or not earlier ones have answered (open loop), and the run ends
+# with an SLO report: latency percentiles, 429 rate and errors by intent. --bench replays against
+# a fresh app on local stub upstreams (bench_server.py) instead of a running --url.
+#
+#   python3 replay_log.py /tmp/xaiChatApi.log --dry-run                  # workload shape only
+#   python3 replay_log.py /tmp/xaiChatApi.log* --url http://127.0.0.1:5000 --speed 4
+#   python3 replay_log.py capture.ndjson --bench -w 4 --speed 10 --max-gap 30 --slo p95=3000,rate_429=0.02
+#
+# NDJSON lines need 'nick', 'channel' and 'message' (or 'session' as "nick:channel", 'prompt' for
+# images), a 'ts'/'timestamp'/'time' in epoch seconds or ISO 8601, and optionally an 'endpoint'.
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from intent_router import route_message, chat_branch
+from bench_server import (percentile, parse_latency, start_stub, start_redis, write_config, free_port, start_app,
+                          stop_app, ProcMonitor)
+
+CHAT_LINE_RE = re.compile(r"Timestamp: (?P<ts>\d+(?:\.\d+)?), Request from nick: (?P<nick>.*?), channel: (?P<channel>.*?), message: (?P<message>.*)$")
+IMAGE_LINE_RE = re.compile(r"Image gen session: \S+, Timestamp: (?P<ts>\d+(?:\.\d+)?), Prompt: (?P<message>.*), Nick: (?P<nick>.*)$")
+ENDPOINTS = ('/chat', '/chat/stream', '/generate-image')
+SLO_KEYS = ('p50', 'p90', 'p95', 'p99', 'rate_429', 'error_rate')
+
+# ------------------------------------------------------------------------------
+# Workload
+# ------------------------------------------------------------------------------
+def parse_ts(value) -> float | None:
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+def parse_ndjson(record: dict) -> dict | None:
+    ts = parse_ts(next((record[k] for k in ('ts', 'timestamp', 'time') if k in record), None))
+    nick, channel = record.get('nick'), record.get('channel')
+    if (nick is None or channel is None) and ':' in str(record.get('session', '')):
+        nick, channel = str(record['session']).split(':', 1)
+    endpoint = record.get('endpoint') or ('/generate-image' if 'prompt' in record and 'message' not in record else '/chat')
+    message = record.get('message', record.get('prompt'))
+    if ts is None or not nick or not message or endpoint not in ENDPOINTS:
+        return None
+    return {'ts': ts, 'nick': str(nick), 'channel': str(channel or 'default'), 'message': str(message), 'endpoint': endpoint}
+
+def parse_line(line: str) -> dict | None:
+    line = line.rstrip('\n')
+    if line.startswith('{'):
+        try:
+            return parse_ndjson(json.loads(line))
+        except ValueError:
+            return None
+    match = CHAT_LINE_RE.search(line)
+    if match:
+        return {**match.groupdict(), 'ts': float(match['ts']), 'endpoint': '/chat'}
+    match = IMAGE_LINE_RE.search(line)
+    if match:
+        return {**match.groupdict(), 'ts': float(match['ts']), 'channel': '', 'endpoint': '/generate-image'}
+    return None
+
+def load_workload(paths: list[str]) -> list[dict]:
+    """Requests from every file, oldest first, each tagged with its intent branch."""
+    events = []
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            events += filter(None, map(parse_line, f))
+    events.sort(key=lambda e: e['ts'])
+    for event in events:
+        event['intent'] = 'image' if event['endpoint'] == '/generate-image' else chat_branch(route_message(event['message'])[0])
+    return events
+
+def schedule(events: list[dict], speed: float, max_gap: float | None) -> list[float]:
+    """Send offsets (seconds from replay start): original gaps, idle stretches capped at max_gap, divided by speed."""
+    offsets, at = [], 0.0
+    for i, event in enumerate(events):
+        if i:
+            gap = event['ts'] - events[i - 1]['ts']
+            at += (min(gap, max_gap) if max_gap else gap) / speed
+        offsets.append(at)
+    return offsets
+
+def shares(values: list, top: int = 10) -> list[tuple[str, int, float]]:
+    counts = {}
+    for v in values:
+        counts[v] = counts.get(v, 0) + 1
+    ordered = sorted(counts.items(), key=lambda kv: -kv[1])
+    return [(k, n, round(100 * n / len(values), 1)) for k, n in ordered[:top]]
+
+def describe(events: list[dict], offsets: list[float]) -> dict:
+    """Shape of the workload as it will be replayed: rate, burstiness, channel/intent mix."""
+    span = offsets[-1] if offsets else 0.0
+    peak_1s = peak_60s = 0
+    start = 0
+    for end, at in enumerate(offsets):
+        while at - offsets[start] >= 1.0:
+            start += 1
+        peak_1s = max(peak_1s, end - start + 1)
+    start = 0
+    for end, at in enumerate(offsets):
+        while at - offsets[start] >= 60.0:
+            start += 1
+        peak_60s = max(peak_60s, end - start + 1)
+    return {
+        'requests': len(events), 'sessions': len({(e['nick'], e['channel']) for e in events}),
+        'source_start': datetime.fromtimestamp(events[0]['ts']).isoformat(timespec='seconds') if events else None,
+        'source_span_s': round(events[-1]['ts'] - events[0]['ts'], 1) if events else 0.0,
+        'replay_span_s': round(span, 1), 'mean_rps': round(len(events) / span, 2) if span else float(len(events)),
+        'peak_1s': peak_1s, 'peak_60s': peak_60s,
+        'channels': shares([e['channel'] or '(image)' for e in events]), 'intents': shares([e['intent'] for e in events]),
+    }
+
+def print_workload(shape: dict, speed: float) -> None:
+    print(f"Workload: {shape['requests']} requests from {shape['sessions']} sessions, starting {shape['source_start']}, "
+          f"{shape['source_span_s']}s of traffic -> {shape['replay_span_s']}s at {speed}x")
+    print(f"Rate: {shape['mean_rps']} req/s mean, peak {shape['peak_1s']} in 1s, {shape['peak_60s']} in 60s")
+    print("Channels: " + ', '.join(f"{k} {p}%" for k, _, p in shape['channels']))
+    print("Intents:  " + ', '.join(f"{k} {p}%" for k, _, p in shape['intents']))
+
+# ------------------------------------------------------------------------------
+# Replay
+# ------------------------------------------------------------------------------
+def replay(events: list[dict], offsets: list[float], base: str, args) -> list[dict]:
+    """Send each request at its offset from a pool of args.max_inflight threads; returns one result per request."""
+    local = threading.local()
+    results = [None] * len(events)
+    def send(i: int, due: float) -> None:
+        http = getattr(local, 'session', None) or requests.Session()
+        local.session = http
+        event = events[i]
+        sent = time.perf_counter()
+        payload = {'prompt': event['message'], 'nick': event['nick']} if event['endpoint'] == '/generate-image' else \
+                  {'message': event['message'], 'nick': event['nick'], 'channel': event['channel']}
+        try:
+            with http.post(f"{base}{event['endpoint']}", json=payload, timeout=args.timeout, stream=True) as resp:
+                for _ in resp.iter_content(8192):
+                    pass
+                status = resp.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        results[i] = {'intent': event['intent'], 'channel': event['channel'], 'status': status,
+                      'latency': time.perf_counter() - sent, 'lag': sent - due}
+    with ThreadPoolExecutor(max_workers=args.max_inflight, thread_name_prefix='replay') as pool:
+        begin = time.perf_counter()
+        for i, offset in enumerate(offsets):
+            due = begin + offset
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, i, due)
+    return [r for r in results if r is not None]
+
+def stats(results: list[dict]) -> dict:
+    latencies = sorted(r['latency'] for r in results)
+    count = len(results)
+    limited = sum(1 for r in results if r['status'] == 429)
+    errors = {}
+    for r in results:
+        if not isinstance(r['status'], int) or r['status'] >= 500:
+            errors[str(r['status'])] = errors.get(str(r['status']), 0) + 1
+    return {'requests': count, **{f"p{p}": round(1000 * percentile(latencies, p), 1) for p in (50, 90, 95, 99)},
+            'max': round(1000 * latencies[-1], 1) if latencies else 0.0,
+            'rate_429': round(limited / count, 4) if count else 0.0,
+            'error_rate': round(sum(errors.values()) / count, 4) if count else 0.0, 'errors': errors}
+
+def parse_slo(spec: str) -> dict:
+    """'p95=3000,rate_429=0.02,...' -> limits (latencies in ms, rates as fractions)."""
+    slo = {}
+    for part in filter(None, spec.split(',')):
+        key, _, value = part.partition('=')
+        if key.strip() not in SLO_KEYS:
+            raise argparse.ArgumentTypeError(f"unknown SLO {key!r} (one of {', '.join(SLO_KEYS)})")
+        slo[key.strip()] = float(value)
+    return slo
+
+def print_report(report: dict) -> None:
+    overall, run = report['overall'], report['run']
+    print(f"\nReplayed {overall['requests']} requests in {run['elapsed_s']}s at {run['speed']}x against {run['target']}")
+    print(f"Dispatch lag p99 {report['dispatch_lag_p99_ms']} ms" +
+          (" (client pool saturated: raise --max-inflight)" if report['dispatch_lag_p99_ms'] > 100 else ''))
+    header = f"{'intent':<10} {'count':>6} {'p50':>8} {'p90':>8} {'p95':>8} {'p99':>8} {'max':>8} {'429%':>6} {'err%':>6}  errors"
+    print(header)
+    print('-' * len(header))
+    for intent, s in [*report['by_intent'].items(), ('ALL', overall)]:
+        errors = ', '.join(f"{k}={v}" for k, v in sorted(s['errors'].items()))
+        print(f"{intent:<10} {s['requests']:>6} {s['p50']:>8} {s['p90']:>8} {s['p95']:>8} {s['p99']:>8} {s['max']:>8} "
+              f"{100 * s['rate_429']:>6.1f} {100 * s['error_rate']:>6.1f}  {errors}")
+    if report.get('processes'):
+        print('\n' + '  '.join(f"{p['role']} {p['pid']}: {p['cpu_pct']}% cpu, {p['peak_rss_mb']} MB peak" for p in report['processes']))
+    for name, check in report['slo'].items():
+        print(f"SLO {name} <= {check['limit']}: {check['actual']} {'ok' if check['ok'] else 'FAILED'}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay logged /chat and /generate-image traffic against the Grok API")
+    parser.add_argument('logs', nargs='+', help="log_file copies and/or NDJSON captures")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="running instance to replay against")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay N times faster than recorded")
+    parser.add_argument('--max-gap', type=float, help="cap idle gaps between requests at this many (recorded) seconds")
+    parser.add_argument('--limit', type=int, help="replay only the first N requests")
+    parser.add_argument('--max-inflight', type=int, default=256, help="client threads; requests beyond this wait their turn")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--slo', type=parse_slo, default={}, help="limits to check, e.g. p95=3000,p99=8000,rate_429=0.02,error_rate=0.01")
+    parser.add_argument('--dry-run', action='store_true', help="print the workload shape and stop")
+    parser.add_argument('--save', help="write the report as JSON")
+    bench = parser.add_argument_group('--bench: start the app on stub upstreams (see bench_server.py)')
+    bench.add_argument('--bench', action='store_true')
+    bench.add_argument('-w', '--workers', type=int, default=2)
+    bench.add_argument('--async', dest='use_async', action='store_true')
+    bench.add_argument('--xai-latency', type=parse_latency, default=parse_latency('lognormal:0.6:0.35'))
+    bench.add_argument('--image-latency', type=parse_latency, default=parse_latency('lognormal:2.0:0.3'))
+    bench.add_argument('--provider-latency', type=parse_latency, default=parse_latency('lognormal:0.12:0.4'))
+    bench.add_argument('--redis', choices=('fake', 'external'), default='fake')
+    bench.add_argument('--redis-host', default='127.0.0.1')
+    bench.add_argument('--redis-port', type=int, default=6379)
+    bench.add_argument('--rate-limit', type=float, help="override rate_limit_seconds (default: the config's, so 429s are real)")
+    bench.add_argument('--reply-cache', action=argparse.BooleanOptionalAction, default=True)
+    bench.add_argument('--log-level', default='INFO')
+    bench.add_argument('--config', help="base config.json (default: the one next to this script)")
+    bench.add_argument('--startup-timeout', type=float, default=60.0)
+    args = parser.parse_args()
+    events = load_workload(args.logs)[:args.limit]
+    if not events:
+        parser.error("no requests found in " + ', '.join(args.logs))
+    offsets = schedule(events, args.speed, args.max_gap)
+    shape = describe(events, offsets)
+    print_workload(shape, args.speed)
+    if args.dry_run:
+        return 0
+    proc = stub = redis_server = monitor = workdir = None
+    base = args.url.rstrip('/')
+    try:
+        if args.bench:
+            stub = start_stub({'xai': args.xai_latency, 'image': args.image_latency, 'provider': args.provider_latency})
+            redis_server, _ = start_redis(args.redis, args.redis_host, args.redis_port)
+            workdir = tempfile.mkdtemp(prefix='grok_replay_')
+            write_config(workdir, args, f"http://127.0.0.1:{stub.server_address[1]}")
+            port = free_port()
+            proc = start_app(workdir, args, port)
+            base = f"http://127.0.0.1:{port}"
+            monitor = ProcMonitor(proc.pid)
+            monitor.start()
+        started = time.perf_counter()
+        results = replay(events, offsets, base, args)
+        elapsed = time.perf_counter() - started
+        processes = monitor.report(elapsed) if monitor else []
+    finally:
+        if proc is not None:
+            stop_app(proc)
+        if stub is not None:
+            stub.shutdown()
+        if redis_server is not None:
+            redis_server.shutdown()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    overall = stats(results)
+    intents = [k for k, _, _ in shape['intents']] + sorted({r['intent'] for r in results} - {k for k, _, _ in shape['intents']})
+    report = {
+        'run': {'target': base if not args.bench else f"bench ({'grok_asgi' if args.use_async else 'grok'} x{args.workers})",
+                'speed': args.speed, 'max_gap': args.max_gap, 'elapsed_s': round(elapsed, 2), 'logs': args.logs},
+        'workload': shape,
+        'overall': overall,
+        'by_intent': {i: stats([r for r in results if r['intent'] == i]) for i in intents},
+        'dispatch_lag_p99_ms': round(1000 * percentile(sorted(r['lag'] for r in results), 99), 1),
+        'processes': processes,
+        'slo': {k: {'limit': v, 'actual': overall[k], 'ok': overall[k] <= v} for k, v in args.slo.items()},
+    }
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nReport saved to {args.save}")
+    return 0 if all(check['ok'] for check in report['slo'].values()) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Startup profile for the Grok Flask API (grok.py, grok_asgi.py)
+#
+# Imports the app the way a gunicorn worker does, in a fresh interpreter under -X importtime, and
+# reports where boot time goes: the app's own phases (grok.boot_times: imports, config, setup,
+# startup_test, routes), the packages whose imports cost the most, and the app's direct imports
+# by cumulative time. --budget makes the exit status fail when importing the app (interpreter start-up
+# not included) takes longer.
+#
+#   python3 startup_profile.py                    # grok.py, top 15
+#   python3 startup_profile.py -m grok_asgi --budget 1.0
+#   python3 startup_profile.py --app-dir /opt/grok  # a deployed copy, with its own config.json
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+def profile(module: str, app_dir: str = APP_DIR) -> dict:
+    code = f"import json, grok, {module}; print('BOOT ' + json.dumps(grok.boot_times))"
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=app_dir, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    packages, direct, app_us = {}, [], 0
+    for line in proc.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), len(match[3]), match[4]
+        top = name.split('.')[0]
+        packages[top] = packages.get(top, 0) + self_us
+        if indent == 0 and name in ('grok', module): # the app's own import, its dependencies included
+            app_us += cumulative_us
+        if indent == 2: # imported directly by a module at the top level (the app, or grok via grok_asgi)
+            direct.append((name, cumulative_us))
+    boot = next((json.loads(l[5:]) for l in proc.stdout.splitlines() if l.startswith('BOOT ')), {})
+    return {'module': module, 'wall_s': round(wall, 3), 'app_s': round(app_us / 1e6, 3),
+            'import_s': round(sum(packages.values()) / 1e6, 3), 'phases': boot,
+            'packages': sorted(packages.items(), key=lambda kv: -kv[1]), 'direct': sorted(direct, key=lambda kv: -kv[1])}
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Where the app's boot time goes")
+    parser.add_argument('-m', '--module', default='grok', help="app module to import (grok or grok_asgi)")
+    parser.add_argument('--app-dir', default=APP_DIR, help="directory holding the app and its config.json")
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--budget', type=float, help="fail if importing the app takes longer than this many seconds")
+    parser.add_argument('--json', action='store_true', help="print the profile as JSON")
+    args = parser.parse_args()
+    result = profile(args.module, args.app_dir)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(f"import {args.module}: {result['app_s']:.3f}s, {result['import_s']:.3f}s of imports in all, {result['wall_s']:.3f}s wall (interpreter start included)")
+        print("\nApp phases:")
+        for phase, seconds in result['phases'].items():
+            print(f"  {phase:<14} {seconds:>8.3f}s")
+        print(f"\nPackages by own import time (top {args.top}):")
+        for name, us in result['packages'][:args.top]:
+            print(f"  {name:<28} {us / 1000:>8.1f} ms  {100 * us / max(sum(u for _, u in result['packages']), 1):>5.1f}%")
+        print(f"\nDirect imports by cumulative time (top {args.top}):")
+        for name, us in result['direct'][:args.top]:
+            print(f"  {name:<28} {us / 1000:>8.1f} ms")
+    if args.budget is not None and result['app_s'] > args.budget:
+        print(f"\nOver budget: import {args.module} took {result['app_s']:.3f}s > {args.budget:.3f}s")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# Streamed chunking must give the IRC lines chunked_reply() gives for the whole reply
+#
+#   python3 -m pytest -q test_chunking.py
+import random
+
+from chunking import chunked_reply, IncrementalChunker
+
+WORDS = ['a', 'bb', 'hello', 'world', 'well-known', '.', '  ', '\t', 'a\tb', '\t\t', '\n', '\n\n', '\\\\n',
+         'x' * 20, 'y' * 70, 'z' * 59, 'q' * 60, 'w' * 130]
+
+def streamed(text: str, width: int, rng: random.Random) -> list[str]:
+    chunker, lines, pos = IncrementalChunker(width), [], 0
+    while pos < len(text):
+        size = rng.randint(1, 15)
+        lines += chunker.feed(text[pos:pos + size])
+        pos += size
+    return lines + chunker.flush()
+
+def whole(text: str, width: int) -> list[str]:
+    full = text.strip().replace('\\\\n', '\n') # what /chat does before chunking
+    return [line for line in chunked_reply(full, width) if line] if full else []
+
+def test_streamed_matches_chunked_reply():
+    rng = random.Random(1)
+    for _ in range(5000):
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 60)))
+        assert streamed(text, 60, rng) == whole(text, 60), repr(text)
+
+def test_tabs_in_a_wrapped_paragraph():
+    text = 'word ' * 20 + 'tab\there ' + 'more ' * 20 + 'end\tof\tline\n'
+    rng = random.Random(2)
+    for _ in range(200):
+        assert streamed(text, 60, rng) == whole(text, 60)
+
+def test_default_width():
+    rng = random.Random(3)
+    for _ in range(500):
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 200)))
+        assert streamed(text, 380, rng) == whole(text, 380), repr(text)
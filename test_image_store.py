@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Image store references must die with their jobs: a file whose jobs have all expired is deleted
+#
+#   python3 -m pytest -q test_image_store.py
+import glob, importlib, json, os, shutil, sys
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+@pytest.fixture(scope='module')
+def grok(tmp_path_factory):
+    """grok imported from a copy of the app (it reads config.json next to itself), on fakeredis."""
+    workdir = tmp_path_factory.mktemp('app')
+    for path in glob.glob(os.path.join(APP_DIR, '*.py')):
+        shutil.copy(path, workdir)
+    with open(os.path.join(APP_DIR, 'config.json')) as f:
+        config = json.load(f)
+    config.update(log_file=str(workdir / 'grok.log'), image_save_dir=str(workdir / 'generate'),
+                  trace_file='', run_startup_test=False, xai_api_key='test')
+    with open(workdir / 'config.json', 'w') as f:
+        json.dump(config, f)
+    os.makedirs(workdir / 'generate')
+    sys.path.insert(0, str(workdir))
+    try:
+        module = importlib.import_module('grok')
+    finally:
+        sys.path.remove(str(workdir))
+    module.redis_client = fakeredis.FakeRedis(decode_responses=True)
+    module.acquire_image_script = module.redis_client.register_script(module.ACQUIRE_IMAGE_LUA)
+    module.release_image_script = module.redis_client.register_script(module.RELEASE_IMAGE_LUA)
+    yield module
+    sys.modules.pop('grok', None)
+
+def save(grok, filename: str) -> str:
+    path = os.path.join(grok.config['image_save_dir'], filename)
+    with open(path, 'wb') as f:
+        f.write(b'png')
+    return path
+
+def job(grok, job_id: str) -> None:
+    grok.redis_client.hset(f"imagejob:{job_id}", mapping={'job_id': job_id, 'status': 'done'})
+
+def test_expired_jobs_release_their_references(grok):
+    path = save(grok, 'grok_img_fox.png')
+    job(grok, 'a'); job(grok, 'b')
+    grok.store_image('grok_img_fox.png', 'A red fox', {'original': {'file': 'grok_img_fox.png'}}, 'a')
+    assert grok.find_prompt_image('a red   fox!', 'b')['file'] == 'grok_img_fox.png'
+    assert grok.redis_client.hget('image:grok_img_fox.png', 'refs') == '2'
+    grok.redis_client.delete('imagejob:a') # image_job_ttl passed
+    assert grok.release_expired_image_refs() == 1
+    assert os.path.exists(path) and grok.redis_client.hget('image:grok_img_fox.png', 'refs') == '1'
+    assert grok.release_expired_image_refs() == 0
+    grok.redis_client.delete('imagejob:b')
+    assert grok.release_expired_image_refs() == 1
+    assert not os.path.exists(path)
+    assert not grok.redis_client.exists('image:grok_img_fox.png', 'image:grok_img_fox.png:jobs')
+    assert not grok.redis_client.sismember(grok.IMAGE_FILES, 'grok_img_fox.png')
+
+def test_deleted_job_is_not_released_again_on_expiry(grok):
+    path = save(grok, 'grok_img_owl.png')
+    job(grok, 'c'); job(grok, 'd')
+    grok.store_image('grok_img_owl.png', 'an owl', {'original': {'file': 'grok_img_owl.png'}}, 'c')
+    grok.find_prompt_image('an owl', 'd')
+    assert grok.remove_image_job({'job_id': 'c', 'image_file': 'grok_img_owl.png'}) == 1
+    grok.redis_client.delete('imagejob:c')
+    assert grok.release_expired_image_refs() == 0
+    assert os.path.exists(path)
+    assert grok.remove_image_job({'job_id': 'd', 'image_file': 'grok_img_owl.png'}) == 0
+    assert not os.path.exists(path)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Per-request tracing spans for the Grok Flask API (grok.py, grok_asgi.py)
+#
+# start() opens a trace for one /chat request (joining an incoming W3C traceparent if Eggdrop
+# or a proxy sent one), span() times a stage or an upstream call under it, and finish() hands
+# the spans to a background writer that appends them as NDJSON, one span per line, with
+# OTLP-style field names (trace_id, span_id, parent_span_id, start/end_time_unix_nano, attributes,
+# status). The trace's request ID goes out on upstream calls as X-Request-ID and traceparent.
+#
+# Gunicorn workers share one trace file: each line goes out in a single write() on an O_APPEND
+# descriptor, so lines from different processes never interleave, and only one process rotates it
+# (the master, see gunicorn.conf.py; workers are configured with rotate=False).
+import os
+import re
+import json
+import time
+import queue
+import random
+import threading
+import logging
+import contextvars
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+_trace = contextvars.ContextVar('trace', default=None)
+_parent = contextvars.ContextVar('trace_parent_span', default=None)
+_settings = {'path': '', 'sample_rate': 1.0, 'max_bytes': 50 * 1024 * 1024, 'rotate': True}
+_queue = queue.SimpleQueue()
+_owner_pid = os.getpid()
+_writer_thread = None
+_lock = threading.Lock()
+
+class Trace:
+    __slots__ = ('trace_id', 'root_id', 'parent_id', 'request_id', 'name', 'start', 'sampled', 'spans', 'attributes')
+    def __init__(self, name: str, request_id: str | None = None, traceparent: str | None = None):
+        match = _TRACEPARENT_RE.match((traceparent or '').strip().lower())
+        self.trace_id = match.group(1) if match else os.urandom(16).hex()
+        self.parent_id = match.group(2) if match else None
+        self.root_id = os.urandom(8).hex()
+        self.request_id = (request_id or '').strip()[:64] or self.trace_id[:16]
+        self.name = name
+        self.start = time.time_ns()
+        self.sampled = bool(_settings['path']) and random.random() < _settings['sample_rate']
+        self.spans = []
+        self.attributes = {}
+
+def configure(path: str, sample_rate: float = 1.0, max_bytes: int = 50 * 1024 * 1024, rotate: bool = True) -> None:
+    """NDJSON sink path ('' disables export), share of requests traced, size at which the file is rotated to .1,
+    and whether this process's writer does the rotating."""
+    _settings.update(path=path, sample_rate=float(sample_rate), max_bytes=int(max_bytes), rotate=bool(rotate))
+
+def rotate() -> bool:
+    """Move the trace file to .1 once it reaches max_bytes; call from one process only."""
+    path = _settings['path']
+    if not path or not _settings['max_bytes'] or not os.path.exists(path) or os.path.getsize(path) < _settings['max_bytes']:
+        return False
+    os.replace(path, path + '.1')
+    return True
+
+def start(name: str, request_id: str | None = None, traceparent: str | None = None) -> Trace:
+    trace = Trace(name, request_id, traceparent)
+    _trace.set(trace)
+    _parent.set(None)
+    return trace
+
+def resume(trace: Trace | None) -> None:
+    """Make trace current again, in a streamed response's generator that outlives the view."""
+    _trace.set(trace)
+    _parent.set(None)
+
+def current() -> Trace | None:
+    return _trace.get()
+
+def request_id() -> str | None:
+    trace = _trace.get()
+    return trace.request_id if trace else None
+
+def traceparent() -> str | None:
+    """W3C traceparent for an outgoing call, parented on the innermost open span."""
+    trace = _trace.get()
+    if trace is None:
+        return None
+    return f"00-{trace.trace_id}-{_parent.get() or trace.root_id}-{'01' if trace.sampled else '00'}"
+
+def annotate(**attributes) -> None:
+    """Attach attributes (intent, session...) to the request's root span."""
+    trace = _trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a stage of the current trace; a no-op outside a sampled request."""
+    trace = _trace.get()
+    if trace is None or not trace.sampled:
+        yield None
+        return
+    record = {'name': name, 'span_id': os.urandom(8).hex(), 'parent_span_id': _parent.get() or trace.root_id,
+              'start_time_unix_nano': time.time_ns(), 'attributes': attributes, 'status': 'OK'}
+    token = _parent.set(record['span_id'])
+    try:
+        yield record
+    except Exception as e:
+        record['status'] = 'ERROR'
+        record['attributes'] = {**attributes, 'error': f"{type(e).__name__}: {str(e)}"[:200]}
+        raise
+    finally:
+        try:
+            _parent.reset(token)
+        except ValueError: # closed from another context (a streamed response's generator)
+            _parent.set(record['parent_span_id'])
+        record['end_time_unix_nano'] = time.time_ns()
+        trace.spans.append(record)
+
+def wrap(fn):
+    """fn bound to a copy of the current context, so spans from a worker thread join this request's trace."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)
+
+def finish(**attributes) -> Trace | None:
+    """Close the root span and queue the trace for export."""
+    trace = _trace.get()
+    _trace.set(None)
+    if trace is None or not trace.sampled:
+        return trace
+    root = {'name': trace.name, 'span_id': trace.root_id, 'parent_span_id': trace.parent_id,
+            'start_time_unix_nano': trace.start, 'end_time_unix_nano': time.time_ns(),
+            'attributes': {**trace.attributes, **attributes, 'request_id': trace.request_id}, 'status': 'OK'}
+    _export(trace.trace_id, [root] + trace.spans)
+    return trace
+
+def _export(trace_id: str, spans: list) -> None:
+    global _writer_thread, _queue, _owner_pid
+    with _lock:
+        if os.getpid() != _owner_pid: # forked: the writer thread stayed in the parent
+            _queue, _owner_pid, _writer_thread = queue.SimpleQueue(), os.getpid(), None
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_writer_loop, args=(_queue,), name='trace-writer', daemon=True)
+            _writer_thread.start()
+    _queue.put((trace_id, spans))
+
+def _writer_loop(q: queue.SimpleQueue) -> None:
+    while True:
+        batch = [q.get()]
+        while not q.empty() and len(batch) < 256:
+            batch.append(q.get_nowait())
+        path = _settings['path']
+        try:
+            if _settings['rotate']:
+                rotate()
+            # Reopened per batch so writes follow a rotation done by another process
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                for trace_id, spans in batch:
+                    for s in spans:
+                        os.write(fd, (json.dumps({'trace_id': trace_id, **s}, default=str) + '\n').encode('utf-8'))
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.warning(f"Trace export to {path} failed: {type(e).__name__}: {str(e)}")
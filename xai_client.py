@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# Shared xAI client registry for the Grok Flask APIs (grok.py, grok4.py, xaiChatApi.py)
+#
+# One OpenAI client (and so one httpx connection pool) per process and endpoint,
+# created lazily on first use so that each gunicorn worker builds its own after fork.
+import os
+import threading
+import time
+import logging
+import asyncio
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Pool defaults; each can be overridden from config.json
+POOL_DEFAULTS = {
+    'xai_pool_max_connections': 20,
+    'xai_pool_max_keepalive': 10,
+    'xai_keepalive_expiry': 120.0, # seconds an idle connection is kept open
+    'xai_keepwarm_interval': 50.0, # seconds of idleness before a keep-warm ping, 0 to disable
+}
+_clients = {} # (api_key, base_url) -> OpenAI
+_http_clients = {} # (api_key, base_url) -> httpx.Client backing the OpenAI client
+_last_used = {} # (api_key, base_url) -> monotonic time of last checkout
+_async_clients = {} # (api_key, base_url, id(loop)) -> AsyncOpenAI, for the async server (grok_asgi.py)
+_lock = threading.Lock()
+_owner_pid = os.getpid()
+_keepwarm_thread = None
+
+def _pool_setting(config: dict | None, name: str):
+    return (config or {}).get(name, POOL_DEFAULTS[name])
+
+def _reset_after_fork() -> None:
+    """Drop clients inherited from the parent; their sockets belong to the parent's pool."""
+    global _lock, _owner_pid, _keepwarm_thread
+    _clients.clear()
+    _http_clients.clear()
+    _last_used.clear()
+    _async_clients.clear()
+    _lock = threading.Lock()
+    _owner_pid = os.getpid()
+    _keepwarm_thread = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _keepwarm_loop(interval: float) -> None:
+    """Ping endpoints that have sat idle so the pooled TLS connection survives quiet spells."""
+    while True:
+        time.sleep(interval)
+        with _lock:
+            idle = [(key, _http_clients[key]) for key, used in _last_used.items()
+                    if key in _http_clients and time.monotonic() - used >= interval]
+        for (api_key, base_url), http_client in idle:
+            try:
+                http_client.head(base_url, timeout=5.0)
+                logger.debug(f"Keep-warm ping to {base_url} ok")
+            except Exception as e:
+                logger.debug(f"Keep-warm ping to {base_url} failed: {type(e).__name__}: {str(e)}")
+
+def _start_keepwarm(config: dict | None) -> None:
+    global _keepwarm_thread
+    interval = float(_pool_setting(config, 'xai_keepwarm_interval') or 0)
+    if interval <= 0 or _keepwarm_thread is not None:
+        return
+    _keepwarm_thread = threading.Thread(target=_keepwarm_loop, args=(interval,), name='xai-keepwarm', daemon=True)
+    _keepwarm_thread.start()
+
+def _limits(config: dict | None) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=int(_pool_setting(config, 'xai_pool_max_connections')),
+        max_keepalive_connections=int(_pool_setting(config, 'xai_pool_max_keepalive')),
+        keepalive_expiry=float(_pool_setting(config, 'xai_keepalive_expiry')),
+    )
+
+def get_client(api_key: str, base_url: str, config: dict | None = None) -> OpenAI:
+    """Return the pooled OpenAI-compatible client for (api_key, base_url), building it on first use."""
+    if os.getpid() != _owner_pid: # forked without the at-fork hook (e.g. multiprocessing on old Pythons)
+        _reset_after_fork()
+    key = (api_key, base_url)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            limits = _limits(config)
+            timeout = float((config or {}).get('api_timeout', 30.0))
+            http_client = httpx.Client(limits=limits, timeout=timeout)
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, timeout=timeout)
+            _clients[key] = client
+            _http_clients[key] = http_client
+            logger.info(f"Created pooled client for {base_url} (pid: {os.getpid()}, max_connections: {limits.max_connections})")
+        _last_used[key] = time.monotonic()
+        _start_keepwarm(config)
+    return client
+
+def probe(api_key: str, base_url: str, timeout: float = 30.0, attempts: int = 3) -> dict:
+    """Startup connectivity check: one tiny completion, retried with backoff (2s, 4s...).
+
+    Uses a throwaway client so no pool or keep-warm thread outlives it (gunicorn.conf.py runs
+    this in the master, before forking). Returns {'ok', 'at', 'reply'} or {'ok', 'at', 'error'}.
+    """
+    client = OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0) # retried below, not by the SDK too
+    error = None
+    try:
+        for attempt in range(1, attempts + 1):
+            try:
+                response = client.chat.completions.create(model="grok-3", messages=[{"role": "user", "content": "ping"}], max_tokens=10)
+                reply = response.choices[0].message.content
+                logger.info(f"API connectivity test successful: {reply}")
+                return {'ok': True, 'at': time.time(), 'reply': reply}
+            except Exception as e:
+                error = f"{type(e).__name__}: {str(e)}"
+                logger.warning(f"API connectivity test attempt {attempt}/{attempts} failed: {error}")
+                if attempt < attempts:
+                    time.sleep(2 ** attempt)
+        logger.error(f"API connectivity test failed after {attempts} attempts: {error}")
+        return {'ok': False, 'at': None, 'error': error}
+    finally:
+        client.close()
+
+def get_async_client(api_key: str, base_url: str, config: dict | None = None) -> AsyncOpenAI:
+    """Async twin of get_client(), one per (endpoint, running event loop)."""
+    if os.getpid() != _owner_pid:
+        _reset_after_fork()
+    key = (api_key, base_url, id(asyncio.get_running_loop()))
+    client = _async_clients.get(key)
+    if client is None:
+        limits = _limits(config)
+        timeout = float((config or {}).get('api_timeout', 30.0))
+        http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, timeout=timeout)
+        _async_clients[key] = client
+        logger.info(f"Created pooled async client for {base_url} (pid: {os.getpid()}, max_connections: {limits.max_connections})")
+    return client
+
+async def aclose_clients() -> None:
+    """Close the async clients bound to the running loop (async server shutdown)."""
+    loop_id = id(asyncio.get_running_loop())
+    for key in [k for k in _async_clients if k[2] == loop_id]:
+        try:
+            await _async_clients.pop(key).close()
+        except Exception as e:
+            logger.debug(f"Async client close failed: {type(e).__name__}: {str(e)}")
+
+def close_clients() -> None:
+    """Close every pooled client owned by this process (worker shutdown)."""
+    with _lock:
+        for client in _clients.values():
+            try:
+                client.close()
+            except Exception as e:
+                logger.debug(f"Client close failed: {type(e).__name__}: {str(e)}")
+        _clients.clear()
+        _http_clients.clear()
+        _last_used.clear()